@@ -1,8 +1,13 @@
-from django.db import models
-from django.core.exceptions import FieldError
+from django.db import models, transaction, connection
+from django.core.exceptions import FieldError, ValidationError
 from treebeard.al_tree import AL_Node
-from polymorphic import PolymorphicModel, ShowFieldTypeAndContent
+from polymorphic import PolymorphicModel, PolymorphicManager, PolymorphicQuerySet, \
+    ShowFieldTypeAndContent
+from polymorphic.query_strategies import SubclassJoin
+from polymorphic.registry import ctype_table
+from bakul.resolver import PathResolver
 import uuid as uuid_impl # Renamed to avoid clash with field names.
+from itertools import islice
 
 DEFAULT_NODE_TYPE = u'bakul:node'
 DEFAULT_PROPERTY_TYPE = u'bakul:property'
@@ -17,6 +22,28 @@ def print_qset(qset):
         print item
 
 
+def prefetch_properties(nodes):
+    """
+    Fetch the properties of all given nodes with a single query and cache them
+    on each node, so properties(), property() and has_property() need no
+    further queries (see Node.get_property_bag)
+    :param nodes: list of saved Node instances
+    """
+    nodes = dict([(node.id, node) for node in nodes if node.id])
+    ids = nodes.keys()
+    for node in nodes.values():
+        node._property_cache = {}
+    join = SubclassJoin(Item, PROPERTY_MODELS)
+    qn = connection.ops.quote_name
+    # Stay below the query parameter limit of sqlite
+    for start in range(0, len(ids), PROPERTY_BATCH_SIZE):
+        batch = ids[start:start + PROPERTY_BATCH_SIZE]
+        where = u'T0.%s IN (%s)' % (qn(Item._meta.get_field('parent').column),
+            u', '.join([u'%s'] * len(batch)))
+        for prop in join.fetch_objects(where, batch):
+            nodes[prop.parent_id]._property_cache[prop.name] = prop
+
+
 def get_uuid():
     """
     Generates UUID4
@@ -69,6 +96,9 @@ class Item(PolymorphicModel, ShowFieldTypeAndContent, AL_Node):
     name = models.CharField(max_length = 50, null = True, default = '', db_index = True)
     parent = models.ForeignKey('self', related_name='children_set', null=True,
         db_index=True)
+    # Materialized path maintained by AL_Node, answers ancestor, descendant and
+    # depth queries with a single query
+    path = models.CharField(max_length = 255, null = True, unique = True)
     # Enable node_order_by only if sib_order is not used
     node_order_by = ['date_created', 'date_modified']
     # Enable sib_order only if node_order_by is not used
@@ -85,12 +115,26 @@ class Item(PolymorphicModel, ShowFieldTypeAndContent, AL_Node):
         :param depth: maximum depth to traverse. If ommitted defaults to 1
                 
         """
-        print u'- <%d, %s>' % (self.id, self.uuid)
-        if depth > 0:
-            children = self.get_children()
-            for ch in children:
-                print u' ',
-                ch.dump_tree(depth - 1)
+        # Fetch the whole branch at once instead of querying per node
+        base_depth = self.get_depth()
+        for node in Item.get_tree(self, levels=depth):
+            print u'%s- <%d, %s>' % (u'  ' * (node.get_depth() - base_depth),
+                node.id, node.uuid)
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            # A rename changes every path that goes through this item
+            path_resolver.invalidate(self.path)
+        super(Item, self).save(*args, **kwargs)
+
+    def _prepare_bulk_insert(self):
+        # Stores the real class, as save() would (see AL_Node.bulk_load)
+        self.pre_save_polymorphic()
+
+    def move(self, target, pos=None):
+        old_path = self.path
+        super(Item, self).move(target, pos)
+        path_resolver.invalidate(old_path)
     
     def get_children(self):
         if issubclass(self.__class__, AL_Node):
@@ -110,11 +154,58 @@ class Item(PolymorphicModel, ShowFieldTypeAndContent, AL_Node):
 #   class Meta:
 #       abstract = True
 
+class NodeQuerySet(PolymorphicQuerySet):
+    """
+    QuerySet for Node, adds prefetch_properties()
+    """
+    def __init__(self, *args, **kwargs):
+        self.properties_prefetched = False
+        super(NodeQuerySet, self).__init__(*args, **kwargs)
+
+    def _clone(self, *args, **kwargs):
+        new = super(NodeQuerySet, self)._clone(*args, **kwargs)
+        new.properties_prefetched = self.properties_prefetched
+        return new
+
+    def prefetch_properties(self):
+        """
+        Load the properties of the resulting nodes together, one query per
+        PROPERTY_BATCH_SIZE nodes, instead of one query per node
+        """
+        new = self._clone()
+        new.properties_prefetched = True
+        return new
+
+    def iterator(self):
+        base_iter = super(NodeQuerySet, self).iterator()
+        if not self.properties_prefetched:
+            for o in base_iter: yield o
+            return
+
+        while True:
+            batch = list(islice(base_iter, PROPERTY_BATCH_SIZE))
+            if not batch: return
+            prefetch_properties([o for o in batch if isinstance(o, Node)])
+            for o in batch: yield o
+
+
+# Resolves workspace paths into Item primary keys, see Workspace.get_node
+path_resolver = PathResolver(Item)
+
+def invalidate_deleted_item(sender, instance, **kwargs):
+    path_resolver.invalidate(instance.path)
+
+# Deleting an instance of a sub class deletes its Item row as well
+models.signals.post_delete.connect(invalidate_deleted_item, sender=Item)
+
+
 class Node(Item):
     date_created = models.DateTimeField(null = False, auto_now_add = True)
     date_modified = models.DateTimeField(null = False, auto_now = True)
     node_type = models.ForeignKey('NodeType', null = True)
 
+    objects = PolymorphicManager(NodeQuerySet)
+
     def has_property(self, prop_name, narrow_check=False):
         """
         Test if this Node has property(es) prop_name. prop_name can be a unicode string
@@ -132,68 +223,69 @@ class Node(Item):
             raise NotImplementedError
         else:
 
+            # Served from the property bag, a single query for all names
+            bag = self.get_property_bag()
             if (type(prop_name) == list):
-                # If prop_name is a list...
-                # Narrow down search, make use of cache
-                avail_prop = self.get_children().instance_of(Property).filter(name__in = prop_name)
-                #avail_prop = Property.objects.filter(parent__id = self.id, name__in = prop_name)
-                has_status = []
-                for pn in prop_name:
-                    try: 
-                        if avail_prop.get(name = pn): has_status.append(True)
-                    except Item.DoesNotExist: has_status.append(False)
-            
-                assert len(has_status) == len(prop_name), "Returned statuses must be as much as passed prop names."
-                return has_status
-        
+                return [pn in bag for pn in prop_name]
             else:
-                prop_child = Property.objects.filter(parent__id = self.id, name = prop_name)
-                if prop_child : return True
-                else: return False
+                return prop_name in bag
 
     def set_property(self, **kwargs):       
         """
         Set property of this node. property names will be checked for existance a
         and values will be checked for type compatibility
+
+        All properties are read with one query (the property bag) and written with
+        one executemany() UPDATE per concrete property type: every value is a plain
+        parameter for the column of its own type.
         """
         # Node ini harus sudah tersave sebelum bisa tambah property
         if not self.id: raise ValueError("Node must be saved before adding properties.")
 
-        if kwargs.has_key("identifier") or kwargs.has_key("date_created") or kwargs.has_key("date_modified"):
-            # TODO bisakah basic Node property di ubah2?
-            # ...untuk sekarang, buang saja dan abaikan dulu
-            kwargs.pop("identifier")
-            kwargs.pop("date_created")
-            kwargs.pop("date_modified")
+        # TODO bisakah basic Node property di ubah2?
+        # ...untuk sekarang, buang saja dan abaikan dulu
+        for basic_prop in ("identifier", "date_created", "date_modified"):
+            kwargs.pop(basic_prop, None)
         
         # TODO Perlukah sanity checking kwargs lebih jauh lagi?
-        candidate_props = kwargs.keys()
-        candidate_status = self.has_property(candidate_props)
-        # Manfaatkan caching dengan mengambil properties yg sudah pasti ada dulu
-        exists_props = self.properties_qset().filter(name__in = candidate_props)
-        for i in range(0,len(candidate_status)):
-            prop_name = candidate_props[i]
-            prop_value = kwargs[prop_name]
-            # Berdasarkan candidate_status ke-i...
-            if candidate_status[i]:
-                # ...node ini sudah punya property bernama candidate_props[i], tinggal men-set valuenya saja
-                prop = exists_props[i]
-                print prop.value.__class__
-                ##
-                # FIXME I'm not sure if this is the best wayt to do type compatibility check
-                ##
-                self.__type_check(prop.value, prop_value)
-                if type(prop_value) == str: prop_value = unicode(prop_value)    # Tweak for str v unicode
-                if type(prop.value) != type(prop_value):
-                    raise ValueError(u"%s, Incompatible value type for '%s'. Expecting '%s' but got '%s'" % (self.node_type.name, prop_name, type(prop.value),  type(prop_value)))
-    
-                prop.value = prop_value
-                prop.save()
-            
-            else:
-                # ...node ini belum punya property bernama candidate_prop[i], 
+        type_name = self.node_type and self.node_type.name or DEFAULT_NODE_TYPE
+        bag = self.get_property_bag()
+        # Every kwarg is checked before the cached properties are touched
+        checked = []
+        for prop_name, prop_value in kwargs.items():
+            if not prop_name in bag:
+                # ...node ini belum punya property bernama prop_name, 
                 # silently ignore? raise ValueError?
-                raise ValueError(u"%s, Property '%s' not found." % (self.node_type.name, prop_name))
+                raise ValueError(u"%s, Property '%s' not found." % (type_name, prop_name))
+
+            prop = bag[prop_name]
+            field = prop._meta.get_field('value')
+            if type(prop_value) == str: prop_value = unicode(prop_value)    # Tweak for str v unicode
+            try:
+                prop_value = field.to_python(prop_value)
+            except ValidationError:
+                raise ValueError(u"%s, Incompatible value type for '%s'. Expecting '%s' but got '%s'" % (
+                    type_name, prop_name, field.__class__.__name__, type(prop_value)))
+            checked.append((prop, field, prop_value))
+
+        # updates[property class] = [(property, new db value), ...]
+        updates = {}
+        for prop, field, prop_value in checked:
+            prop.value = prop_value
+            # Honors auto_now, as prop.save() would
+            prop_value = field.pre_save(prop, False)
+            updates.setdefault(prop.__class__, []).append(
+                (prop, field.get_db_prep_save(prop_value, connection=connection)))
+
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for klass, values in updates.items():
+            sql = u'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+                qn(klass._meta.db_table), qn(klass._meta.get_field('value').column),
+                qn(klass._meta.pk.column))
+            cursor.executemany(sql, [ (db_value, prop.pk) for prop, db_value in values ])
+        transaction.commit_unless_managed()
+        self.clear_property_cache()
     
     def set_node_type(self, node_type):     
         ##
@@ -239,6 +331,25 @@ class Node(Item):
         assert prop is not None, u"This node sould have property '%s'" % prop_name
         return prop.value
 
+    def save(self, *args, **kwargs):
+        super(Node, self).save(*args, **kwargs)
+        self.clear_property_cache()
+
+    def get_property_bag(self):
+        """
+        Get this node's properties, loaded with a single query and cached on this node
+        until the next save() or set_property()
+        :returns: dictionary of property name -> Property instance
+        """
+        if not hasattr(self, '_property_cache'):
+            if not self.id: return {}
+            prefetch_properties([self])
+        return self._property_cache
+
+    def clear_property_cache(self):
+        if hasattr(self, '_property_cache'):
+            del self._property_cache
+
     def properties_qset(self):
         """
         Get a query set containing all Properties of this node
@@ -251,15 +362,31 @@ class Node(Item):
         Get this node's properties as python dictionary
         :returns: this node's properties
         """
-        prop_child = self.get_children().instance_of(Property)
         d = {}
-        for p in prop_child:
-            d[p.name] = p.value
+        for name, p in self.get_property_bag().items():
+            d[name] = p.value
 
         return d
 
+    def property_values(self):
+        """
+        Get this node's properties as (uuid, name, value) tuples, read with a
+        single query without creating Property instances
+        :returns: list of (uuid, name, value) tuples, ordered by property id
+        """
+        fields = [u'%s___value' % model.__name__ for model in PROPERTY_MODELS]
+        rows = Item.objects.filter(parent = self).instance_of(*PROPERTY_MODELS).order_by('id') \
+            .polymorphic_values_list('uuid', 'name', 'polymorphic_ctype', *fields)
+        # The value is in the column of the real property type
+        columns = dict([(ctype_table.id_for_model(model), i + 3)
+            for i, model in enumerate(PROPERTY_MODELS)])
+        return [(row[0], row[1], row[columns[row[2]]]) for row in rows]
+
     def property(self, prop_name):
-        return self.properties_qset().get(name = prop_name)
+        try:
+            return self.get_property_bag()[prop_name]
+        except KeyError:
+            raise Property.DoesNotExist(u"Property '%s' not found." % prop_name)
 
     
 
@@ -303,6 +430,13 @@ class TextProperty(Property):
 class TimeProperty(Property):
     value = models.TimeField(null = True, auto_now = True)
 
+# Concrete property types, loaded together by prefetch_properties
+PROPERTY_MODELS = (StringProperty, BooleanProperty, NullBooleanProperty, DateProperty,
+    DateTimeProperty, DecimalProperty, FloatProperty, IntegerProperty, TextProperty,
+    TimeProperty)
+# Maximum number of nodes per property bag query
+PROPERTY_BATCH_SIZE = 500
+
 
 class Repository(models.Model):
     name = models.CharField(max_length = 50, null = False, db_index = True, unique = True)
@@ -311,8 +445,8 @@ class Repository(models.Model):
     root_node = models.OneToOneField('Node', null = False)
 
     def __unicode__(self):
-        return u"{'name' : '%s', 'uuid' : '%s'}" %
-            (self.name, self.uuid)
+        return u"{'name' : '%s', 'uuid' : '%s'}" % (
+            self.name, self.uuid)
 
     def create_workspace(self, ws_name, path = None):
         """
@@ -325,9 +459,9 @@ class Repository(models.Model):
 
 
 class Workspace(Node):
-    root_node = models.ForeignKey('Node', null = False)
+    root_node = models.ForeignKey('Node', null = False, related_name = 'workspaces')
     repository = models.ForeignKey('Repository', null = False)
-    current_node = root_node
+    current_node = models.ForeignKey('Node', null = True, related_name = 'current_workspaces')
 
     def cwd(self, path):
         """
@@ -335,13 +469,18 @@ class Workspace(Node):
         :param path: new working node's path
         :returns: new working node
         """
-        raise NotImplementedError
+        node = self.get_node(path)
+        if not isinstance(node, Node):
+            raise ValueError(u"'%s' is not a node." % path)
+        self.current_node = node
+        Workspace.objects.filter(pk = self.pk).update(current_node = node)
+        return node
 
     def pwd(self):
         """
         :returns: Current working node
         """
-        raise NotImplementedError
+        return self.current_node or self.root_node
 
     def create_node(self, node_type):
         """
@@ -353,11 +492,42 @@ class Workspace(Node):
 
     def get_node(self, path):
         """
-        Fetch node in path <code>path</code>
+        Fetch node in path <code>path</code>. Absolute paths start at the
+        workspace's root node, relative paths at the current working node.
+        Resolving the path takes one query, none if it was resolved before,
+        then the node is fetched from its real class with one more query.
         :params path: The node's path
         :returns: The node
         """
-        raise NotImplementedError
+        node = self.get_nodes([path])[path]
+        if node is None:
+            raise Item.DoesNotExist(u"Path '%s' not found." % path)
+        return node
+
+    def get_nodes(self, paths):
+        """
+        Fetch the nodes of many paths, resolved together (see get_node)
+        :params paths: list of paths
+        :returns: dictionary of path -> node (None if the path doesn't exist)
+        """
+        found = {}
+        for absolute, base in ((True, self.root_node), (False, self.pwd())):
+            batch = [path for path in paths if path.startswith(u'/') == absolute]
+            if batch:
+                found.update(path_resolver.resolve_typed(base, batch))
+        # The resolver knows the real classes, one query per class
+        by_ctype = {}
+        for pk, ctype_id in filter(None, found.values()):
+            by_ctype.setdefault(ctype_id, []).append(pk)
+        items = {}
+        for ctype_id, pks in by_ctype.items():
+            if ctype_id is None:
+                items.update(Item.objects.polymorphic_strategy('join').in_bulk(pks))
+            else:
+                model = ctype_table.class_for_id(ctype_id)
+                items.update(model.objects.non_polymorphic().in_bulk(pks))
+        return dict([(path, found[path] and items.get(found[path][0]))
+            for path in found])
 
     def print_cwd(self):
         raise NotImplementedError
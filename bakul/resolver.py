@@ -0,0 +1,212 @@
+"""
+Resolution of slash separated paths (made of Item names) into Item primary keys.
+"""
+from django.db import connection
+from django.db.models.fields import FieldDoesNotExist
+
+# Maximum number of resolved paths kept by a PathResolver
+PATH_CACHE_SIZE = 1000
+# Maximum number of paths resolved by a single query
+PATH_BATCH_SIZE = 50
+
+
+def split_path(path):
+    """
+    Split a slash separated path into its names, '.' and '..' are resolved
+    :param path: the path, e.g. u'/projects/acme/spec'
+    :returns: list of names
+    """
+    names = []
+    for name in path.split(u'/'):
+        if not name or name == u'.':
+            continue
+        if name == u'..':
+            if not names:
+                raise ValueError(u"Path '%s' goes above its base node." % path)
+            names.pop()
+        else:
+            names.append(name)
+    return names
+
+
+class LRUCache(object):
+    """
+    Minimal least recently used cache
+    """
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self._data = {}
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default = None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        self._tick += 1
+        entry[0] = self._tick
+        return entry[1]
+
+    def set(self, key, value):
+        self._tick += 1
+        self._data[key] = [self._tick, value]
+        if len(self._data) > self.size:
+            # Evict the least recently used quarter at once
+            entries = sorted(self._data.items(), key = lambda item: item[1][0])
+            for key, entry in entries[:max(1, self.size / 4)]:
+                del self._data[key]
+
+    def remove_if(self, func):
+        """
+        Remove all entries for which func(key, value) is true
+        """
+        for key, entry in self._data.items():
+            if func(key, entry[1]):
+                del self._data[key]
+
+
+class PathResolver(object):
+    """
+    Resolves paths relative to a base node into primary keys, one query per
+    batch of paths, and caches the results.
+
+    The cache keeps the materialized path (see AL_Node) and the ContentType
+    id (see PolymorphicModel) of every resolved item, so moving, renaming or deleting an item only drops the paths that
+    go through it (see invalidate).
+
+    The cache lives in the process: it's only invalidated by the saves, moves
+    and deletes of this process. Other processes (e.g. the other workers of
+    the web server) keep resolving a renamed, moved or deleted item to its old
+    path until the entry is evicted, so writers that need it must clear the
+    cache of every process (or use a size of 0 there).
+    """
+    def __init__(self, model, size = PATH_CACHE_SIZE):
+        self.model = model
+        self.cache = LRUCache(size)
+        # Number of queries run, for monitoring cache efficiency
+        self.queries = 0
+
+    def resolve(self, base, path):
+        """
+        Resolve one path
+        :param base: the node relative paths are resolved from
+        :param path: slash separated path of item names
+        :returns: the primary key of the item, or None if there's none
+        """
+        return self.resolve_many(base, [path])[path]
+
+    def resolve_many(self, base, paths):
+        """
+        Resolve many paths from the same base node with at most one query per
+        PATH_BATCH_SIZE paths not found in the cache
+        :returns: dictionary of path -> primary key (None for missing paths)
+        """
+        return dict([(path, found and found[0])
+            for path, found in self.resolve_typed(base, paths).items()])
+
+    def resolve_typed(self, base, paths):
+        """
+        Resolve many paths like resolve_many, along with the ContentType id
+        of the items (None if the model isn't polymorphic), so the caller can
+        fetch them from their real classes directly
+        :returns: dictionary of path -> (primary key, ContentType id), None
+            for missing paths
+        """
+        result = {}
+        missing = []
+        for path in paths:
+            names = tuple(split_path(path))
+            if not names:
+                result[path] = (base.pk, getattr(base, 'polymorphic_ctype_id', None))
+                continue
+            cached = self.cache.get((base.pk, names))
+            if cached is None:
+                missing.append((path, names))
+            else:
+                result[path] = (cached[0], cached[3])
+
+        for start in range(0, len(missing), PATH_BATCH_SIZE):
+            batch = missing[start:start + PATH_BATCH_SIZE]
+            found = self._fetch(base.pk, [names for path, names in batch])
+            for idx, (path, names) in enumerate(batch):
+                if idx in found:
+                    pk, item_path, ctype_id = found[idx]
+                    self.cache.set((base.pk, names), (pk, item_path, base.path, ctype_id))
+                    result[path] = (pk, ctype_id)
+                else:
+                    # Misses are not cached, the item may be created later
+                    result[path] = None
+        return result
+
+    def _fetch(self, base_pk, names_list):
+        """
+        Run the self-join query for a list of name tuples
+        :returns: dictionary of index in names_list -> (pk, path, ctype id)
+        """
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        pk = qn(opts.pk.column)
+        parent = qn(opts.get_field('parent').column)
+        name = qn(opts.get_field('name').column)
+        path = qn(opts.get_field('path').column)
+        try:
+            ctype = qn(opts.get_field('polymorphic_ctype').column)
+        except FieldDoesNotExist:
+            ctype = None
+
+        arms = []
+        params = []
+        for idx, names in enumerate(names_list):
+            joins = [u'%s t1' % table]
+            where = [u't1.%s = %%s' % parent, u't1.%s = %%s' % name]
+            params.extend([base_pk, names[0]])
+            for level in range(2, len(names) + 1):
+                joins.append(u'INNER JOIN %s t%d ON t%d.%s = t%d.%s' % (
+                    table, level, level, parent, level - 1, pk))
+                where.append(u't%d.%s = %%s' % (level, name))
+                params.append(names[level - 1])
+            last = len(names)
+            arms.append(u'SELECT %d, t%d.%s, t%d.%s, %s FROM %s WHERE %s' % (
+                idx, last, pk, last, path,
+                ctype and u't%d.%s' % (last, ctype) or u'NULL',
+                u' '.join(joins), u' AND '.join(where)))
+
+        cursor = connection.cursor()
+        cursor.execute(u' UNION ALL '.join(arms), params)
+        self.queries += 1
+        found = {}
+        for idx, item_pk, item_path, ctype_id in cursor.fetchall():
+            # Sibling names aren't unique, the oldest item wins
+            if idx not in found or item_pk < found[idx][0]:
+                found[idx] = (item_pk, item_path, ctype_id)
+        return found
+
+    def invalidate(self, item_path):
+        """
+        Drop the cached paths that go through an item that was moved, renamed
+        or deleted
+        :param item_path: the (old) materialized path of the item
+        """
+        if not len(self.cache):
+            return
+        if not item_path:
+            # Without a materialized path we can't tell what it affects
+            self.cache.clear()
+            return
+
+        def affected(key, value):
+            pk, path, base_path, ctype_id = value
+            if not path or not base_path:
+                return True
+            # The item must lie between the base node and the resolved item
+            return path.startswith(item_path) and len(item_path) > len(base_path)
+        self.cache.remove_if(affected)
+
+    def clear(self):
+        self.cache.clear()
@@ -21,3 +21,206 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+from decimal import Decimal
+from bakul.models import Node, Property, StringProperty, IntegerProperty, \
+    BooleanProperty, DecimalProperty, TextProperty, prefetch_properties, \
+    Item, Repository, Workspace, path_resolver
+from polymorphic.registry import ctype_table
+from treebeard.testutils import QueryCountMixin
+
+
+class PropertyBagTest(QueryCountMixin, TestCase):
+
+    def setUp(self):
+        self.node = Node.objects.create(name = u'node')
+        self.other = Node.objects.create(name = u'other')
+        for node in (self.node, self.other):
+            StringProperty.objects.create(parent = node, name = u'title', value = node.name)
+            IntegerProperty.objects.create(parent = node, name = u'size', value = 1)
+            IntegerProperty.objects.create(parent = node, name = u'count', value = 2)
+            BooleanProperty.objects.create(parent = node, name = u'hidden')
+            DecimalProperty.objects.create(parent = node, name = u'price', value = Decimal('1.5'))
+        Node.objects.create(name = u'child', parent = self.node)
+
+    def test_properties_single_query(self):
+        props, queries = self._count_queries(self.node.properties)
+        self.assertEqual(queries, 1)
+        self.assertEqual(props, {u'title': u'node', u'size': 1, u'count': 2,
+            u'hidden': False, u'price': Decimal('1.5')})
+        prop, queries = self._count_queries(self.node.property, u'size')
+        self.assertEqual(queries, 0)
+        self.assertEqual(type(prop), IntegerProperty)
+        self.assertEqual(prop.parent_id, self.node.id)
+        self.assertRaises(Property.DoesNotExist, self.node.property, u'child')
+        self.assertEqual(self.node.has_property([u'size', u'child', u'title']),
+            [True, False, True])
+        self.assertEqual(self.node.has_property(u'price'), True)
+
+    def test_prefetch_properties(self):
+        nodes = list(Node.objects.filter(parent__isnull = True).non_polymorphic())
+        ret, queries = self._count_queries(prefetch_properties, nodes)
+        self.assertEqual(queries, 1)
+        self.assertEqual([node.properties()[u'title'] for node in nodes],
+            [u'node', u'other'])
+
+    def test_prefetch_properties_queryset(self):
+        nodes, queries = self._count_queries(lambda:
+            list(Node.objects.filter(parent__isnull = True).prefetch_properties()))
+        # Node query, then one query for all properties
+        self.assertEqual(queries, 2)
+        props, queries = self._count_queries(lambda:
+            [(node.properties(), node.property(u'title').value,
+              node.has_property([u'size', u'missing'])) for node in nodes])
+        self.assertEqual(queries, 0)
+        self.assertEqual([p[1:] for p in props], [
+            (u'node', [True, False]), (u'other', [True, False])])
+        self.assertEqual(props[1][0][u'size'], 1)
+        node = Node.objects.prefetch_properties().get(name = u'child')
+        self.assertEqual(node.properties(), {})
+
+    def test_property_values(self):
+        values, queries = self._count_queries(self.node.property_values)
+        self.assertEqual(queries, 1)
+        self.assertEqual([v[1:] for v in values], [(u'title', u'node'), (u'size', 1),
+            (u'count', 2), (u'hidden', False), (u'price', Decimal('1.5'))])
+        self.assertEqual(values[0][0], self.node.property(u'title').uuid)
+
+    def test_only_listing(self):
+        TextProperty.objects.create(parent = self.node, name = u'notes', value = u'long text')
+        items, queries = self._get_queries(lambda:
+            list(Item.objects.filter(parent = self.node).only('name').order_by('id')))
+        # base query, then one query per real class (Node and 5 property types),
+        # without the values
+        self.assertEqual(len(queries), 7)
+        self.assertFalse('"value"' in ' '.join([q['sql'] for q in queries]))
+        self.assertEqual([item.name for item in items],
+            [u'title', u'size', u'count', u'hidden', u'price', u'child', u'notes'])
+        self.assertEqual(type(items[-1]).__bases__, (TextProperty, ))
+        self.assertEqual(items[-1].value, u'long text')
+
+    def test_set_property(self):
+        self.node.properties()
+        ret, queries = self._count_queries(self.node.set_property,
+            title = 'changed', size = 10, count = 20, price = Decimal('2.25'),
+            date_created = None)
+        # One UPDATE per concrete property type, the bag was already cached
+        self.assertEqual(queries, 3)
+        self.assertEqual(self.node.properties(), {u'title': u'changed', u'size': 10,
+            u'count': 20, u'hidden': False, u'price': Decimal('2.25')})
+        self.assertEqual(Node.objects.get(pk = self.other.pk).properties()[u'size'], 1)
+
+    def test_set_property_errors(self):
+        self.assertRaises(ValueError, self.node.set_property, missing = 1)
+        self.assertRaises(ValueError, self.node.set_property, size = u'many')
+        self.assertRaises(ValueError, Node().set_property, size = 1)
+        # a failing kwarg leaves the cached properties untouched
+        self.node.properties()
+        self.assertRaises(ValueError, self.node.set_property,
+            hidden = True, title = u'changed', size = u'many')
+        self.assertRaises(ValueError, self.node.set_property,
+            count = 7, missing = 1)
+        self.assertEqual(self.node.properties()[u'hidden'], False)
+        self.assertEqual(self.node.properties()[u'title'], u'node')
+        self.assertEqual(self.node.properties()[u'count'], 2)
+        self.assertEqual(Node.objects.get(pk = self.node.pk).properties()[u'size'], 1)
+
+    def test_cache_invalidation(self):
+        self.node.properties()
+        IntegerProperty.objects.filter(parent = self.node, name = u'size').update(value = 5)
+        self.assertEqual(self.node.properties()[u'size'], 1)
+        self.node.save()
+        self.assertEqual(self.node.properties()[u'size'], 5)
+
+
+class WorkspacePathTest(QueryCountMixin, TestCase):
+
+    def setUp(self):
+        path_resolver.clear()
+        ctype_table.warm()
+        self.root = Node.objects.create(name = u'root')
+        self.projects = Node.objects.create(name = u'projects', parent = self.root)
+        self.acme = Node.objects.create(name = u'acme', parent = self.projects)
+        self.spec = Node.objects.create(name = u'spec', parent = self.acme)
+        self.title = StringProperty.objects.create(name = u'title', parent = self.spec,
+            value = u'Spec')
+        self.other = Node.objects.create(name = u'other', parent = self.root)
+        repository = Repository.objects.create(name = u'repo', root_node = self.root)
+        self.ws = Workspace.objects.create(name = u'ws', root_node = self.root,
+            repository = repository)
+
+    def test_get_node(self):
+        node, queries = self._count_queries(self.ws.get_node, u'/projects/acme/spec/title')
+        # One query resolves the path, one fetches the item from its real class
+        self.assertEqual((node, queries), (self.title, 2))
+        self.assertEqual(type(node), StringProperty)
+        self.assertEqual(node.value, u'Spec')
+        node, queries = self._count_queries(path_resolver.resolve, self.root,
+            u'/projects/acme/spec/title')
+        self.assertEqual((node, queries), (self.title.pk, 0))
+        # Cached, only the item is fetched
+        node, queries = self._count_queries(self.ws.get_node, u'/projects/acme/spec/title')
+        self.assertEqual((node, queries), (self.title, 1))
+        self.assertEqual(type(node), StringProperty)
+        self.assertEqual(self.ws.get_node(u'/'), self.root)
+        self.assertEqual(self.ws.get_node(u'/projects/./acme/../acme/'), self.acme)
+        self.assertRaises(Item.DoesNotExist, self.ws.get_node, u'/projects/missing')
+        self.assertRaises(ValueError, self.ws.get_node, u'/..')
+
+    def test_get_nodes_batched(self):
+        paths = [u'/projects', u'/projects/acme/spec', u'/other', u'/nothing', u'/']
+        nodes, queries = self._count_queries(self.ws.get_nodes, paths)
+        # One query resolves the paths, one fetches the nodes
+        self.assertEqual(queries, 2)
+        self.assertEqual(nodes, {u'/projects': self.projects, u'/projects/acme/spec': self.spec,
+            u'/other': self.other, u'/nothing': None, u'/': self.root})
+        # Cached now, misses aren't cached
+        nodes, queries = self._count_queries(self.ws.get_nodes, paths[:3])
+        self.assertEqual(queries, 1)
+
+    def test_cwd(self):
+        self.assertEqual(self.ws.pwd(), self.root)
+        self.assertEqual(self.ws.cwd(u'/projects/acme'), self.acme)
+        self.assertEqual(self.ws.get_node(u'spec/title'), self.title)
+        self.assertEqual(Workspace.objects.get(pk = self.ws.pk).pwd(), self.acme)
+        self.assertRaises(ValueError, self.ws.cwd, u'spec/title')
+
+    def test_invalidation(self):
+        self.ws.get_nodes([u'/projects/acme/spec', u'/other'])
+        self.assertEqual(len(path_resolver.cache), 2)
+        # Renaming an item drops the paths that go through it
+        self.acme.name = u'acme2'
+        self.acme.save()
+        self.assertEqual(len(path_resolver.cache), 1)
+        self.assertRaises(Item.DoesNotExist, self.ws.get_node, u'/projects/acme/spec')
+        self.assertEqual(self.ws.get_node(u'/projects/acme2/spec'), self.spec)
+        # Moving too
+        self.acme.move(self.other, 'sorted-child')
+        self.assertEqual(len(path_resolver.cache), 1)
+        self.assertEqual(self.ws.get_node(u'/other/acme2/spec'), self.spec)
+        # And deleting
+        Item.objects.get(pk = self.spec.pk).delete()
+        self.assertEqual(self.ws.get_nodes([u'/other/acme2/spec', u'/other']),
+            {u'/other/acme2/spec': None, u'/other': self.other})
+
+
+class BulkLoadTest(QueryCountMixin, TestCase):
+
+    def test_bulk_load(self):
+        data = [{'data': {'name': u'root'}, 'model': Node, 'children': [
+            {'data': {'name': u'title', 'value': u'Root'}, 'model': 'bakul.StringProperty'},
+            {'data': {'name': u'size', 'value': 3}, 'model': IntegerProperty},
+            {'data': {'name': u'child'}, 'model': Node, 'children': [
+                {'data': {'name': u'hidden', 'value': True}, 'model': BooleanProperty}]}]}]
+        ids, queries = self._count_queries(Item.bulk_load, data)
+        self.assertEqual(len(ids), 5)
+        # Max id and path, a (cached) content type per model, then one
+        # executemany per table, whatever the number of nodes
+        self.assertTrue(queries <= 2 + 4 + 6)
+        root = Node.objects.get(name = u'root')
+        self.assertEqual(root.properties(), {u'title': u'Root', u'size': 3})
+        child = Node.objects.get(name = u'child')
+        self.assertEqual(child.properties()[u'hidden'], True)
+        self.assertEqual(child.get_depth(), 2)
+        self.assertEqual(child.path[:-4], root.path)
+        self.assertEqual(type(Item.objects.get(pk = ids[1])), StringProperty)
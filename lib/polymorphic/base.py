@@ -4,10 +4,10 @@
 """
 
 import sys
-import inspect
 
 from django.db import models
 from django.db.models.base import ModelBase
+from django.db.models.fields.related import SingleRelatedObjectDescriptor, ReverseSingleRelatedObjectDescriptor
 
 from manager import PolymorphicManager
 from query import PolymorphicQuerySet
@@ -73,8 +73,14 @@ class PolymorphicModelBase(ModelBase):
         # validate resulting default manager
         self.validate_model_manager(new_class._default_manager, model_name, '_default_manager')
 
-        # for __init__ function of this class (monkeypatching inheritance accessors)
-        new_class.polymorphic_super_sub_accessors_replaced = False
+        # store the default manager as a plain class attribute, like Django does for
+        # non-polymorphic models (reading it through a ManagerDescriptor costs a python call)
+        if not new_class._meta.abstract:
+            new_class._default_manager = new_class._default_manager
+
+        # replace Django's inheritance accessors (to the super and sub models)
+        if not new_class._meta.abstract and not new_class._deferred:
+            new_class.replace_inheritance_accessors()
 
         # determine the name of the primary key field and store it into the class variable
         # polymorphic_primary_key_name (it is needed by query.py)
@@ -83,6 +89,11 @@ class PolymorphicModelBase(ModelBase):
                 new_class.polymorphic_primary_key_name=f.name
                 break
 
+        if (not new_class._meta.abstract and not new_class._deferred
+                and not new_class in self.polymorphic_models):
+            self.polymorphic_models.append(new_class)
+            if self.polymorphic_dump_mode: self.switch_default_manager(new_class, True)
+
         return new_class
 
     def get_inherited_managers(self, attrs):
@@ -97,6 +108,8 @@ class PolymorphicModelBase(ModelBase):
             if not getattr(base, 'polymorphic_model_marker', None): continue # leave managers of non-polym. models alone
 
             for key, manager in base.__dict__.items():
+                if key == '_default_manager' and base in self.polymorphic_saved_default_managers:
+                    manager = self.polymorphic_saved_default_managers[base]     # dump mode
                 if type(manager) == models.manager.ManagerDescriptor: manager = manager.manager
                 if not isinstance(manager, models.Manager): continue
                 if key in ['_base_manager']: continue       # let Django handle _base_manager
@@ -152,6 +165,51 @@ class PolymorphicModelBase(ModelBase):
                 e = 'PolymorphicModel: "%s" - field name "%s" is not allowed in polymorphic models'
                 raise AssertionError(e % (self.__name__, f.name) )
 
+    def replace_inheritance_accessors(self):
+        """Replace Django's inheritance accessor member functions for this model
+        with our own versions.
+        We monkey patch them until a patch can be added to Django
+        (which would probably be very small and make all of this obsolete).
+
+        If we have inheritance of the form ModelA -> ModelB ->ModelC then
+        Django creates accessors like this:
+        - ModelA: modelb
+        - ModelB: modela_ptr, modelb, modelc
+        - ModelC: modela_ptr, modelb, modelb_ptr, modelc
+
+        These accessors allow Django (and everyone else) to travel up and down
+        the inheritance tree for the db object at hand.
+
+        The original Django accessors use our polymorphic manager.
+        But they should not. So we replace them with our own accessors that use
+        our appropriate base_objects manager (and cache the object they return).
+
+        This is done once, when the model is created: its accessors to its super
+        models are replaced, and the accessor to this model on its direct
+        (polymorphic) super models (the sub models are created after their bases).
+        """
+        for name, model in self.get_inheritance_relation_fields_and_models().iteritems():
+            replace_inheritance_accessor(self, name, model)
+        name = self.__name__.lower()
+        for base in self.__bases__:
+            if getattr(base, 'polymorphic_model_marker', None):
+                replace_inheritance_accessor(base, name, self)
+
+    def get_inheritance_relation_fields_and_models(self):
+        """helper function for replace_inheritance_accessors:
+        determine names of all Django inheritance accessor member functions
+        to the super models of this model"""
+        result = {}
+        def add_all_super_models(model):
+            if ( issubclass(model, models.Model) and model != models.Model
+                and model != self
+                and not model._meta.abstract ):
+                result[model.__name__.lower() + '_ptr'] = model
+            for b in model.__bases__:
+                add_all_super_models(b)
+        add_all_super_models(self)
+        return result
+
     @classmethod
     def validate_model_manager(self, manager, model_name, manager_name):
         """check if the manager is derived from PolymorphicManager
@@ -168,24 +226,58 @@ class PolymorphicModelBase(ModelBase):
         return manager
 
 
-    # hack: a small patch to Django would be a better solution.
     # Django's management command 'dumpdata' relies on non-polymorphic
-    # behaviour of the _default_manager. Therefore, we catch any access to _default_manager
-    # here and return the non-polymorphic default manager instead if we are called from 'dumpdata.py'
-    # (non-polymorphic default manager is 'base_objects' for polymorphic models).
-    # This way we don't need to patch django.core.management.commands.dumpdata
-    # for all supported Django versions.
-    # TODO: investigate Django how this can be avoided
-    _dumpdata_command_running = False
-    if len(sys.argv)>1: _dumpdata_command_running = ( sys.argv[1] == 'dumpdata' )
-    def __getattribute__(self, name):
-        if name=='_default_manager':
-            if self._dumpdata_command_running:
-                frm = inspect.stack()[1] # frm[1] is caller file name, frm[3] is caller function name
-                if 'django/core/management/commands/dumpdata.py' in frm[1]:
-                    return self.base_objects
-                #caller_mod_name = inspect.getmodule(frm[0]).__name__  # does not work with python 2.4
-                #if caller_mod_name == 'django.core.management.commands.dumpdata':
-
-        return super(PolymorphicModelBase, self).__getattribute__(name)
+    # behaviour of the _default_manager. In dump mode, the _default_manager of
+    # every polymorphic model is replaced by its non-polymorphic manager
+    # 'base_objects', so 'dumpdata' (or any other export code) gets the plain
+    # base objects. Dump mode is switched on automatically when the command line
+    # runs 'dumpdata' (see is_dumpdata_command), and can be switched explicitly
+    # with set_dump_mode().
+    # The managers are swapped on the classes, so there is no cost per attribute access.
+    polymorphic_models = []             # all non-abstract polymorphic models
+    polymorphic_dump_mode = False
+    polymorphic_saved_default_managers = {}     # model -> its _default_manager class attribute
 
+    @classmethod
+    def set_dump_mode(self, enabled):
+        "switch the _default_manager of all polymorphic models to base_objects (enabled=True) or back"
+        PolymorphicModelBase.polymorphic_dump_mode = enabled
+        for model in self.polymorphic_models:
+            self.switch_default_manager(model, enabled)
+
+    @classmethod
+    def switch_default_manager(self, model, dump_mode):
+        saved = self.polymorphic_saved_default_managers
+        if dump_mode and model not in saved:
+            saved[model] = model.__dict__.get('_default_manager')
+            setattr(model, '_default_manager', model.base_objects)
+        elif not dump_mode and model in saved:
+            manager = saved.pop(model)
+            if manager is None: delattr(model, '_default_manager')
+            else: setattr(model, '_default_manager', manager)
+
+
+def replace_inheritance_accessor(model, name, accessor_model):
+    """replace Django's accessor 'name' (to the super or sub model accessor_model) of
+    model, if it has one, by a property that retrieves the object with the
+    base_objects manager of accessor_model and caches it in the instance"""
+    orig_accessor = getattr(model, name, None)
+    if not type(orig_accessor) in [SingleRelatedObjectDescriptor, ReverseSingleRelatedObjectDescriptor]:
+        return
+    cache_name = '_polymorphic_%s_cache' % name
+    def accessor_function(self):
+        try:
+            return self.__dict__[cache_name]
+        except KeyError:
+            obj = accessor_model.base_objects.get(pk=self.pk)
+            self.__dict__[cache_name] = obj
+            return obj
+    setattr(model, name, property(accessor_function))
+
+
+def is_dumpdata_command(argv):
+    "true if the command line argv runs 'dumpdata' (which needn't be the first argument, options or wrappers may come first)"
+    return 'dumpdata' in argv[1:]
+
+if is_dumpdata_command(sys.argv):
+    PolymorphicModelBase.polymorphic_dump_mode = True
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+""" Micro benchmarks for the polymorphic query machinery
+    Please see README.rst or DOCS.rst or http://bserve.webhop.org/wiki/django_polymorphic
+
+    Usage (e.g. from manage.py shell):
+        from polymorphic.benchmarks import benchmark_filter
+        print benchmark_filter(Model2A, 'Model2C___field3', 'C3')
+        print benchmark_class_attribute(Model2A)
+        print benchmark_instantiation(StringProperty, 100000)
+        print benchmark_type_dispatch(Model2A)
+        print benchmark_values(Model2A.objects.all(), 'field1', 'Model2C___field3')
+"""
+
+import time
+
+from registry import subclass_registry, ctype_table
+
+
+def benchmark_filter(model, field_path, value=None, repeat=1000):
+    """
+    Measure the cost of one model.objects.filter(**{field_path: value}) call
+    (building the queryset, no query is run), in seconds.
+
+    Returns a dict with the time per call with the subclass registry filled
+    ('cached') and cleared before every call ('uncached').
+    """
+    kwargs = { field_path: value }
+
+    def run(clear):
+        start = time.time()
+        for i in xrange(repeat):
+            if clear: subclass_registry.clear()
+            model.objects.filter(**kwargs)
+        return (time.time() - start) / repeat
+
+    result = { 'uncached': run(True) }
+    # the first call fills the registry
+    model.objects.filter(**kwargs)
+    result['cached'] = run(False)
+    return result
+
+
+def benchmark_class_attribute(model, name='_default_manager', plain_model=None, repeat=100000):
+    """
+    Measure the cost of reading a class attribute (getattr(model, name)) of a
+    polymorphic model, in seconds.
+
+    Returns a dict with the time per access for model ('model') and for the same
+    attribute of a plain Django model ('plain', ContentType by default) for comparison.
+    """
+    if plain_model is None:
+        from django.contrib.contenttypes.models import ContentType
+        plain_model = ContentType
+
+    def run(cls):
+        start = time.time()
+        for i in xrange(repeat):
+            getattr(cls, name)
+        return (time.time() - start) / repeat
+
+    return { 'model': run(model), 'plain': run(plain_model) }
+
+
+def benchmark_instantiation(model, count=100000):
+    """
+    Measure the cost of creating count instances of model from a database row,
+    as a queryset does (model(*row)), in seconds. No query is run.
+
+    Returns a dict with the total time ('total') and the time per instance ('instance').
+    """
+    row = [ field.get_default() for field in model._meta.fields ]
+    start = time.time()
+    for i in xrange(count):
+        model(*row)
+    total = time.time() - start
+    return { 'total': total, 'instance': total / count }
+
+
+def benchmark_type_dispatch(model, repeat=100000):
+    """
+    Measure the polymorphic type dispatch (ContentType id -> model class), in seconds.
+
+    Returns a dict with the cold-start cost of loading the ContentType table ('cold'),
+    and the time per lookup with the table ('table') and with the ContentType
+    manager cache ('contenttype').
+    """
+    from django.contrib.contenttypes.models import ContentType
+    ctype_table.clear()
+    result = { 'cold': ctype_table.warm() }
+    ctype_id = ctype_table.id_for_model(model)
+
+    start = time.time()
+    for i in xrange(repeat):
+        ctype_table.class_for_id(ctype_id)
+    result['table'] = (time.time() - start) / repeat
+
+    start = time.time()
+    for i in xrange(repeat):
+        ContentType.objects.get_for_id(ctype_id).model_class()
+    result['contenttype'] = (time.time() - start) / repeat
+    return result
+
+
+def benchmark_values(queryset, *fields, **kwargs):
+    """
+    Measure reading fields (ModelX___field paths allowed) of all objects of queryset
+    with polymorphic_values_list() compared to retrieving the objects, in seconds.
+
+    Returns a dict with the time per evaluation for polymorphic_values_list ('values')
+    and list(queryset) ('objects').
+    """
+    repeat = kwargs.get('repeat', 10)
+
+    def run(get):
+        start = time.time()
+        for i in xrange(repeat):
+            get()
+        return (time.time() - start) / repeat
+
+    return { 'values': run(lambda: queryset.polymorphic_values_list(*fields)),
+             'objects': run(lambda: list(queryset.all())) }
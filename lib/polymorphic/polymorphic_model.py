@@ -28,6 +28,7 @@ from manager import PolymorphicManager
 from query import PolymorphicQuerySet
 from showfields import ShowFieldType
 from query_translate import translate_polymorphic_Q_object
+from registry import ctype_table
 
  
 ###################################################################################
@@ -89,8 +90,8 @@ class PolymorphicModel(models.Model):
         field to figure out the real class of this object
         (used by PolymorphicQuerySet._get_real_instances)
         """
-        if not self.polymorphic_ctype:
-            self.polymorphic_ctype = ContentType.objects.get_for_model(self)
+        if not self.polymorphic_ctype_id:
+            self.polymorphic_ctype_id = ctype_table.id_for_model(self.__class__)
 
     def save(self, *args, **kwargs):
         """Overridden model save function which supports the polymorphism
@@ -105,8 +106,8 @@ class PolymorphicModel(models.Model):
         determined using this method.""" 
         # the following line would be the easiest way to do this, but it produces sql queries
         #return self.polymorphic_ctype.model_class()
-        # so we use the following version, which uses the CopntentType manager cache
-        return ContentType.objects.get_for_id(self.polymorphic_ctype_id).model_class()
+        # so we use the following version, which uses our in-process ContentType table
+        return ctype_table.class_for_id(self.polymorphic_ctype_id)
     
     def get_real_instance(self):
         """Normally not needed.
@@ -117,74 +118,3 @@ class PolymorphicModel(models.Model):
         real_model = self.get_real_instance_class()
         if real_model == self.__class__: return self
         return real_model.objects.get(pk=self.pk)
-
-
-    def __init__(self, * args, ** kwargs):
-        """Replace Django's inheritance accessor member functions for our model
-        (self.__class__) with our own versions.
-        We monkey patch them until a patch can be added to Django
-        (which would probably be very small and make all of this obsolete).
-
-        If we have inheritance of the form ModelA -> ModelB ->ModelC then
-        Django creates accessors like this:
-        - ModelA: modelb
-        - ModelB: modela_ptr, modelb, modelc
-        - ModelC: modela_ptr, modelb, modelb_ptr, modelc
-
-        These accessors allow Django (and everyone else) to travel up and down
-        the inheritance tree for the db object at hand.
-
-        The original Django accessors use our polymorphic manager.
-        But they should not. So we replace them with our own accessors that use
-        our appropriate base_objects manager.
-        """
-        super(PolymorphicModel, self).__init__(*args, ** kwargs)
-
-        if self.__class__.polymorphic_super_sub_accessors_replaced: return
-        self.__class__.polymorphic_super_sub_accessors_replaced = True
-
-        def create_accessor_function_for_model(model, accessor_name):
-            def accessor_function(self):
-                attr = model.base_objects.get(pk=self.pk)
-                return attr
-            return accessor_function
-
-        subclasses_and_superclasses_accessors = self._get_inheritance_relation_fields_and_models()
-
-        from django.db.models.fields.related import SingleRelatedObjectDescriptor, ReverseSingleRelatedObjectDescriptor
-        for name,model in subclasses_and_superclasses_accessors.iteritems():
-            orig_accessor = getattr(self.__class__, name, None)
-            if type(orig_accessor) in [SingleRelatedObjectDescriptor,ReverseSingleRelatedObjectDescriptor]:
-                #print >>sys.stderr, '---------- replacing',name, orig_accessor
-                setattr(self.__class__, name, property(create_accessor_function_for_model(model, name)) )
-
-    def _get_inheritance_relation_fields_and_models(self):
-        """helper function for __init__:
-        determine names of all Django inheritance accessor member functions for type(self)"""
-
-        def add_model(model, as_ptr, result):
-            name = model.__name__.lower()
-            if as_ptr: name+='_ptr'
-            result[name] = model
-
-        def add_model_if_regular(model, as_ptr, result):
-            if ( issubclass(model, models.Model) and model != models.Model
-                and model != self.__class__
-                and model != PolymorphicModel ):
-                add_model(model,as_ptr,result)
-
-        def add_all_super_models(model, result):
-            add_model_if_regular(model, True, result)
-            for b in model.__bases__:
-                add_all_super_models(b, result)
-
-        def add_all_sub_models(model, result):
-            for b in model.__subclasses__():
-                add_model_if_regular(b, False, result)
-
-        result = {}
-        add_all_super_models(self.__class__,result)
-        add_all_sub_models(self.__class__,result)
-        return result
-
-        
\ No newline at end of file
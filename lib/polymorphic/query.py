@@ -5,17 +5,29 @@
 
 from compatibility_tools import defaultdict
 
+from django.db import connections
 from django.db.models.query import QuerySet
-from django.contrib.contenttypes.models import ContentType
 
 from query_translate import translate_polymorphic_filter_definitions_in_kwargs, translate_polymorphic_filter_definitions_in_args
 from query_translate import translate_polymorphic_field_path
+from query_strategies import SubclassJoin
+from registry import ctype_table
 
 # chunk-size: maximum number of objects requested per db-request
 # by the polymorphic queryset.iterator() implementation; we use the same chunk size as Django
 from django.db.models.query import CHUNK_SIZE               # this is 100 for Django 1.1/1.2
 Polymorphic_QuerySet_objects_per_request = CHUNK_SIZE
 
+# retrieval strategies for the real (derived) objects, see PolymorphicQuerySet.polymorphic_strategy():
+# 'chunked': one query per derived model per chunk (the default)
+# 'join':    one query per chunk, LEFT OUTER JOINing the tables of all derived models in the chunk
+# 'union':   one query per chunk, combining one select per derived model with UNION ALL
+Polymorphic_QuerySet_strategies = ('chunked', 'join', 'union')
+
+# default chunk size for the 'join' and 'union' strategies
+# (all ids of a chunk go into one query => stay below sqlite's limit of 999 query parameters)
+Polymorphic_QuerySet_objects_per_join_request = 500
+
 
 
 ###################################################################################
@@ -34,12 +46,18 @@ class PolymorphicQuerySet(QuerySet):
     def __init__(self, *args, **kwargs):
         "init our queryset object member variables"
         self.polymorphic_disabled = False
+        self.polymorphic_strategy_name = 'chunked'
+        self.polymorphic_chunk_size = None
+        # number of db queries the last evaluation of this queryset needed (None: not evaluated)
+        self.polymorphic_query_count = None
         super(PolymorphicQuerySet, self).__init__(*args, **kwargs)
 
     def _clone(self, *args, **kwargs):
         "Django's _clone only copies its own variables, so we need to copy ours here"
         new = super(PolymorphicQuerySet, self)._clone(*args, **kwargs)
         new.polymorphic_disabled = self.polymorphic_disabled
+        new.polymorphic_strategy_name = self.polymorphic_strategy_name
+        new.polymorphic_chunk_size = self.polymorphic_chunk_size
         return new
 
     def non_polymorphic(self, *args, **kwargs):
@@ -49,6 +67,42 @@ class PolymorphicQuerySet(QuerySet):
         self.polymorphic_disabled = True
         return self
 
+    def polymorphic_strategy(self, strategy, chunk_size=None):
+        """Choose how the real (derived) objects are retrieved for this query:
+        'chunked' (one query per derived model per chunk, the default), 'join'
+        or 'union' (one query per chunk for all derived models).
+        chunk_size is the number of objects resolved per chunk.
+        After evaluation, polymorphic_query_count holds the number of db queries used."""
+        assert strategy in Polymorphic_QuerySet_strategies, (
+            'PolymorphicModel: unknown polymorphic_strategy "%s"' % strategy )
+        new = self._clone()
+        new.polymorphic_strategy_name = strategy
+        new.polymorphic_chunk_size = chunk_size
+        return new
+
+    def _get_polymorphic_chunk_size(self):
+        if self.polymorphic_chunk_size: return self.polymorphic_chunk_size
+        if self._use_subclass_join(): return Polymorphic_QuerySet_objects_per_join_request
+        return Polymorphic_QuerySet_objects_per_request
+
+    def _use_subclass_join(self):
+        "select_related(), defer() and only() are only supported by the 'chunked' strategy"
+        return (self.polymorphic_strategy_name != 'chunked' and not self.query.select_related
+                and not self.query.deferred_loading[0])
+
+    def defer(self, *fields):
+        """the real class of the objects is always needed => polymorphic_ctype can't be deferred.
+        The deferred fields are deferred in the queries for the real objects as well."""
+        fields = [ f for f in fields if f not in ('polymorphic_ctype', 'polymorphic_ctype_id') ]
+        return super(PolymorphicQuerySet, self).defer(*fields)
+
+    def only(self, *fields):
+        """the real class of the objects is always needed => polymorphic_ctype is always loaded.
+        Only these fields are loaded in the queries for the real objects as well."""
+        if fields and fields != (None,) and not 'polymorphic_ctype' in fields:
+            fields = fields + ('polymorphic_ctype',)
+        return super(PolymorphicQuerySet, self).only(*fields)
+
     def instance_of(self, *args):
         """Filter the queryset to only include the classes in args (and their subclasses).
         Implementation in _translate_polymorphic_filter_defnition."""
@@ -91,6 +145,56 @@ class PolymorphicQuerySet(QuerySet):
         self.polymorphic_disabled = True
         return super(PolymorphicQuerySet, self).aggregate(*args, **kwargs)
 
+    def _polymorphic_values_rows(self, fields):
+        """Run the query for polymorphic_values() and polymorphic_values_list():
+        one select returning the columns of fields (ModelX___field paths allowed),
+        the tables of the sub models are LEFT OUTER JOINed. Returns the row iterator."""
+        assert fields, 'PolymorphicModel: polymorphic_values(): no fields given'
+        query = self.query.clone()
+        query.select_related = False
+        query.clear_deferred_loading()
+        query.clear_select_fields()
+        query.default_cols = False
+        query.set_extra_mask([])
+        query.set_aggregate_mask([])
+        # allow_m2m: the paths to the sub models follow the reverse one-to-one parent links,
+        # which vanilla values() refuses (there is at most one row per object, though)
+        query.add_fields([ translate_polymorphic_field_path(self.model, f) for f in fields ], True)
+        return query.get_compiler(self.db).results_iter()
+
+    def polymorphic_values(self, *fields):
+        """Like values(), but accepts ModelX___field paths (e.g. 'Model2C___field3').
+        Returns a list of dicts (keyed by the given field names), retrieved with a
+        single query; no objects are created. The field of a sub model is None
+        for the objects that are not instances of it."""
+        return [ dict(zip(fields, row)) for row in self._polymorphic_values_rows(fields) ]
+
+    def polymorphic_values_list(self, *fields, **kwargs):
+        """Like values_list(), but accepts ModelX___field paths, see polymorphic_values().
+        Returns a list of tuples (or of values, with flat=True and a single field)."""
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to polymorphic_values_list: %s' % (kwargs.keys(),))
+        if flat and len(fields) > 1:
+            raise TypeError("'flat' is not valid when polymorphic_values_list is called with more than one field.")
+        rows = self._polymorphic_values_rows(fields)
+        if flat: return [ row[0] for row in rows ]
+        return [ tuple(row) for row in rows ]
+
+    def explain(self):
+        """Return the query plan the database chooses for the base query of this
+        queryset, as a list of rows (EXPLAIN QUERY PLAN for sqlite, EXPLAIN otherwise).
+        Useful for comparing the plans of different filters, e.g. of instance_of()."""
+        connection = connections[self.db]
+        sql, params = self.query.get_compiler(self.db).as_sql()
+        if connection.settings_dict['ENGINE'].endswith('sqlite3'):
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            prefix = 'EXPLAIN '
+        cursor = connection.cursor()
+        cursor.execute(prefix + sql, params)
+        return cursor.fetchall()
+
     # Since django_polymorphic 'V1.0 beta2', extra() always returns polymorphic results.^
     # The resulting objects are required to have a unique primary key within the result set
     # (otherwise an error is thrown).
@@ -137,7 +241,8 @@ class PolymorphicQuerySet(QuerySet):
         # - also record the correct result order in "ordered_id_list"
         # - store objects that already have the correct class into "results"
         base_result_objects_by_id = {}
-        self_model_content_type_id = ContentType.objects.get_for_model(self.model).pk
+        self_model_content_type_id = ctype_table.id_for_model(self.model)
+        class_for_id = ctype_table.class_for_id
         for base_object in base_result_objects:
             ordered_id_list.append(base_object.pk)
 
@@ -154,7 +259,7 @@ class PolymorphicQuerySet(QuerySet):
             # this object is derived and its real instance needs to be retrieved
             # => store it's id into the bin for this model type
             else:
-                idlist_per_model[base_object.get_real_instance_class()].append(base_object.pk)
+                idlist_per_model[class_for_id(base_object.polymorphic_ctype_id)].append(base_object.pk)
 
         # django's automatic ".pk" field does not always work correctly for
         # custom fields in derived objects (unclear yet who to put the blame on).
@@ -169,24 +274,24 @@ class PolymorphicQuerySet(QuerySet):
         # from the db and store them in results[].
         # Then we copy the annotate fields from the base objects to the real objects.
         # Then we copy the extra() select fields from the base objects to the real objects.
-        # TODO: defer(), only(): support for these would be around here
+        # We also copy the defer() / only() configuration to the new querysets.
+        if self._use_subclass_join():
+            self._get_real_instances_joined(idlist_per_model, base_result_objects_by_id, results)
+
         for modelclass, idlist in idlist_per_model.items():
             qs = modelclass.base_objects.filter(pk__in=idlist) # use pk__in instead ####
             qs.dup_select_related(self)    # copy select related configuration to new qs
+            field_names, defer = self.query.deferred_loading
+            if field_names:
+                # the primary key of the base model is needed below
+                if defer: field_names = set(field_names) - set([pk_name])
+                else: field_names = set(field_names) | set([pk_name])
+                qs.query.deferred_loading = (set(field_names), defer)
+            self._count_polymorphic_query()
 
             for o in qs:
                 o_pk=getattr(o,pk_name)
-                
-                if self.query.aggregates:
-                    for anno_field_name in self.query.aggregates.keys():
-                        attr = getattr(base_result_objects_by_id[o_pk], anno_field_name)
-                        setattr(o, anno_field_name, attr)
-
-                if self.query.extra_select:
-                    for select_field_name in self.query.extra_select.keys():
-                        attr = getattr(base_result_objects_by_id[o_pk], select_field_name)
-                        setattr(o, select_field_name, attr)
-
+                self._copy_annotations(o, base_result_objects_by_id[o_pk])
                 results[o_pk] = o
 
         # re-create correct order and return result list
@@ -206,6 +311,45 @@ class PolymorphicQuerySet(QuerySet):
             
         return resultlist
 
+    def _get_real_instances_joined(self, idlist_per_model, base_result_objects_by_id, results):
+        """
+        Retrieve the objects in idlist_per_model with a single query (strategies 'join' and 'union').
+
+        The objects of all models derived from self.model are built from the rows and stored
+        into results; they are removed from idlist_per_model. Anything else (objects
+        whose real class is not derived from self.model) stays in idlist_per_model.
+        """
+        models = [ m for m in idlist_per_model.keys() if m is not self.model and issubclass(m, self.model) ]
+        if not models: return
+
+        join = SubclassJoin(self.model, models)
+        ids_per_model = dict([ (m, idlist_per_model.pop(m)) for m in models ])
+        rows = join.fetch_rows(ids_per_model, self.polymorphic_strategy_name, self.db)
+        self._count_polymorphic_query()
+
+        for modelclass, idlist in ids_per_model.items():
+            for o_pk in idlist:
+                if not o_pk in rows: continue   # deleted in the meantime
+                base_object = base_result_objects_by_id[o_pk]
+                o = join.build_instance(modelclass, base_object, rows[o_pk])
+                self._copy_annotations(o, base_object)
+                results[o_pk] = o
+
+    def _copy_annotations(self, o, base_object):
+        "copy the annotate fields and the extra() select fields from the base object to the real object"
+        if self.query.aggregates:
+            for anno_field_name in self.query.aggregates.keys():
+                attr = getattr(base_object, anno_field_name)
+                setattr(o, anno_field_name, attr)
+
+        if self.query.extra_select:
+            for select_field_name in self.query.extra_select.keys():
+                attr = getattr(base_object, select_field_name)
+                setattr(o, select_field_name, attr)
+
+    def _count_polymorphic_query(self):
+        self.polymorphic_query_count = (self.polymorphic_query_count or 0) + 1
+
     def iterator(self):
         """
         This function is used by Django for all object retrieval.
@@ -220,8 +364,11 @@ class PolymorphicQuerySet(QuerySet):
 
         but it requests the objects in chunks from the database,
         with Polymorphic_QuerySet_objects_per_request per chunk
+        (or the chunk size set with polymorphic_strategy()).
         """
         base_iter = super(PolymorphicQuerySet, self).iterator()
+        self.polymorphic_query_count = 1
+        chunk_size = self._get_polymorphic_chunk_size()
 
         # disabled => work just like a normal queryset
         if self.polymorphic_disabled:
@@ -232,7 +379,7 @@ class PolymorphicQuerySet(QuerySet):
             base_result_objects = []
             reached_end = False
 
-            for i in range(Polymorphic_QuerySet_objects_per_request):
+            for i in range(chunk_size):
                 try:
                     o=base_iter.next()
                     base_result_objects.append(o)
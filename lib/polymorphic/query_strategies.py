@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+""" Polymorphic object retrieval strategies
+    Please see README.rst or DOCS.rst or http://bserve.webhop.org/wiki/django_polymorphic
+"""
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from registry import ctype_table
+
+
+###################################################################################
+### SubclassJoin
+
+def _concrete_model(model):
+    "return the model that owns the db table of model (follows proxy models)"
+    while model._meta.proxy:
+        model = model._meta.proxy_for_model
+    return model
+
+
+class SubclassJoin(object):
+    """
+    Loads the subclass fields of objects that were retrieved as base_model
+    instances with a single sql query, instead of one query per subclass.
+
+    base_model is the model the objects were retrieved as, models is the list of
+    real classes (derived from base_model) that are to be built.
+    The base object already carries the values of all fields of base_model and its
+    parents, so only the tables of the models between base_model and each
+    real class are read:
+
+    'join':  one select over the base table, LEFT OUTER JOINed to all these tables
+    'union': one select per real class (INNER JOINs over its own tables only),
+             NULL padded to the same column layout and combined with UNION ALL
+    """
+
+    def __init__(self, base_model, models):
+        self.base_model = base_model
+        self.base_concrete = _concrete_model(base_model)
+        self.models = list(models)
+
+        # chain[realclass] = [ (model, parent_model, parent_ptr_field), ... ] , parents first
+        self.chain = {}
+        tables = []
+        for model in self.models:
+            chain = self._get_chain(_concrete_model(model))
+            self.chain[model] = chain
+            for link in chain:
+                if link not in tables: tables.append(link)
+
+        # parents must be joined before their children
+        tables.sort(key=lambda link: len(link[0]._meta.get_parent_list()))
+        self.tables = tables
+        self.aliases = dict([ (link[0], 'T%d' % (i + 1)) for i, link in enumerate(tables) ])
+
+        # column layout of the result rows: base pk first, then the local fields of all tables
+        self.columns = []
+        self.column_index = {}
+        for link in tables:
+            for field in link[0]._meta.local_fields:
+                self.column_index[(link[0], field.attname)] = len(self.columns) + 1
+                self.columns.append((link[0], field))
+
+    def _get_chain(self, model):
+        "the concrete models (and their parent links) between self.base_concrete (excluded) and model"
+        chain = []
+        while model is not self.base_concrete:
+            for parent, ptr in model._meta.parents.items():
+                if issubclass(parent, self.base_concrete):
+                    break
+            else:
+                raise AssertionError('PolymorphicModel: ' + model.__name__ +
+                    ' is not derived from ' + self.base_concrete.__name__)
+            parent = _concrete_model(parent)
+            chain.insert(0, (model, parent, ptr))
+            model = parent
+        return chain
+
+    def _alias(self, model):
+        if model is self.base_concrete: return 'T0'
+        return self.aliases[model]
+
+    def _from_clause(self, qn, tables, join):
+        base_opts = self.base_concrete._meta
+        sql = [ '%s T0' % qn(base_opts.db_table) ]
+        for model, parent, ptr in tables:
+            sql.append('%s %s %s ON (%s.%s = %s.%s)' % (
+                join, qn(model._meta.db_table), self._alias(model),
+                self._alias(model), qn(ptr.column),
+                self._alias(parent), qn(ptr.rel.get_related_field().column) ))
+        return ' '.join(sql)
+
+    def _null_column(self, field, connection):
+        """a NULL of the type of field: postgres types the untyped NULLs of the
+        first UNION arms as text, which the typed columns of a later arm don't match.
+        MySQL doesn't CAST to most column types, but doesn't need it either"""
+        db_type = field.db_type(connection=connection)
+        if not db_type or 'mysql' in connection.settings_dict['ENGINE']: return 'NULL'
+        return 'CAST(NULL AS %s)' % db_type
+
+    def _column_list(self, qn, tables=None, connection=None):
+        cols = [ 'T0.%s' % qn(self.base_concrete._meta.pk.column) ]
+        for model, field in self.columns:
+            if tables is None or model in tables:
+                cols.append('%s.%s' % (self._alias(model), qn(field.column)))
+            else:
+                cols.append(self._null_column(field, connection))
+        return ', '.join(cols)
+
+    def get_sql(self, ids_per_model, strategy='join', connection=None):
+        """returns (sql, params) of the query that loads the subclass columns for the
+        ids in ids_per_model (a dict realclass -> list of pks)"""
+        qn = connection.ops.quote_name
+        pk = self.base_concrete._meta.pk
+        prep = lambda idlist: [ pk.get_db_prep_value(i, connection=connection, prepared=False) for i in idlist ]
+        pk_col = 'T0.%s' % qn(self.base_concrete._meta.pk.column)
+
+        if strategy == 'join':
+            ids = []
+            for idlist in ids_per_model.values(): ids.extend(idlist)
+            sql = 'SELECT %s FROM %s WHERE %s IN (%s)' % (
+                self._column_list(qn),
+                self._from_clause(qn, self.tables, 'LEFT OUTER JOIN'),
+                pk_col, ', '.join(['%s'] * len(ids)) )
+            return sql, prep(ids)
+
+        if strategy == 'union':
+            arms = []
+            params = []
+            for model, idlist in ids_per_model.items():
+                if not idlist: continue
+                chain = self.chain[model]
+                arms.append('SELECT %s FROM %s WHERE %s IN (%s)' % (
+                    self._column_list(qn, [ link[0] for link in chain ], connection),
+                    self._from_clause(qn, chain, 'INNER JOIN'),
+                    pk_col, ', '.join(['%s'] * len(idlist)) ))
+                params.extend(prep(idlist))
+            return ' UNION ALL '.join(arms), params
+
+        raise ValueError('PolymorphicModel: unknown SubclassJoin strategy "%s"' % strategy)
+
+    def fetch_rows(self, ids_per_model, strategy='join', using=DEFAULT_DB_ALIAS):
+        "run the query, returns a dict pk -> row"
+        connection = connections[using]
+        sql, params = self.get_sql(ids_per_model, strategy, connection)
+        if not params: return {}
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        to_python = self.base_concrete._meta.pk.to_python
+        return dict([ (to_python(row[0]), row) for row in cursor.fetchall() ])
+
+    def fetch_objects(self, where, params, using=DEFAULT_DB_ALIAS):
+        """
+        Load complete objects of the real classes with a single query, without
+        retrieving base objects first.
+
+        where is an sql condition on the base table (alias T0), e.g. 'T0.parent_id IN (%s)'.
+        Only objects whose polymorphic_ctype is one of self.models are returned.
+        base_model must be the root of the inheritance tree (its table has all base fields).
+        """
+        assert not self.base_concrete._meta.parents, (
+            'PolymorphicModel: fetch_objects needs the root model as base model' )
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = self.base_concrete._meta
+        models_by_ctype = dict([ (ctype_table.id_for_model(m), m) for m in self.models ])
+        ctype_column = opts.get_field('polymorphic_ctype').column
+
+        sql = 'SELECT %s, %s FROM %s WHERE T0.%s IN (%s) AND (%s)' % (
+            ', '.join([ 'T0.%s' % qn(f.column) for f in opts.fields ]),
+            self._column_list(qn),
+            self._from_clause(qn, self.tables, 'LEFT OUTER JOIN'),
+            qn(ctype_column), ', '.join(['%s'] * len(models_by_ctype)), where )
+        cursor = connection.cursor()
+        cursor.execute(sql, models_by_ctype.keys() + list(params))
+
+        result = []
+        base_len = len(opts.fields)
+        for row in cursor.fetchall():
+            base_object = self.base_concrete(*row[:base_len])
+            base_object._state.db = using
+            model = models_by_ctype[base_object.polymorphic_ctype_id]
+            result.append(self.build_instance(model, base_object, row[base_len:]))
+        return result
+
+    def build_instance(self, model, base_object, row):
+        """create the model instance for base_object of the real class model,
+        taking the subclass field values from row"""
+        values = []
+        for field in model._meta.fields:
+            index = self.column_index.get((_concrete_model(field.model), field.attname))
+            if index is None:
+                values.append(getattr(base_object, field.attname))
+            else:
+                values.append(row[index])
+        obj = model(*values)
+        obj._state.db = base_object._state.db
+        return obj
@@ -4,9 +4,9 @@
 """
 
 from django.db import models
-from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
 from compatibility_tools import compat_partition
+from registry import subclass_registry, AmbiguousModelName
 
 
 ###################################################################################
@@ -126,57 +126,40 @@ def translate_polymorphic_field_path(queryset_model, field_path):
     if not sep: return field_path
     assert classname, 'PolymorphicModel: %s: bad field specification' % field_path
 
+    info = subclass_registry.get(queryset_model)
+    newpath = info.field_paths.get(field_path)
+    if newpath is not None: return newpath
+
     negated = False
     if classname[0] == '-':
         negated = True
         classname = classname.lstrip('-')
 
     if '__' in classname:
-        # the user has app label prepended to class name via __ => use Django's get_model function
+        # the user has app label prepended to class name via __
         appname, sep, classname = compat_partition(classname, '__')
-        model = models.get_model(appname, classname)
-        assert model, 'PolymorphicModel: model %s (in app %s) not found!' % (model.__name__, appname)
-        if not issubclass(model, queryset_model):
+        model = info.by_app_name.get((appname, classname.lower()))
+        if not model:
+            model = models.get_model(appname, classname)
+            assert model, 'PolymorphicModel: model %s (in app %s) not found!' % (classname, appname)
             e = 'PolymorphicModel: queryset filter error: "' + model.__name__ + '" is not derived from "' + queryset_model.__name__ + '"'
             raise AssertionError(e)
 
     else:
         # the user has only given us the class name via __
         # => select the model from the sub models of the queryset base model
-
-        # function to collect all sub-models, this should be optimized (cached)
-        def add_all_sub_models(model, result):
-            if issubclass(model, models.Model) and model != models.Model:
-                # model name is occurring twice in submodel inheritance tree => Error
-                if model.__name__ in result and model != result[model.__name__]:
-                    e = 'PolymorphicModel: model name alone is ambiguous: %s.%s and %s.%s!\n'
-                    e += 'In this case, please use the syntax: applabel__ModelName___field'
-                    assert model, e % (
-                        model._meta.app_label, model.__name__,
-                        result[model.__name__]._meta.app_label, result[model.__name__].__name__)
-
-                result[model.__name__] = model
-
-            for b in model.__subclasses__():
-                add_all_sub_models(b, result)
-
-        submodels = {}
-        add_all_sub_models(queryset_model, submodels)
-        model = submodels.get(classname, None)
+        model = info.by_name.get(classname, None)
         assert model, 'PolymorphicModel: model %s not found (not a subclass of %s)!' % (classname, queryset_model.__name__)
+        if isinstance(model, AmbiguousModelName):
+            # model name is occurring twice in submodel inheritance tree => Error
+            e = 'PolymorphicModel: model name alone is ambiguous: %s!\n' % ' and '.join([
+                '%s.%s' % (m._meta.app_label, m.__name__) for m in model.models ])
+            e += 'In this case, please use the syntax: applabel__ModelName___field'
+            raise AssertionError(e)
 
-    # create new field path for expressions, e.g. for baseclass=ModelA, myclass=ModelC
-    # 'modelb__modelc" is returned
-    def _create_base_path(baseclass, myclass):
-        bases = myclass.__bases__
-        for b in bases:
-            if b == baseclass:
-                return myclass.__name__.lower()
-            path = _create_base_path(baseclass, b)
-            if path: return path + '__' + myclass.__name__.lower()
-        return ''
-
-    basepath = _create_base_path(queryset_model, model)
+    # field path for expressions, e.g. for baseclass=ModelA, myclass=ModelC
+    # 'modelb__modelc" is used
+    basepath = info.base_paths[model]
 
     if negated: newpath = '-'
     else: newpath = ''
@@ -185,6 +168,7 @@ def translate_polymorphic_field_path(queryset_model, field_path):
     if basepath: newpath += '__'
 
     newpath += pure_field_path
+    info.field_paths[field_path] = newpath
     return newpath
 
 
@@ -195,10 +179,9 @@ def _create_model_filter_Q(modellist, not_instance_of=False):
     including all subclasses of these models (as we want to do the same
     as pythons isinstance() ).
     .
-    We recursively collect all __subclasses__(), create a Q filter for each,
-    and or-combine these Q objects. This could be done much more
-    efficiently however (regarding the resulting sql), should an optimization
-    be needed.
+    The ContentType ids of each model and its subclasses are taken from the
+    subclass registry, so the filter is a single polymorphic_ctype IN (...)
+    condition.
     """
 
     if not modellist: return None
@@ -211,15 +194,10 @@ def _create_model_filter_Q(modellist, not_instance_of=False):
         else:
             assert False, 'PolymorphicModel: instance_of expects a list of (polymorphic) models or a single (polymorphic) model'
 
-    def q_class_with_subclasses(model):
-        q = Q(polymorphic_ctype=ContentType.objects.get_for_model(model))
-        for subclass in model.__subclasses__():
-            q = q | q_class_with_subclasses(subclass)
-        return q
-
-    qlist = [  q_class_with_subclasses(m)  for m in modellist  ]
-
-    q_ored = reduce(lambda a, b: a | b, qlist)
-    if not_instance_of: q_ored = ~q_ored
-    return q_ored
+    ctype_ids = set()
+    for model in modellist:
+        ctype_ids.update(subclass_registry.get(model).get_ctype_ids())
 
+    q = Q(polymorphic_ctype__in=sorted(ctype_ids))
+    if not_instance_of: q = ~q
+    return q
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+""" Cached subclass registry, used for translating polymorphic field paths,
+    and the ContentType id <-> model class table used for type dispatch
+    Please see README.rst or DOCS.rst or http://bserve.webhop.org/wiki/django_polymorphic
+"""
+
+import time
+
+from django.db import models
+from django.db.models.signals import class_prepared, post_delete, post_syncdb
+from django.contrib.contenttypes.models import ContentType
+
+
+###################################################################################
+### SubclassRegistry
+
+class AmbiguousModelName(object):
+    "registry entry for a model name that is used by more than one sub model"
+    def __init__(self, *models):
+        self.models = list(models)
+
+
+def _create_base_path(baseclass, myclass):
+    """
+    create the field path from baseclass to myclass, e.g. for
+    baseclass=ModelA, myclass=ModelC 'modelb__modelc' is returned
+    (abstract models have no table, they are left out of the path)
+    """
+    name = myclass.__name__.lower()
+    if myclass._meta.abstract: name = ''
+    for b in myclass.__bases__:
+        if b == baseclass:
+            return name
+        if not issubclass(b, baseclass): continue
+        path = _create_base_path(baseclass, b)
+        if path and name: return path + '__' + name
+        return path or name
+    return ''
+
+
+def _is_registered_model(model):
+    """False for the classes that are not real models: abstract models (no table, no
+    ContentType), defer() / only() proxy classes and the left-overs of ModelBase when
+    it returns an already registered model"""
+    if model._meta.abstract: return False
+    if getattr(model, '_deferred', False): return False
+    return models.get_model(model._meta.app_label, model.__name__,
+                            seed_cache=False) is model
+
+
+class SubclassInfo(object):
+    """
+    Everything the polymorphic field path translation needs to know about
+    the sub models of one model:
+
+    submodels:     all sub models (including model itself), breadth first
+    by_name:       class name -> model (or AmbiguousModelName)
+    by_app_name:   (app_label, lowercase class name) -> model
+    base_paths:    model -> django field path from model to the sub model
+    field_paths:   cache of translated field paths
+    ctype_ids:     ids of the ContentTypes of the sub models (see get_ctype_ids)
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.submodels = []
+        self.by_name = {}
+        self.by_app_name = {}
+        self.base_paths = {}
+        self.field_paths = {}
+        self.ctype_ids = None
+
+        stack = [model]
+        while stack:
+            submodel = stack.pop(0)
+            if submodel in self.base_paths: continue
+            if issubclass(submodel, models.Model) and submodel != models.Model:
+                # the sub models of an abstract model are still searched
+                if not submodel._meta.abstract:
+                    if not _is_registered_model(submodel): continue
+                    self._add(submodel)
+            stack.extend(submodel.__subclasses__())
+
+    def get_ctype_ids(self):
+        """returns the sorted list of the ContentType ids of model and all its
+        sub models (what isinstance(obj, model) accepts), created on first use"""
+        if self.ctype_ids is None:
+            ids = set([ ctype_table.id_for_model(m) for m in self.submodels ])
+            self.ctype_ids = sorted(ids)
+        return self.ctype_ids
+
+    def _add(self, submodel):
+        self.submodels.append(submodel)
+        self.base_paths[submodel] = _create_base_path(self.model, submodel)
+        name = submodel.__name__
+        known = self.by_name.get(name)
+        if known is None:
+            self.by_name[name] = submodel
+        elif isinstance(known, AmbiguousModelName):
+            known.models.append(submodel)
+        else:
+            self.by_name[name] = AmbiguousModelName(known, submodel)
+        self.by_app_name[(submodel._meta.app_label, name.lower())] = submodel
+
+
+class SubclassRegistry(object):
+    """
+    Per model cache of SubclassInfo objects.
+
+    The entries are built on first use (when all models are loaded),
+    defining a new model class, running syncdb or deleting a ContentType
+    clears the registry.
+    """
+
+    def __init__(self):
+        self._infos = {}
+
+    def get(self, model):
+        "returns the SubclassInfo of model"
+        info = self._infos.get(model)
+        if info is None:
+            info = self._infos[model] = SubclassInfo(model)
+        return info
+
+    def clear(self):
+        self._infos.clear()
+
+
+subclass_registry = SubclassRegistry()
+
+
+###################################################################################
+### ContentTypeTable
+
+class ContentTypeTable(object):
+    """
+    In-process mapping of ContentType ids to model classes and back, used for
+    the polymorphic type dispatch instead of ContentType objects.
+
+    The table is loaded with a single query (all ContentTypes) on first use,
+    or explicitly at startup with warm(). The maps are never modified in place:
+    a model missing from the table (e.g. whose ContentType was created later)
+    is added to new copies of the maps.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.classes = None         # ContentType id -> model class
+        self.ids = None             # model class -> ContentType id
+        self.warm_seconds = None    # duration of the last warm()
+
+    def warm(self):
+        "load the ContentType ids of all models, returns the time it took in seconds"
+        start = time.time()
+        classes = {}
+        ids = {}
+        for ctype in ContentType.objects.all():
+            model = ctype.model_class()
+            if model is None: continue      # stale ContentType
+            classes[ctype.pk] = model
+            ids[model] = ctype.pk
+        self.classes, self.ids = classes, ids
+        self.warm_seconds = time.time() - start
+        return self.warm_seconds
+
+    def class_for_id(self, ctype_id):
+        "the model class of a ContentType id"
+        if self.classes is None: self.warm()
+        try:
+            return self.classes[ctype_id]
+        except KeyError:
+            model = ContentType.objects.get_for_id(ctype_id).model_class()
+            self._add(ctype_id, model)
+            return model
+
+    def id_for_model(self, model):
+        "the ContentType id of a model class (the one of the concrete model for proxy models)"
+        if self.ids is None: self.warm()
+        try:
+            return self.ids[model]
+        except KeyError:
+            concrete = model
+            while concrete._meta.proxy:
+                concrete = concrete._meta.proxy_for_model
+            ctype_id = self.ids.get(concrete)
+            if ctype_id is None:
+                ctype_id = ContentType.objects.get_for_model(concrete).pk
+            self._add(ctype_id, concrete, model)
+            return ctype_id
+
+    def _add(self, ctype_id, model, proxy_model=None):
+        classes = dict(self.classes)
+        classes[ctype_id] = model
+        ids = dict(self.ids)
+        ids[model] = ctype_id
+        if proxy_model is not None: ids[proxy_model] = ctype_id
+        self.classes, self.ids = classes, ids
+
+
+ctype_table = ContentTypeTable()
+
+
+def _clear_subclass_registry(sender, **kwargs):
+    if getattr(sender, '_deferred', False): return
+    subclass_registry.clear()
+
+def _clear_registries(sender, **kwargs):
+    subclass_registry.clear()
+    ctype_table.clear()
+
+class_prepared.connect(_clear_subclass_registry)
+post_syncdb.connect(_clear_registries)
+post_delete.connect(_clear_registries, sender=ContentType)
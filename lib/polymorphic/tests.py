@@ -11,12 +11,18 @@ from django import VERSION as django_VERSION
 from django.test import TestCase
 from django.db.models.query import QuerySet
 from django.db.models import Q,Count
-from django.db import models
+from django.db import models, connection
+from django.conf import settings as django_settings
+from django.db.models.signals import class_prepared
 from django.contrib.contenttypes.models import ContentType
 
 from polymorphic import PolymorphicModel, PolymorphicManager, PolymorphicQuerySet
 from polymorphic import ShowFieldContent, ShowFieldType, ShowFieldTypeAndContent, get_version
 from polymorphic import translate_polymorphic_Q_object
+from polymorphic.query_translate import translate_polymorphic_field_path
+from polymorphic.registry import subclass_registry, ctype_table
+from polymorphic.benchmarks import benchmark_filter, benchmark_class_attribute, benchmark_instantiation, benchmark_type_dispatch
+from polymorphic.base import PolymorphicModelBase, is_dumpdata_command
 
 class PlainA(models.Model):
     field1 = models.CharField(max_length=10)
@@ -164,6 +170,16 @@ class Middle(Top):
 class Bottom(Middle):
     author = models.CharField(max_length=50)
 
+# abstract model between two polymorphic models
+class AbstractMidBase(ShowFieldType, PolymorphicModel):
+    field1 = models.CharField(max_length=10)
+class AbstractMid(AbstractMidBase):
+    field2 = models.CharField(max_length=10)
+    class Meta:
+        abstract = True
+class AbstractMidLeaf(AbstractMid):
+    field3 = models.CharField(max_length=10)
+
 
 # UUID tests won't work with Django 1.1
 if not (django_VERSION[0] <= 1 and django_VERSION[1] <= 1):
@@ -201,6 +217,17 @@ class RelatedNameClash(ShowFieldType, PolymorphicModel):
 
 
 class testclass(TestCase):
+    def log_queries(self, func, *args, **kwargs):
+        "run func with DEBUG on, returns its result and the list of the sql queries it ran"
+        old_debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        connection.queries = []
+        try:
+            ret = func(*args, **kwargs)
+        finally:
+            django_settings.DEBUG = old_debug
+        return ret, [ q['sql'] for q in connection.queries ]
+
     def test_diamond_inheritance(self):
         # Django diamond problem
         o = DiamondXY.objects.create(field_b='b', field_x='x', field_y='y')
@@ -285,6 +312,242 @@ class testclass(TestCase):
         assert x == expected1 or x == expected2
 
 
+    def test_polymorphic_strategies(self):
+        Model2A.objects.create(field1='A1')
+        Model2B.objects.create(field1='B1', field2='B2')
+        Model2C.objects.create(field1='C1', field2='C2', field3='C3')
+        Model2D.objects.create(field1='D1', field2='D2', field3='D3', field4='D4')
+
+        expected = repr(list(Model2A.objects.order_by('id')))
+        for strategy in ('chunked', 'join', 'union'):
+            qs = Model2A.objects.order_by('id').polymorphic_strategy(strategy)
+            ol = list(qs)
+            assert repr(ol) == expected, strategy
+            assert [ (o.field1, getattr(o,'field2',None), getattr(o,'field3',None), getattr(o,'field4',None)) for o in ol ] == [
+                (u'A1', None, None, None), (u'B1', u'B2', None, None),
+                (u'C1', u'C2', u'C3', None), (u'D1', u'D2', u'D3', u'D4') ], strategy
+
+        # one query for the base objects, then one per derived model per chunk (chunked)
+        # or one per chunk (join, union)
+        qs = Model2A.objects.polymorphic_strategy('chunked')
+        assert qs.polymorphic_query_count == None
+        list(qs)
+        assert qs.polymorphic_query_count == 4
+        qs = Model2A.objects.polymorphic_strategy('chunked', chunk_size=2)
+        list(qs)
+        assert qs.polymorphic_query_count == 4
+        qs = Model2A.objects.polymorphic_strategy('join')
+        list(qs)
+        assert qs.polymorphic_query_count == 2
+        qs = Model2A.objects.polymorphic_strategy('union', chunk_size=2)
+        list(qs)
+        assert qs.polymorphic_query_count == 3
+        # the missing columns of an arm are typed NULLs
+        ol, queries = self.log_queries(lambda: list(Model2A.objects.polymorphic_strategy('union')))
+        assert 'CAST(NULL AS varchar(10))' in queries[-1] and 'UNION ALL' in queries[-1]
+
+        # querying a derived model, with annotations, and with filters on derived fields
+        ol = list(Model2B.objects.order_by('id').polymorphic_strategy('join'))
+        assert repr(ol) == repr(list(Model2B.objects.order_by('id')))
+        ol = list(Model2A.objects.extra(select={'extra':'field1'}).order_by('id').polymorphic_strategy('union'))
+        assert [ o.extra for o in ol ] == [ u'A1', u'B1', u'C1', u'D1' ]
+        o = Model2A.objects.polymorphic_strategy('join').get(Model2C___field3='C3')
+        assert type(o) == Model2C and o.field2 == 'C2' and o.field3 == 'C3'
+
+        # select_related is only supported by the chunked strategy
+        qs = Model2A.objects.select_related().polymorphic_strategy('join')
+        list(qs)
+        assert qs.polymorphic_query_count == 4
+
+    def test_polymorphic_strategies_custom_primary_key(self):
+        if not 'UUIDField' in globals(): return
+        a=UUIDProject.objects.create(topic="John's gathering")
+        b=UUIDArtProject.objects.create(topic="Sculpting with Tim", artist="T. Turner")
+        c=UUIDResearchProject.objects.create(topic="Swallow Aerodynamics", supervisor="Dr. Winter")
+        expected = repr(UUIDProject.objects.order_by('topic'))
+        for strategy in ('join', 'union'):
+            qs = UUIDProject.objects.order_by('topic').polymorphic_strategy(strategy)
+            ol = list(qs)
+            assert repr(PolymorphicQuerySet._p_list_class(ol)) == expected, strategy
+            assert qs.polymorphic_query_count == 2
+
+    def test_subclass_registry(self):
+        info = subclass_registry.get(Model2A)
+        assert info.submodels == [ Model2A, Model2B, ModelWithMyManager, Model2C, Model2D ]
+        assert info.base_paths[Model2D] == 'model2b__model2c__model2d'
+        assert info.by_name['Model2C'] is Model2C
+        assert info.by_app_name[('polymorphic', 'model2c')] is Model2C
+
+        # translations are cached per model and field path
+        assert translate_polymorphic_field_path(Model2A, '-Model2C___field3') == '-model2b__model2c__field3'
+        assert info.field_paths['-Model2C___field3'] == '-model2b__model2c__field3'
+        assert translate_polymorphic_field_path(Model2A, 'polymorphic__Model2D___field4') == 'model2b__model2c__model2d__field4'
+        assert translate_polymorphic_field_path(Model2B, 'Model2C___field3') == 'model2c__field3'
+        assert translate_polymorphic_field_path(Model2A, 'field1') == 'field1'
+
+        # defining a model clears the registry
+        class_prepared.send(sender=Model2D)
+        assert subclass_registry.get(Model2A) is not info
+
+        # abstract models have no table: left out of the sub models and field paths
+        info = subclass_registry.get(AbstractMidBase)
+        assert info.submodels == [ AbstractMidBase, AbstractMidLeaf ]
+        assert info.base_paths[AbstractMidLeaf] == 'abstractmidleaf'
+        assert len(info.get_ctype_ids()) == 2
+        AbstractMidLeaf.objects.create(field1='L1', field2='L2', field3='L3')
+        o = AbstractMidBase.objects.get(AbstractMidLeaf___field3='L3')
+        assert type(o) == AbstractMidLeaf and o.field2 == 'L2'
+        assert AbstractMidBase.objects.instance_of(AbstractMidLeaf).count() == 1
+
+        try:
+            translate_polymorphic_field_path(Model2B, 'ModelX___field')
+        except AssertionError, e:
+            assert 'not a subclass of Model2B' in str(e)
+        else:
+            assert False, 'ModelX is not a subclass of Model2B'
+        try:
+            translate_polymorphic_field_path(Model2B, 'polymorphic__ModelX___field')
+        except AssertionError, e:
+            assert 'is not derived from' in str(e)
+        else:
+            assert False, 'ModelX is not a subclass of Model2B'
+
+        timings = benchmark_filter(Model2A, 'Model2C___field3', 'C3', repeat=10)
+        assert timings['cached'] > 0 and timings['uncached'] > 0
+
+    def test_instance_of_ctype_ids(self):
+        ids = lambda *models: sorted([ ContentType.objects.get_for_model(m).pk for m in models ])
+        assert subclass_registry.get(Model2B).get_ctype_ids() == ids(Model2B, Model2C, Model2D)
+
+        # a single IN condition, whatever the number of subclasses
+        q = Model2A.translate_polymorphic_Q_object(Q(instance_of=Model2B)).children[0]
+        assert q.children == [ ('polymorphic_ctype__in', ids(Model2B, Model2C, Model2D)) ]
+        q = Model2A.translate_polymorphic_Q_object(Q(instance_of=[Model2C, ModelWithMyManager])).children[0]
+        assert q.children == [ ('polymorphic_ctype__in', ids(ModelWithMyManager, Model2C, Model2D)) ]
+        sql = str(Model2A.objects.not_instance_of(Model2C).query)
+        assert sql.count(' IN (') == 1 and not ' OR ' in sql and 'NOT' in sql
+
+        # the plan of the query can be inspected
+        plan = Model2A.objects.instance_of(Model2B).explain()
+        assert plan and type(plan) == list
+
+    def test_dump_mode(self):
+        Model2A.objects.create(field1='A1')
+        Model2B.objects.create(field1='B1', field2='B2')
+        assert not PolymorphicModelBase.polymorphic_dump_mode
+        assert isinstance(Model2A._default_manager, PolymorphicManager)
+        my_manager = ModelWithMyManager._default_manager
+        PolymorphicModelBase.set_dump_mode(True)
+        try:
+            assert Model2A._default_manager is Model2A.base_objects
+            assert ModelWithMyManager._default_manager is ModelWithMyManager.base_objects
+            assert [ type(o) for o in Model2A._default_manager.order_by('id') ] == [ Model2A, Model2A ]
+        finally:
+            PolymorphicModelBase.set_dump_mode(False)
+        assert isinstance(Model2A._default_manager, PolymorphicManager)
+        assert ModelWithMyManager._default_manager is my_manager
+        assert [ type(o) for o in Model2A._default_manager.order_by('id') ] == [ Model2A, Model2B ]
+
+        # switched on automatically wherever 'dumpdata' is on the command line
+        assert is_dumpdata_command(['manage.py', 'dumpdata', 'bakul'])
+        assert is_dumpdata_command(['django-admin.py', '--settings=settings', 'dumpdata'])
+        assert not is_dumpdata_command(['manage.py', 'loaddata', 'data.json'])
+        assert not is_dumpdata_command(['dumpdata'])
+
+        # class attribute reads are not intercepted anymore
+        assert not '__getattribute__' in PolymorphicModelBase.__dict__
+        timings = benchmark_class_attribute(Model2A, repeat=10)
+        assert timings['model'] > 0 and timings['plain'] > 0
+
+    def test_inheritance_accessors(self):
+        Model2D.objects.create(field1='D1', field2='D2', field3='D3', field4='D4')
+        # the accessors are replaced when the models are created, __init__ is Django's
+        assert type(Model2A.__dict__['model2b']) == property
+        assert type(Model2C.__dict__['model2b_ptr']) == property
+        assert type(Model2D.__dict__['model2c_ptr']) == property
+        assert not '__init__' in PolymorphicModel.__dict__
+
+        o = Model2A.base_objects.get(field1='D1')
+        def access():
+            b = o.model2b
+            assert type(b) == Model2B and b.field2 == 'D2'
+            assert o.model2b is b
+            assert type(b.model2c) == Model2C and type(b.model2a_ptr) == Model2A
+            assert b.model2c is b.model2c
+        ret, queries = self.log_queries(access)
+        assert len(queries) == 3
+
+        timings = benchmark_instantiation(Model2D, 10)
+        assert timings['total'] > 0 and timings['instance'] > 0
+
+    def test_ctype_table(self):
+        ctype_table.clear()
+        assert ctype_table.warm() >= 0
+        ctype = ContentType.objects.get_for_model(Model2C)
+        assert ctype_table.class_for_id(ctype.pk) is Model2C
+        assert ctype_table.id_for_model(Model2C) == ctype.pk
+
+        # type dispatch and saving don't need ContentType objects nor queries
+        Model2A.objects.create(field1='A1')
+        Model2C.objects.create(field1='C1', field2='C2', field3='C3')
+        def dispatch():
+            o = Model2A.base_objects.get(field1='C1')
+            assert o.get_real_instance_class() is Model2C
+            o.save()
+            assert [ type(o) for o in Model2A.objects.order_by('id') ] == [ Model2A, Model2C ]
+        ret, queries = self.log_queries(dispatch)
+        assert len(queries) == 5
+
+        # missing entries are added to the table
+        ctype_table.classes = {}
+        ctype_table.ids = {}
+        assert ctype_table.class_for_id(ctype.pk) is Model2C
+        assert ctype_table.id_for_model(Model2C) == ctype.pk
+        ctype_table.clear()
+
+        timings = benchmark_type_dispatch(Model2A, repeat=10)
+        assert timings['cold'] > 0 and timings['table'] > 0 and timings['contenttype'] > 0
+
+    def test_defer_and_only(self):
+        Model2A.objects.create(field1='A1')
+        Model2B.objects.create(field1='B1', field2='B2')
+        Model2C.objects.create(field1='C1', field2='C2', field3='C3')
+        ol, queries = self.log_queries(lambda: list(Model2A.objects.only('field1').order_by('id')))
+        sql = ' '.join(queries)
+        assert len(queries) == 3
+        assert not 'field2' in sql and not 'field3' in sql
+        assert [ (o.field1, isinstance(o, Model2B), isinstance(o, Model2C)) for o in ol ] == [
+            (u'A1', False, False), (u'B1', True, False), (u'C1', True, True) ]
+
+        ol, queries = self.log_queries(lambda: list(Model2B.objects.defer('field2').order_by('id').polymorphic_strategy('join')))
+        assert len(queries) == 2
+        assert not 'field2' in ' '.join(queries)
+        assert [ (o.field1, o.field3) for o in ol[1:] ] == [ (u'C1', u'C3') ]
+        # the deferred fields are loaded on access
+        assert ol[1].field2 == 'C2' and isinstance(ol[1], Model2C)
+        # polymorphic_ctype is never deferred
+        assert Model2A.objects.defer('polymorphic_ctype').query.deferred_loading[0] == set()
+        assert Model2A.objects.only('field1').query.deferred_loading[0] == set(['field1', 'polymorphic_ctype'])
+
+    def test_polymorphic_values(self):
+        Model2A.objects.create(field1='A1')
+        Model2B.objects.create(field1='B1', field2='B2')
+        Model2C.objects.create(field1='C1', field2='C2', field3='C3')
+        dl, queries = self.log_queries(
+            Model2A.objects.order_by('id').polymorphic_values, 'field1', 'Model2B___field2', 'Model2C___field3')
+        assert len(queries) == 1
+        assert 'LEFT OUTER JOIN' in queries[0]
+        assert dl == [
+            { 'field1': u'A1', 'Model2B___field2': None, 'Model2C___field3': None },
+            { 'field1': u'B1', 'Model2B___field2': u'B2', 'Model2C___field3': None },
+            { 'field1': u'C1', 'Model2B___field2': u'C2', 'Model2C___field3': u'C3' } ]
+        qs = Model2A.objects.filter(Model2B___field2__startswith='C')
+        assert qs.polymorphic_values_list('field1', 'Model2C___field3') == [ (u'C1', u'C3') ]
+        qs = Model2A.objects.order_by('-Model2B___field2')[:2]
+        assert qs.polymorphic_values_list('field1', flat=True) == [ u'C1', u'B1' ]
+        # extra() columns are left out
+        assert Model2A.objects.extra(select={ 'x': '1' }).filter(field1='A1').polymorphic_values_list('id') == [ (1,) ]
+
     def test_limit_choices_to(self):
         "this is not really a testcase, as limit_choices_to only affects the Django admin"
         # create a blog of type BlogA
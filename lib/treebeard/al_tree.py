@@ -1,9 +1,14 @@
 "Adjacency List"
 
-from django.core import serializers
+import time
+
+from django.core.management.color import no_style
 from django.db import models, transaction, connection
+from django.db.models import Max
+from django.db.models.fields import FieldDoesNotExist
 
 from treebeard.models import Node
+from treebeard.mp_tree import MP_PathEncoding
 from treebeard.exceptions import InvalidMoveToDescendant
 
 
@@ -20,17 +25,59 @@ class AL_NodeManager(models.Manager):
         return qset.order_by(*order_by)
 
 
-class AL_Node(Node):
-    "Abstract model to create your own Adjacency List Trees."
+class AL_BulkLoadResult(list):
+    """
+    The list of ids of the nodes added by :meth:`AL_Node.bulk_load`, with
+    the time it took (``seconds``) and its throughput (``nodes_per_second``).
+    """
+    seconds = 0.0
+    nodes_per_second = 0.0
+
+
+class AL_Node(MP_PathEncoding, Node):
+    """
+    Abstract model to create your own Adjacency List Trees.
+
+    If the model has a ``path`` field (a nullable, unique ``CharField``),
+    it's maintained as a materialized path of the tree (encoded as in
+    :class:`treebeard.mp_tree.MP_Node`) and used to answer depth, ancestor
+    and descendant queries with a single query. Nodes must change their
+    parent with :meth:`move` to keep it in sync, and an existing tree needs
+    a :meth:`rebuild_paths` when the field is added.
+
+    Likewise, if the model has a ``depth`` field (a nullable, indexed
+    ``PositiveIntegerField``), it's maintained with the depth of every
+    node: :meth:`get_depth` doesn't need any query and
+    :meth:`get_nodes_at_depth` is a single indexed query. A :meth:`move`
+    updates the depth of the whole branch with a single statement (per
+    batch of nodes without recursive queries or ``path``), and an existing
+    tree needs a :meth:`rebuild_depths` when the field is added.
+
+    With ``sib_order_spread`` set (only for trees without
+    ``node_order_by``), new siblings get ``sib_order`` values with up to
+    ``sib_order_spread`` free values between them, and a node inserted or
+    moved between two siblings takes a free value instead of shifting the
+    ``sib_order`` of all the following siblings. When there is none, only
+    the following siblings up to the next big enough gap are moved.
+    Repeated inserts at the same place use up the gaps around it, so a
+    bigger spread helps there. The neighbour siblings are looked up by
+    ``(parent, sib_order)``: with many siblings, add an index on these
+    columns (e.g. with a custom SQL file).
+    """
 
     objects = AL_NodeManager()
     node_order_by = None
+    sib_order_spread = 0
 
     @classmethod
     def add_root(cls, **kwargs):
         "Adds a root node to the tree."
         newobj = cls(**kwargs)
         newobj._cached_depth = 1
+        if cls._get_path_field():
+            newobj.path = cls._get_new_path(None)
+        if cls._get_depth_field():
+            newobj.depth = 1
 
         if not cls.node_order_by:
             try:
@@ -38,7 +85,7 @@ class AL_Node(Node):
                         'sib_order').reverse()[0].sib_order
             except IndexError:
                 max = 0
-            newobj.sib_order = max + 1
+            newobj.sib_order = max + 1 + cls.sib_order_spread
 
         # saving the instance before returning it
         newobj.save()
@@ -61,6 +108,9 @@ class AL_Node(Node):
         if self.parent_id is None:
             return 1
 
+        if self._get_node_depth():
+            return self.depth
+
         try:
             if update:
                 del self._cached_depth
@@ -69,6 +119,10 @@ class AL_Node(Node):
         except AttributeError:
             pass
 
+        if self._get_node_path():
+            self._cached_depth = len(self.path) / self.steplen
+            return self._cached_depth
+
         depth = 0
         node = self
         while node:
@@ -85,11 +139,45 @@ class AL_Node(Node):
         ":returns: the parent node of the current node object."
         return self.parent
 
+    @classmethod
+    def get_parents(cls, nodes):
+        """
+        :returns: A list with the parent node of every node in ``nodes``
+            (``None`` for root nodes and for nodes whose parent row is
+            missing), in the same order, with a single query per batch of
+            nodes. The parents are cached in the nodes, so
+            ``node.parent`` doesn't need a query.
+        """
+        nodes = list(nodes)
+        ids = sorted(set([node.parent_id for node in nodes
+                          if node.parent_id is not None]))
+        parents = {}
+        for pos in range(0, len(ids), cls.bulk_batch_size):
+            parents.update(cls.objects.in_bulk(
+                ids[pos:pos + cls.bulk_batch_size]))
+        cache_name = cls._meta.get_field('parent').get_cache_name()
+        ret = []
+        for node in nodes:
+            parent = parents.get(node.parent_id)
+            setattr(node, cache_name, parent)
+            ret.append(parent)
+        return ret
+
     def get_ancestors(self):
         """
         :returns: A *list* containing the current node object's ancestors,
             starting by the root node and descending to the parent.
         """
+        path = self._get_node_path()
+        if path:
+            if self.parent_id is None:
+                return []
+            # a single query for all the ancestors
+            paths = [path[0:pos]
+                     for pos in range(self.steplen, len(path), self.steplen)]
+            return list(self._get_path_manager().filter(
+                path__in=paths).order_by('path'))
+
         ancestors = []
         node = self.parent
         while node:
@@ -100,6 +188,9 @@ class AL_Node(Node):
 
     def get_root(self):
         ":returns: the root node for the current node object."
+        path = self._get_node_path()
+        if path and self.parent_id is not None:
+            return self._get_path_manager().get(path=path[0:self.steplen])
         ancestors = self.get_ancestors()
         if ancestors:
             return ancestors[0]
@@ -110,48 +201,64 @@ class AL_Node(Node):
         :returns: ``True`` if the node if a descendant of another node given
             as an argument, else, returns ``False``
         """
+        path, nodepath = self._get_node_path(), node._get_node_path()
+        if path and nodepath:
+            return len(path) > len(nodepath) and path.startswith(nodepath)
         return self.pk in [obj.pk for obj in node.get_descendants()]
 
     @classmethod
-    def dump_bulk(cls, parent=None, keep_ids=True):
-        "Dumps a tree branch to a python data structure."
+    def _dump_bulk_iter(cls, parent=None, keep_ids=True):
+        "Walks a tree branch as DFS for :meth:`dump_bulk`."
 
         serializable_cls = cls._get_serializable_model()
         if parent and serializable_cls != cls and \
                 parent.__class__ != serializable_cls:
             parent = serializable_cls.objects.get(pk=parent.pk)
 
-        # a list of nodes: not really a queryset, but it works
-        objs = serializable_cls.get_tree(parent)
-
-        ret, lnk = [], {}
-        for node, pyobj in zip(objs, serializers.serialize('python', objs)):
-            depth = node.get_depth()
-            # django's serializer stores the attributes in 'fields'
-            fields = pyobj['fields']
-            del fields['parent']
-
-            # non-sorted trees have this
-            if 'sib_order' in fields:
-                del fields['sib_order']
-
-            if 'id' in fields:
-                del fields['id']
-
-            newobj = {'data': fields}
-            if keep_ids:
-                newobj['id'] = pyobj['pk']
-
-            if (not parent and depth == 1) or \
-                    (parent and depth == parent.get_depth()):
-                ret.append(newobj)
-            else:
-                parentobj = lnk[node.parent_id]
-                if 'children' not in parentobj:
-                    parentobj['children'] = []
-                parentobj['children'].append(newobj)
-            lnk[node.id] = newobj
-        return ret
+        # only the pending siblings of the open branch are kept: when the
+        # walk reaches a node whose children weren't fetched yet, they're
+        # fetched along with the children of the nodes on top of the stack,
+        # a level per query, up to bulk_batch_size parents
+        if parent:
+            stack = [(parent, 1)]
+        else:
+            stack = [(node, 1) for node in serializable_cls.objects.filter(
+                parent__isnull=True)][::-1]
+        parent_cache = cls._meta.get_field('parent').get_cache_name()
+        children = {}
+        batch = []
+        while stack:
+            node, depth = stack.pop()
+            batch.append((node, depth))
+            if node.pk not in children:
+                parents = dict([(other.pk, other) for other, otherdepth
+                    in stack[max(0, len(stack) - cls.bulk_batch_size + 1):]
+                    if other.pk not in children])
+                parents[node.pk] = node
+                room = cls.bulk_batch_size
+                while parents:
+                    room -= len(parents)
+                    for pk in parents:
+                        children[pk] = []
+                    level = []
+                    for child in serializable_cls.objects.filter(
+                            parent__in=parents.keys()):
+                        # the serializer reads the parent object
+                        setattr(child, parent_cache, parents[child.parent_id])
+                        children[child.parent_id].append(child)
+                        level.append(child)
+                    # their children are fetched ahead while they fit
+                    parents = dict([(child.pk, child)
+                                    for child in level[:max(0, room)]])
+            stack.extend([(child, depth + 1)
+                          for child in children.pop(node.pk)[::-1]])
+            if not stack or len(batch) == cls.bulk_batch_size:
+                dumped = cls._dump_bulk_serialize(
+                    [node for node, depth in batch], keep_ids,
+                    ('parent', 'sib_order', 'path', 'depth'))
+                for (node, depth), newobj in zip(batch, dumped):
+                    yield depth, newobj
+                batch = []
 
     def add_child(self, **kwargs):
         "Adds a child to the node."
@@ -167,39 +274,414 @@ class AL_Node(Node):
                     )[0].sib_order
             except IndexError:
                 max = 0
-            newobj.sib_order = max + 1
+            newobj.sib_order = max + 1 + self.__class__.sib_order_spread
 
         # saving the instance before returning it
         newobj.parent = self
+        if self.__class__._get_path_field():
+            newobj.path = self.__class__._get_new_path(self)
+        if self.__class__._get_depth_field():
+            newobj.depth = self.get_depth() + 1
         newobj.save()
+        self.__dict__.pop('_cached_children', None)
         transaction.commit_unless_managed()
         return newobj
 
     @classmethod
-    def _get_tree_recur(cls, ret, parent, depth):
+    def bulk_load(cls, bulk_data, parent=None, keep_ids=False):
+        """
+        Loads a list/dictionary structure to the tree, like
+        :meth:`load_bulk`, but without calling ``add_child``/``save`` for
+        every node: ids, parents, sibling order (and paths) are assigned in
+        memory and the rows of every table are inserted with batched
+        ``executemany`` calls, all in the same transaction. No signals are
+        sent.
+
+        Every dictionary in the structure may have a ``model`` key (a model
+        class or an ``'app_label.ModelName'`` string) to create the node as
+        an instance of a model that inherits from the tree model.
+
+        .. note::
+
+           Unless ``keep_ids`` is used, ids are allocated after the current
+           maximum id, so no other process should add nodes at the same time.
+
+        :returns: An :class:`AL_BulkLoadResult`, the list of the added node
+            ids.
+        """
+        start = time.time()
+        parent_field = cls._meta.get_field('parent')
+        tree_model = parent_field.model
+        has_path = bool(cls._get_path_field())
+        has_depth = bool(cls._get_depth_field())
+        qn = connection.ops.quote_name
+
+        next_id = None
+        if not keep_ids:
+            next_id = tree_model._base_manager.aggregate(
+                last=Max('pk'))['last'] or 0
+
+        # sib_order and path of the next child, per parent
         if parent:
-            qset = cls.objects.filter(parent=parent)
+            siblings = cls.objects.filter(parent=parent)
         else:
-            qset = cls.get_root_nodes()
-        for node in qset:
-            node._cached_depth = depth
+            siblings = cls.objects.filter(parent__isnull=True)
+        next_child = {}
+        sib_order_step = cls.sib_order_spread + 1
+        if not cls.node_order_by:
+            next_child[None] = {'sib_order': (siblings.aggregate(
+                last=Max('sib_order'))['last'] or 0) + sib_order_step}
+        if has_path:
+            next_child.setdefault(None, {})['path'] = cls._get_new_path(parent)
+        first_depth = 1
+        if has_depth and parent:
+            first_depth = parent.get_depth() + 1
+
+        # rows[model] = list of tuples with the values of its local fields
+        rows = {}
+        added = AL_BulkLoadResult()
+        # tree, iterative preorder
+        stack = [(None, node) for node in bulk_data[::-1]]
+        while stack:
+            parent_obj, node_struct = stack.pop()
+            model = cls._get_bulk_model(node_struct.get('model'))
+            node_obj = model(**node_struct['data'])
+            if keep_ids:
+                pk = node_struct['id']
+            else:
+                next_id += 1
+                pk = next_id
+            chain = cls._get_bulk_chain(model)
+            for concrete in chain:
+                setattr(node_obj, concrete._meta.pk.attname, pk)
+
+            if parent_obj:
+                setattr(node_obj, parent_field.attname, parent_obj.pk)
+            elif parent:
+                setattr(node_obj, parent_field.attname, parent.pk)
+            nextval = next_child.get(parent_obj and parent_obj.pk, {})
+            if 'sib_order' in nextval:
+                node_obj.sib_order = nextval['sib_order']
+                nextval['sib_order'] += sib_order_step
+            if has_path:
+                node_obj.path = nextval['path']
+                if node_obj.path:
+                    nextval['path'] = cls._inc_path(node_obj.path)
+            if has_depth:
+                if parent_obj:
+                    node_obj.depth = parent_obj.depth + 1
+                else:
+                    node_obj.depth = first_depth
+            node_obj._prepare_bulk_insert()
+
+            for concrete in chain:
+                rows.setdefault(concrete, []).append(tuple([
+                    field.get_db_prep_save(field.pre_save(node_obj, True),
+                                           connection=connection)
+                    for field in concrete._meta.local_fields]))
+            added.append(pk)
+
+            children = node_struct.get('children')
+            if children:
+                nextval = {}
+                if not cls.node_order_by:
+                    nextval['sib_order'] = sib_order_step
+                if has_path:
+                    nextval['path'] = node_obj.path and cls._get_path(
+                        node_obj.path, len(node_obj.path) / cls.steplen + 1, 1)
+                next_child[pk] = nextval
+                # extending the stack with the current node as the parent of
+                # the new nodes
+                stack.extend([(node_obj, node) for node in children[::-1]])
+
+        try:
+            cursor = connection.cursor()
+            # parent tables first
+            for concrete in sorted(rows.keys(),
+                    key=lambda model: len(model._meta.get_parent_list())):
+                fields = concrete._meta.local_fields
+                sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                    qn(concrete._meta.db_table),
+                    ', '.join([qn(field.column) for field in fields]),
+                    ', '.join(['%s'] * len(fields)))
+                table_rows = rows[concrete]
+                for pos in range(0, len(table_rows), cls.bulk_batch_size):
+                    cursor.executemany(sql,
+                        table_rows[pos:pos + cls.bulk_batch_size])
+            # the ids were given explicitly, postgres needs its sequence fixed
+            for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                         [tree_model]):
+                cursor.execute(sql)
+        except:
+            transaction.rollback_unless_managed()
+            raise
+        transaction.commit_unless_managed()
+
+        if parent:
+            parent.__dict__.pop('_cached_children', None)
+        added.seconds = time.time() - start
+        if added.seconds:
+            added.nodes_per_second = len(added) / added.seconds
+        return added
+
+    @classmethod
+    def _get_bulk_model(cls, model):
+        """
+        :returns: The model class for a node of :meth:`bulk_load`, given as
+            a class or as an ``'app_label.ModelName'`` string.
+        """
+        if model is None:
+            return cls
+        if isinstance(model, basestring):
+            model = models.get_model(*model.split('.', 1))
+        if model is None or \
+                not issubclass(model, cls._meta.get_field('parent').model):
+            raise ValueError('Not a model of this tree: %r' % (model, ))
+        return model
+
+    @classmethod
+    def _get_bulk_chain(cls, model):
+        """
+        :returns: The list of models that own a table row of a ``model``
+            instance, parents first.
+        """
+        while model._meta.proxy:
+            model = model._meta.proxy_for_model
+        chain = list(model._meta.get_parent_list()) + [model]
+        chain.sort(key=lambda concrete: len(concrete._meta.get_parent_list()))
+        return chain
+
+    @classmethod
+    def _load_bulk_batch(cls, bulk_data, parent, keep_ids):
+        "The batches of :meth:`load_bulk_stream` go through :meth:`bulk_load`"
+        return cls.bulk_load(bulk_data, parent, keep_ids)
+
+    def _prepare_bulk_insert(self):
+        """
+        Called by :meth:`bulk_load` for every node before its values are
+        read, in place of the work ``save()`` would do.
+        """
+        pass
+
+    @classmethod
+    def _supports_recursive_cte(cls):
+        """
+        :returns: ``True`` if the database can fetch a whole branch with a
+            single ``WITH RECURSIVE`` query.
+        """
+        engine = cls.get_database_engine()
+        if engine in ('postgresql', 'postgresql_psycopg2'):
+            return True
+        if engine == 'sqlite3':
+            # common table expressions appeared in sqlite 3.8.3
+            from django.db.backends.sqlite3.base import Database
+            return Database.sqlite_version_info >= (3, 8, 3)
+        return False
+
+    @classmethod
+    def _get_subtree_sql(cls, parent, select='id', levels=None):
+        """
+        :returns: A ``WITH RECURSIVE`` query (and its params) that walks the
+            descendants of ``parent`` (or the whole tree), returning
+            ``select`` from the ``subtree(id, depth)`` relation. ``depth``
+            is relative: the first level of the branch has depth 1.
+        """
+        qn = connection.ops.quote_name
+        parent_field = cls._meta.get_field('parent')
+        tree_opts = parent_field.model._meta
+        joins = ''
+        if cls._meta.db_table != tree_opts.db_table:
+            # inherited model: the parent pointer lives in the ancestor's
+            # table, we only walk through the nodes that are of our class
+            joins = ' INNER JOIN %s AS c ON c.%s = t.%s' % (
+                qn(cls._meta.db_table), qn(cls._meta.pk.column),
+                qn(tree_opts.pk.column))
+        params = []
+        if parent:
+            anchor = 't.%s = %%s' % (qn(parent_field.column), )
+            params.append(parent.pk)
+        else:
+            anchor = 't.%s IS NULL' % (qn(parent_field.column), )
+        limit = ''
+        if levels is not None:
+            limit = ' WHERE s.depth < %s'
+        # the CTE is wrapped in a plain SELECT because pysqlite COMMITs
+        # before running any statement it doesn't recognize as a query
+        sql = 'SELECT %(select)s FROM (' \
+              'WITH RECURSIVE subtree(id, depth) AS (' \
+              ' SELECT t.%(pk)s, 1 FROM %(table)s AS t%(joins)s' \
+              '  WHERE %(anchor)s' \
+              ' UNION ALL' \
+              ' SELECT t.%(pk)s, s.depth + 1 FROM %(table)s AS t%(joins)s' \
+              '  INNER JOIN subtree AS s ON t.%(parent)s = s.id%(limit)s' \
+              ') SELECT id, depth FROM subtree) AS subtree' % {
+                  'table': qn(tree_opts.db_table),
+                  'pk': qn(tree_opts.pk.column),
+                  'parent': qn(parent_field.column),
+                  'joins': joins,
+                  'anchor': anchor,
+                  'limit': limit,
+                  'select': select}
+        if levels is not None:
+            params.append(levels)
+        return sql, params
+
+    @classmethod
+    def _get_subtree_cte(cls, parent, levels=None):
+        "Fetches all the nodes of a branch with a single query."
+        sql, params = cls._get_subtree_sql(parent, 'id', levels)
+        pkcol = '%s.%s' % (connection.ops.quote_name(cls._meta.db_table),
+                           connection.ops.quote_name(cls._meta.pk.column))
+        return list(cls.objects.extra(where=['%s IN (%s)' % (pkcol, sql)],
+                                      params=params))
+
+    @classmethod
+    def _get_subtree_bfs(cls, parent, levels=None):
+        """
+        Fetches all the nodes of a branch, level by level, with batched
+        ``parent IN (...)`` queries. Used when the database doesn't support
+        recursive queries.
+        """
+        ret = []
+        if parent:
+            ids = [parent.pk]
+            level = []
+        else:
+            level = list(cls.get_root_nodes())
+            ret.extend(level)
+            ids = [node.pk for node in level]
+            if levels is not None:
+                levels -= 1
+        while ids and (levels is None or levels > 0):
+            level = []
+            for pos in range(0, len(ids), cls.bulk_batch_size):
+                level.extend(cls.objects.filter(
+                    parent__in=ids[pos:pos + cls.bulk_batch_size]))
+            ret.extend(level)
+            ids = [node.pk for node in level]
+            if levels is not None:
+                levels -= 1
+        return ret
+
+    @classmethod
+    def _get_subtree_ids(cls, parent):
+        """
+        :returns: A list of ``(id, parent id)`` tuples of the descendants of
+            ``parent`` (or of the whole tree), in sibling order.
+        """
+        qn = connection.ops.quote_name
+        if (parent and parent._get_node_path()) or \
+                (not parent and cls._get_path_field()):
+            qset = cls.objects.all()
+            if parent:
+                qset = qset.filter(path__startswith=parent.path).exclude(
+                    pk=parent.pk)
+            return list(qset.values_list('pk', 'parent'))
+        if cls._supports_recursive_cte():
+            sql, params = cls._get_subtree_sql(parent)
+            pkcol = '%s.%s' % (qn(cls._meta.db_table), qn(cls._meta.pk.column))
+            return list(cls.objects.extra(
+                where=['%s IN (%s)' % (pkcol, sql)],
+                params=params).values_list('pk', 'parent'))
+        ret = []
+        if parent:
+            level = cls.objects.filter(parent=parent.pk)
+        else:
+            level = cls.objects.filter(parent__isnull=True)
+        level = list(level.values_list('pk', 'parent'))
+        while level:
+            ret.extend(level)
+            ids = [pk for pk, parent_id in level]
+            level = []
+            for pos in range(0, len(ids), cls.bulk_batch_size):
+                level.extend(cls.objects.filter(
+                    parent__in=ids[pos:pos + cls.bulk_batch_size]
+                ).values_list('pk', 'parent'))
+        return ret
+
+    @classmethod
+    def _stitch_subtree(cls, parent, nodes, depth):
+        """
+        Orders a flat list of nodes of a branch as DFS, linking every node
+        with its parent and children objects and caching its depth on the way,
+        so walking the result won't hit the database again.
+
+        :returns: A list of nodes ordered as DFS, including the parent.
+        """
+        parent_cache = cls._meta.get_field('parent').get_cache_name()
+        children = {}
+        for node in nodes:
+            children.setdefault(node.parent_id, []).append(node)
+        if parent:
+            ret = [parent]
+            parent._cached_children = children.get(parent.pk, [])
+            stack = [(parent, node) for node in parent._cached_children[::-1]]
+        else:
+            ret = []
+            stack = [(None, node) for node in children.get(None, [])[::-1]]
+        while stack:
+            nodeparent, node = stack.pop()
+            if nodeparent is None:
+                node._cached_depth = depth
+            else:
+                node._cached_depth = nodeparent._cached_depth + 1
+                setattr(node, parent_cache, nodeparent)
+            node._cached_children = children.get(node.pk, [])
             ret.append(node)
-            cls._get_tree_recur(ret, node, depth + 1)
+            stack.extend([(node, child)
+                          for child in node._cached_children[::-1]])
+        return ret
 
     @classmethod
-    def get_tree(cls, parent=None):
+    def get_tree(cls, parent=None, levels=None):
         """
         :returns: A list of nodes ordered as DFS, including the parent. If
                   no parent is given, the entire tree is returned.
+
+        The branch is fetched in a constant number of queries (a single one
+        if the database supports recursive queries) and every returned node
+        has its parent, children and depth already cached.
+
+        :param levels: If given, only returns the nodes that are at most
+            this number of levels below ``parent`` (or below the root level).
         """
         if parent:
             depth = parent.get_depth() + 1
-            ret = [parent]
+            parent._cached_depth = depth - 1
         else:
             depth = 1
-            ret = []
-        cls._get_tree_recur(ret, parent, depth)
-        return ret
+            if levels is not None:
+                levels += 1
+        if levels is not None and levels < 1:
+            nodes = []
+        elif not parent and cls._get_depth_field():
+            nodes = cls._get_subtree_depth(levels)
+        elif (parent and parent._get_node_path()) or \
+                (not parent and cls._get_path_field()):
+            nodes = cls._get_subtree_path(parent, levels)
+        elif cls._supports_recursive_cte():
+            nodes = cls._get_subtree_cte(parent, levels)
+        else:
+            nodes = cls._get_subtree_bfs(parent, levels)
+        return cls._stitch_subtree(parent, nodes, depth)
+
+    @classmethod
+    def get_nodes_at_depth(cls, depth):
+        """
+        :returns: The nodes at the given depth (1 for the root nodes). A
+            queryset if the model has a ``depth`` or ``path`` field, else a
+            *list*.
+        """
+        if cls._get_depth_field():
+            return cls.objects.filter(depth=depth)
+        if cls._get_path_field():
+            field = cls._get_path_field()
+            return cls.objects.extra(where=['LENGTH(%s.%s) = %%s' % (
+                connection.ops.quote_name(field.model._meta.db_table),
+                connection.ops.quote_name(field.column))],
+                params=[depth * cls.steplen])
+        return [node for node in cls.get_tree(levels=depth - 1)
+                if node.get_depth() == depth]
 
     def get_descendants(self):
         """
@@ -210,8 +692,24 @@ class AL_Node(Node):
 
     def get_descendant_count(self):
         ":returns: the number of descendants of a nodee"
+        cls = self.__class__
+        if self._get_node_path():
+            return cls.objects.filter(path__startswith=self.path).count() - 1
+        if cls._supports_recursive_cte():
+            sql, params = cls._get_subtree_sql(self, 'COUNT(1)')
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
         return len(self.get_descendants())
 
+    def get_children_count(self):
+        ":returns: The number of the node's children"
+        try:
+            # the node was loaded by get_tree
+            return len(self._cached_children)
+        except AttributeError:
+            return super(AL_Node, self).get_children_count()
+
     def get_siblings(self):
         """
         :returns: A queryset of all the node's siblings, including the node
@@ -238,6 +736,12 @@ class AL_Node(Node):
         if self.parent_id:
             newobj.parent_id = self.parent_id
 
+        if self.__class__._get_path_field():
+            newobj.path = self.__class__._get_new_path(
+                self.parent_id and self.parent or None)
+        if self.__class__._get_depth_field():
+            newobj.depth = self.get_depth()
+
         cursor = connection.cursor()
         for sql, vals in stmts:
             cursor.execute(sql, vals)
@@ -254,6 +758,15 @@ class AL_Node(Node):
         sorted trees)
         """
 
+        if cls.sib_order_spread:
+            prev_sib_order, next_sib_order = {
+                'first-sibling': (0, None),
+                'left': (None, target.sib_order),
+                'right': (target.sib_order, None),
+                'last-sibling': (None, None)}[pos]
+            return cls._get_new_sib_order(target.parent_id, prev_sib_order,
+                                          next_sib_order, stmts)
+
         sib_order = target.sib_order
         if pos == 'last-sibling' \
                 or (pos == 'right' and target == target.get_last_sibling()):
@@ -287,6 +800,91 @@ class AL_Node(Node):
                 stmts.append((sql, params))
         return sib_order
 
+    @classmethod
+    def _get_renumber_siblings_sql(cls, parent_id, moves):
+        """
+        Changes the sib_order of the (old, new) moves of the children of
+        ``parent_id`` in a single statement, the moves must be sorted, and be
+        all the siblings between the first and the last old sib_order.
+        """
+        qn = connection.ops.quote_name
+        sql = 'UPDATE %(table)s ' \
+              ' SET sib_order = CASE sib_order %(whens)s ELSE sib_order END ' \
+              ' WHERE sib_order BETWEEN %(first)d AND %(last)d' \
+              ' AND ' % {
+                  'table': qn(cls._meta.db_table),
+                  'whens': ' '.join(['WHEN %d THEN %d' % move
+                                     for move in moves]),
+                  'first': moves[0][0],
+                  'last': moves[-1][0]}
+        parent_column = qn(cls._meta.get_field('parent').column)
+        if parent_id is None:
+            return sql + parent_column + ' IS NULL', []
+        return sql + parent_column + '=%s', [parent_id]
+
+    @classmethod
+    def _get_new_sib_order(cls, parent_id, prev_sib_order, next_sib_order,
+                           stmts):
+        """
+        With ``sib_order_spread``, finds a free sib_order for a new child of
+        ``parent_id`` (a new root node if ``None``) between the siblings with
+        prev_sib_order and next_sib_order (``None`` values are looked up,
+        without both the new node is the last one). When there is none, the
+        statements that spread the siblings from next_sib_order on are added
+        to ``stmts``, up to the first sibling that leaves at least
+        ``(sib_order_spread + 1) // 2`` free values per moved sibling.
+
+        :returns: the sib_order
+        """
+        if parent_id is None:
+            siblings = cls.objects.filter(parent__isnull=True)
+        else:
+            siblings = cls.objects.filter(parent=parent_id)
+        sib_orders = siblings.values_list('sib_order', flat=True)
+        if prev_sib_order is None:
+            prev_sib_order = 0
+            before = sib_orders
+            if next_sib_order is not None:
+                before = sib_orders.filter(sib_order__lt=next_sib_order)
+            for prev_sib_order in before.order_by('-sib_order')[:1]:
+                pass
+        elif next_sib_order is None:
+            for next_sib_order in sib_orders.filter(
+                    sib_order__gt=prev_sib_order).order_by('sib_order')[:1]:
+                pass
+        if next_sib_order is None:
+            return prev_sib_order + 1 + cls.sib_order_spread
+        if next_sib_order - prev_sib_order < 2:
+            # the following siblings are read until the gap, in chunks
+            density = (cls.sib_order_spread + 1) // 2 + 1
+            run = []
+            end = None
+            for sib_order in sib_orders.filter(
+                    sib_order__gte=next_sib_order).order_by(
+                        'sib_order').distinct().iterator():
+                if sib_order - prev_sib_order > (len(run) + 1) * density:
+                    end = sib_order
+                    break
+                run.append(sib_order)
+            if end is None:
+                # the last siblings
+                moves = [(sib_order, prev_sib_order +
+                          (pos + 1) * (cls.sib_order_spread + 1))
+                         for pos, sib_order in enumerate(run)]
+            else:
+                # leaving room for the new node first
+                moves = [(sib_order, prev_sib_order + (pos + 2) *
+                          (end - prev_sib_order) // (len(run) + 2))
+                         for pos, sib_order in enumerate(run)]
+            # the new values are greater than (or equal to) the old ones:
+            # renumbering the batches starting by the last one never merges
+            # two siblings
+            for pos in reversed(range(0, len(moves), cls.bulk_batch_size)):
+                stmts.append(cls._get_renumber_siblings_sql(parent_id,
+                    moves[pos:pos + cls.bulk_batch_size]))
+            next_sib_order = moves[0][1]
+        return (prev_sib_order + next_sib_order) // 2
+
     def move(self, target, pos=None):
         """
         Moves the current node and all it's descendants to a new position
@@ -298,6 +896,7 @@ class AL_Node(Node):
         stmts = []
         sib_order = None
         parent = None
+        old_parent_id = self.parent_id
 
         if pos in ('first-child', 'last-child', 'sorted-child'):
             # moving to a child
@@ -312,7 +911,7 @@ class AL_Node(Node):
                     pos = 'sorted-sibling'
                 else:
                     pos = 'first-sibling'
-                    sib_order = 1
+                    sib_order = 1 + self.sib_order_spread
 
         if target.is_descendant_of(self):
             raise InvalidMoveToDescendant("Can't move node to a descendant.")
@@ -343,14 +942,238 @@ class AL_Node(Node):
             else:
                 self.parent = target.parent
 
+        if self._get_node_depth() and self.parent_id != old_parent_id:
+            # the node changed parent: the branch may change level
+            if self.parent_id is None:
+                depth = 1
+            else:
+                depth = self.parent.get_depth() + 1
+            if depth != self.depth:
+                stmts.extend(self._get_sql_depth_in_branch(depth - self.depth))
+                self.depth = depth
+            self.__dict__.pop('_cached_depth', None)
+
+        if self._get_node_path() and self.parent_id != old_parent_id:
+            # the node changed parent: the branch gets a new path prefix
+            newpath = self.__class__._get_new_path(self.parent)
+            stmts.append(self.__class__._get_sql_newpath_in_branch(self.path,
+                                                                   newpath))
+            self.path = newpath
+            self.__dict__.pop('_cached_depth', None)
+
         if stmts:
             cursor = connection.cursor()
             for sql, vals in stmts:
                 cursor.execute(sql, vals)
 
+        # the children lists cached by get_tree are stale now
+        for node in (self, target, parent):
+            if node is not None:
+                node.__dict__.pop('_cached_children', None)
+
         self.save()
         transaction.commit_unless_managed()
 
+    def save(self, *args, **kwargs):
+        # nodes that weren't created with add_root/add_child/add_sibling
+        if self._get_path_field() and not self.path:
+            self.path = self.__class__._get_new_path(
+                self.parent_id and self.parent or None)
+        if self._get_depth_field() and not self.depth:
+            if self.parent_id is None:
+                self.depth = 1
+            else:
+                self.depth = self.parent.get_depth() + 1
+        super(AL_Node, self).save(*args, **kwargs)
+
+    @classmethod
+    def _get_depth_field(cls):
+        ":returns: The optional ``depth`` field of the model, or ``None``"
+        try:
+            return cls._meta.get_field('depth')
+        except FieldDoesNotExist:
+            return None
+
+    def _get_node_depth(self):
+        """
+        :returns: The stored depth of the node, or ``None`` if the model has
+            no ``depth`` field or the depth wasn't set yet.
+        """
+        if self._get_depth_field():
+            return self.depth
+        return None
+
+    def _get_sql_depth_in_branch(self, delta):
+        """
+        :returns: The list of statements that add ``delta`` to the depth of
+            all the descendants of the node.
+        """
+        qn = connection.ops.quote_name
+        tree_model = self._meta.get_field('parent').model
+        field = self._get_depth_field()
+        sql = 'UPDATE %(table)s SET %(depth)s=%(depth)s+%%s WHERE ' % {
+            'table': qn(field.model._meta.db_table),
+            'depth': qn(field.column)}
+        pkcol = qn(field.model._meta.pk.column)
+        if self._get_node_path():
+            # paths longer than the node's one
+            return [(sql + '%s LIKE %%s' % (
+                qn(self._get_path_field().column), ),
+                [delta, self.path + '_%'])]
+        if tree_model._supports_recursive_cte():
+            # all the descendants, whatever their class
+            subtree, params = tree_model._get_subtree_sql(self)
+            return [(sql + '%s IN (%s)' % (pkcol, subtree),
+                     [delta] + params)]
+        ids = [pk for pk, parent_id in tree_model._get_subtree_ids(self)]
+        return [(sql + '%s IN (%s)' % (
+                    pkcol, ', '.join(['%s'] * len(batch))), [delta] + batch)
+                for batch in [ids[pos:pos + self.bulk_batch_size]
+                              for pos in range(0, len(ids),
+                                               self.bulk_batch_size)]]
+
+    @classmethod
+    def _get_subtree_depth(cls, levels=None):
+        "Fetches all the nodes of the tree, up to a depth, with a single query."
+        qset = cls.objects.all()
+        if levels is not None:
+            qset = qset.filter(depth__lte=levels)
+        return list(qset)
+
+    @classmethod
+    def rebuild_depths(cls):
+        """
+        Rebuilds the ``depth`` of every node in the tree from the ``parent``
+        pointers. Needed after adding a ``depth`` field to an existing tree,
+        or if nodes changed their parent without using :meth:`move`.
+        """
+        model = cls._get_depth_field().model
+        children = {}
+        for pk, parent_id in model._base_manager.values_list('pk', 'parent'):
+            children.setdefault(parent_id, []).append(pk)
+        qn = connection.ops.quote_name
+        sql = 'UPDATE %s SET %s=%%s WHERE %s IN (%%s)' % (
+            qn(model._meta.db_table), qn(cls._get_depth_field().column),
+            qn(model._meta.pk.column))
+        cursor = connection.cursor()
+        depth = 1
+        level = children.get(None, [])
+        while level:
+            # a single statement per batch of nodes of the same level
+            for pos in range(0, len(level), cls.bulk_batch_size):
+                batch = level[pos:pos + cls.bulk_batch_size]
+                cursor.execute(sql % ('%s', ', '.join(['%s'] * len(batch))),
+                               [depth] + batch)
+            level = [pk for parent_id in level
+                     for pk in children.get(parent_id, [])]
+            depth += 1
+        transaction.commit_unless_managed()
+
+    @classmethod
+    def _get_path_field(cls):
+        ":returns: The optional ``path`` field of the model, or ``None``"
+        try:
+            return cls._meta.get_field('path')
+        except FieldDoesNotExist:
+            return None
+
+    def _get_node_path(self):
+        """
+        :returns: The materialized path of the node, or ``None`` if the model
+            has no ``path`` field or the path wasn't built yet.
+        """
+        if self._get_path_field():
+            return self.path
+        return None
+
+    @classmethod
+    def _get_path_manager(cls):
+        """
+        :returns: The default manager of the model that owns the ``path``
+            field (and the whole tree) when using inheritance.
+        """
+        return cls._get_path_field().model._default_manager
+
+    @classmethod
+    def _get_new_path(cls, parent):
+        """
+        :returns: The path for a new last child of ``parent`` (a new root
+            node if ``parent`` is ``None``), or ``None`` if the parent has no
+            path yet.
+
+        The steps of the path only reflect the insertion order, the order of
+        the siblings is still given by ``sib_order``/``node_order_by``.
+        """
+        siblings = cls._get_path_field().model._base_manager
+        if parent:
+            if not parent.path:
+                return None
+            siblings = siblings.filter(parent=parent.pk)
+            parentpath = parent.path
+        else:
+            siblings = siblings.filter(parent__isnull=True)
+            parentpath = ''
+        last = siblings.aggregate(last=Max('path'))['last']
+        if last:
+            return cls._inc_path(last)
+        return cls._get_path(parentpath,
+                             len(parentpath) / cls.steplen + 1, 1)
+
+    @classmethod
+    def _get_sql_newpath_in_branch(cls, oldpath, newpath):
+        ":returns: The sql needed to move a branch to another path."
+        sql = 'UPDATE %s SET path=%s WHERE path LIKE %%s' % (
+            connection.ops.quote_name(
+                cls._get_path_field().model._meta.db_table),
+            cls._get_sql_path_concat())
+        return sql, [newpath, len(oldpath) + 1, oldpath + '%']
+
+    @classmethod
+    def _get_subtree_path(cls, parent, levels=None):
+        "Fetches all the nodes of a branch with a single path prefix query."
+        qset = cls.objects.all()
+        basepath = ''
+        if parent:
+            basepath = parent.path
+            qset = qset.filter(path__startswith=basepath)
+        if levels is not None:
+            field = cls._get_path_field()
+            qset = qset.extra(where=['LENGTH(%s.%s) <= %%s' % (
+                connection.ops.quote_name(field.model._meta.db_table),
+                connection.ops.quote_name(field.column))],
+                params=[len(basepath) + levels * cls.steplen])
+        return [node for node in qset if not parent or node.pk != parent.pk]
+
+    @classmethod
+    def rebuild_paths(cls):
+        """
+        Rebuilds the ``path`` of every node in the tree from the ``parent``
+        pointers. Needed after adding a ``path`` field to an existing tree,
+        or if nodes changed their parent without using :meth:`move`.
+        """
+        model = cls._get_path_field().model
+        children = {}
+        for pk, parent_id in model._base_manager.order_by('pk').values_list(
+                'pk', 'parent'):
+            children.setdefault(parent_id, []).append(pk)
+        vals = []
+        stack = [(None, '')]
+        while stack:
+            parent_id, parentpath = stack.pop()
+            depth = len(parentpath) / cls.steplen + 1
+            for step, pk in enumerate(children.get(parent_id, [])):
+                path = cls._get_path(parentpath, depth, step + 1)
+                vals.append((path, pk))
+                stack.append((pk, path))
+
+        table = connection.ops.quote_name(model._meta.db_table)
+        cursor = connection.cursor()
+        # the paths are unique, clear them all before writing the new ones
+        cursor.execute('UPDATE %s SET path=NULL' % (table, ))
+        cursor.executemany('UPDATE %s SET path=%%s WHERE %s=%%s' % (
+            table, connection.ops.quote_name(model._meta.pk.column)), vals)
+        transaction.commit_unless_managed()
+
     class Meta:
         "Abstract model."
         abstract = True
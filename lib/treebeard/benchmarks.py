@@ -0,0 +1,252 @@
+"""
+Benchmarks for the bulk tree operations.
+
+Usage (e.g. from manage.py shell)::
+
+    from treebeard.benchmarks import benchmark_ns_delete, benchmark_mp_fix_tree
+    print benchmark_ns_delete(NS_TestNode, fields={'desc': 'x'})
+    print benchmark_ns_add_child(NS_TestNode, fields={'desc': 'x'})
+    print benchmark_ns_insert_root(NS_TestNode, fields={'desc': 'x'})
+    print benchmark_al_insert_sibling(AL_TestNode, fields={'desc': 'x'})
+    print benchmark_mp_fix_tree(MP_TestNode, fields={'desc': 'x'})
+
+The benchmarks empty the table of the given model first.
+"""
+
+import time
+
+from django.db import connection, transaction
+
+
+def _insert_rows(model, columns, rows):
+    "inserts the rows with executemany, in batches of model.bulk_batch_size"
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join([qn(model._meta.get_field(col).column) for col in columns]),
+        ', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    for pos in range(0, len(rows), model.bulk_batch_size):
+        cursor.executemany(sql, rows[pos:pos + model.bulk_batch_size])
+    transaction.commit_unless_managed()
+
+
+def build_ns_forest(model, trees=100, children=111, leaves=8, fields=None,
+                    spread=0, tree_id_spread=0):
+    """
+    Replaces the content of the table of model (a NS_Node subclass) with
+    ``trees`` trees, every root has ``children`` children with ``leaves``
+    children each (100 trees of 1000 nodes by default).
+
+    :param fields: dictionary of values for the other required fields
+    :param spread: the free values between two consecutive lft/rgt values
+        (for a model with ``node_spread``)
+    :param tree_id_spread: the free tree_ids between two consecutive trees
+
+    :returns: the number of nodes
+    """
+    model.objects.all().delete()
+    fields = fields or {}
+    columns = ['tree_id', 'lft', 'rgt', 'depth'] + fields.keys()
+    extra = tuple(fields.values())
+
+    def row(tree_id, lft, rgt, depth):
+        return (tree_id * (tree_id_spread + 1), 1 + (lft - 1) * (spread + 1),
+                1 + (rgt - 1) * (spread + 1), depth) + extra
+
+    rows = []
+    for tree_id in range(1, trees + 1):
+        rows.append(row(tree_id, 1, 2 * (1 + children * (leaves + 1)), 1))
+        lft = 2
+        for child in range(children):
+            rows.append(row(tree_id, lft, lft + 2 * leaves + 1, 2))
+            for leaf in range(leaves):
+                rows.append(row(tree_id, lft + 1 + 2 * leaf,
+                                lft + 2 + 2 * leaf, 3))
+            lft += 2 * (leaves + 1)
+    _insert_rows(model, columns, rows)
+    return len(rows)
+
+
+def benchmark_ns_delete(model, subtrees=1000, trees=100, children=111,
+                        leaves=8, fields=None):
+    """
+    Measures deleting about ``subtrees`` scattered subtrees (every n-th child
+    of every root, with its leaves) from a forest built by
+    :func:`build_ns_forest` (100k nodes by default) with a single
+    ``queryset.delete()``.
+
+    :returns: a dictionary with the number of nodes before ('nodes') and
+        after ('left') the delete, the number of deleted subtrees
+        ('subtrees') and the time of the delete in seconds ('seconds')
+    """
+    nodes = build_ns_forest(model, trees, children, leaves, fields)
+    step = max(1, (trees * children) // subtrees)
+    # the lft of the n-th child of a root is 2 + n * 2 * (leaves + 1)
+    qset = model.objects.filter(depth=2).extra(
+        where=['(lft - 2) %% %d = 0' % (step * 2 * (leaves + 1))])
+    count = qset.count()
+    start = time.time()
+    qset.delete()
+    seconds = time.time() - start
+    return {'nodes': nodes, 'left': model.objects.count(),
+            'subtrees': count, 'seconds': seconds}
+
+
+def benchmark_ns_add_child(model, inserts=1000, spread=8, trees=10,
+                           children=1111, leaves=8, fields=None):
+    """
+    Measures ``inserts`` calls of ``add_child`` on scattered nodes of a
+    forest built by :func:`build_ns_forest` (100k nodes in trees of 10k by
+    default), with the consecutive numbering and with a ``node_spread`` of
+    ``spread`` (the class attribute of model is restored afterwards).
+
+    :returns: a dictionary with the number of nodes ('nodes') and, for
+        'consecutive' and 'spread', the time of the inserts in seconds
+        ('seconds') and their throughput ('nodes_per_second')
+    """
+    result = {}
+    old_spread = model.node_spread
+    try:
+        for name, node_spread in (('consecutive', 0), ('spread', spread)):
+            model.node_spread = node_spread
+            result['nodes'] = build_ns_forest(model, trees, children, leaves,
+                                              fields, node_spread)
+            # the depth 2 nodes of all the trees, in turns
+            ids = list(model.objects.filter(depth=2).order_by(
+                'lft', 'tree_id').values_list('id', flat=True))
+            step = max(1, len(ids) // inserts)
+            ids = (ids[::step] * inserts)[:inserts]
+            start = time.time()
+            for pk in ids:
+                model.objects.get(pk=pk).add_child(**(fields or {}))
+            seconds = time.time() - start
+            result[name] = {'seconds': seconds,
+                            'nodes_per_second': inserts / seconds}
+    finally:
+        model.node_spread = old_spread
+    return result
+
+
+def benchmark_ns_insert_root(model, inserts=1000, spread=8, trees=50000,
+                             children=1, leaves=0, fields=None):
+    """
+    Measures ``inserts`` calls of ``add_sibling('left')`` (what ``add_root``
+    does with ``node_order_by``) on scattered roots of a forest built by
+    :func:`build_ns_forest` (100k nodes in trees of 2 by default), with
+    consecutive tree_ids and with a ``tree_id_spread`` of ``spread`` (the
+    class attribute of model is restored afterwards).
+
+    :returns: a dictionary with the number of nodes ('nodes') and, for
+        'consecutive' and 'spread', the time of the inserts in seconds
+        ('seconds') and their throughput ('nodes_per_second')
+    """
+    result = {}
+    old_spread = model.tree_id_spread
+    try:
+        for name, tree_id_spread in (('consecutive', 0), ('spread', spread)):
+            model.tree_id_spread = tree_id_spread
+            result['nodes'] = build_ns_forest(model, trees, children, leaves,
+                                              fields,
+                                              tree_id_spread=tree_id_spread)
+            ids = list(model.get_root_nodes().values_list('id', flat=True))
+            step = max(1, len(ids) // inserts)
+            ids = (ids[::step] * inserts)[:inserts]
+            start = time.time()
+            for pk in ids:
+                model.objects.get(pk=pk).add_sibling('left', **(fields or {}))
+            seconds = time.time() - start
+            result[name] = {'seconds': seconds,
+                            'nodes_per_second': inserts / seconds}
+    finally:
+        model.tree_id_spread = old_spread
+    return result
+
+
+def benchmark_al_insert_sibling(model, inserts=1000, spread=8,
+                                siblings=50000, fields=None):
+    """
+    Measures ``inserts`` calls of ``add_sibling('left')`` on scattered
+    children of a root node with ``siblings`` children (a model without
+    ``node_order_by``), with consecutive sib_orders and with a
+    ``sib_order_spread`` of ``spread`` (the class attribute of model is
+    restored afterwards). The spread inserts only pay off with an index on
+    the ``(parent, sib_order)`` columns.
+
+    :returns: a dictionary with the number of nodes ('nodes') and, for
+        'consecutive' and 'spread', the time of the inserts in seconds
+        ('seconds') and their throughput ('nodes_per_second')
+    """
+    result = {}
+    fields = fields or {}
+    old_spread = model.sib_order_spread
+    try:
+        for name, sib_order_spread in (('consecutive', 0), ('spread', spread)):
+            model.sib_order_spread = sib_order_spread
+            model.objects.all().delete()
+            root = model.add_root(**fields)
+            model.bulk_load([{'data': fields}] * siblings, root)
+            result['nodes'] = siblings + 1
+            ids = list(root.get_children().values_list('id', flat=True))
+            step = max(1, len(ids) // inserts)
+            ids = (ids[::step] * inserts)[:inserts]
+            start = time.time()
+            for pk in ids:
+                model.objects.get(pk=pk).add_sibling('left', **fields)
+            seconds = time.time() - start
+            result[name] = {'seconds': seconds,
+                            'nodes_per_second': inserts / seconds}
+    finally:
+        model.sib_order_spread = old_spread
+    return result
+
+
+def build_mp_forest(model, trees=100, children=111, leaves=8, fields=None,
+                    numchild=None):
+    """
+    Replaces the content of the table of model (a MP_Node subclass) with
+    the same forest as :func:`build_ns_forest`.
+
+    :param numchild: if given, the (wrong) numchild value of every node
+
+    :returns: the number of nodes
+    """
+    model.objects.all().delete()
+    fields = fields or {}
+    columns = ['path', 'depth', 'numchild'] + fields.keys()
+    extra = tuple(fields.values())
+
+    def row(parentpath, depth, step, count):
+        if numchild is not None:
+            count = numchild
+        path = model._get_path(parentpath, depth, step)
+        return (path, depth, count) + extra
+
+    rows = []
+    for tree in range(1, trees + 1):
+        rows.append(row(None, 1, tree, children))
+        rootpath = rows[-1][0]
+        for child in range(1, children + 1):
+            rows.append(row(rootpath, 2, child, leaves))
+            childpath = rows[-1][0]
+            for leaf in range(1, leaves + 1):
+                rows.append(row(childpath, 3, leaf, 0))
+    _insert_rows(model, columns, rows)
+    return len(rows)
+
+
+def benchmark_mp_fix_tree(model, trees=100, children=111, leaves=8,
+                          fields=None):
+    """
+    Measures the non destructive ``fix_tree`` of a forest built by
+    :func:`build_mp_forest` (100k nodes by default) where every node has a
+    wrong ``numchild`` value.
+
+    :returns: the dictionary returned by ``fix_tree`` (rows fixed and
+        seconds) with the number of nodes ('nodes')
+    """
+    nodes = build_mp_forest(model, trees, children, leaves, fields,
+                            numchild=1)
+    result = model.fix_tree()
+    result['nodes'] = nodes
+    return result
@@ -3,9 +3,13 @@
 import operator
 
 from django import VERSION as DJANGO_VERSION
-from django.db.models import Q
+from django.db.models import Q, signals
 from django.db import models, transaction
+from django.dispatch.dispatcher import _make_id
 from django.conf import settings
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
 
 from treebeard.exceptions import InvalidPosition, MissingNodeOrderBy
 
@@ -13,6 +17,10 @@ from treebeard.exceptions import InvalidPosition, MissingNodeOrderBy
 class Node(models.Model):
     "Node class"
 
+    # maximum number of values that bulk operations send to the database in
+    # a single statement (sqlite refuses more than 999 query parameters)
+    bulk_batch_size = 500
+
     @classmethod
     def add_root(cls, **kwargs):  # pragma: no cover
         """
@@ -87,7 +95,92 @@ class Node(models.Model):
         return added
 
     @classmethod
-    def dump_bulk(cls, parent=None, keep_ids=True):  # pragma: no cover
+    def load_bulk_stream(cls, fileobj, parent=None, keep_ids=False):
+        """
+        Loads a tree from a file object written by :meth:`dump_bulk_stream`
+        with ``format='jsonl'``, reading ``bulk_batch_size`` nodes at a time
+        and loading every batch with :meth:`_load_bulk_batch`.
+
+        :param fileobj: The file object to read.
+        :param parent: As in :meth:`load_bulk`
+        :param keep_ids: As in :meth:`load_bulk`
+
+        :returns: The number of added nodes.
+        """
+        added = 0
+        # the ids of the nodes of the current branch, by depth
+        branch = []
+        batch = []
+        for line in fileobj:
+            line = line.strip()
+            if not line:
+                continue
+            batch.append(simplejson.loads(line))
+            if len(batch) == cls.bulk_batch_size:
+                added += cls._load_bulk_stream_batch(batch, branch, parent,
+                                                     keep_ids)
+                batch = []
+        if batch:
+            added += cls._load_bulk_stream_batch(batch, branch, parent,
+                                                 keep_ids)
+        transaction.commit_unless_managed()
+        return added
+
+    @classmethod
+    def _load_bulk_stream_batch(cls, batch, branch, parent, keep_ids):
+        """
+        Loads a batch of json lines for :meth:`load_bulk_stream`, with one
+        :meth:`_load_bulk_batch` call per run of nodes that hang from the
+        same node of the branch left open by the previous batches.
+
+        :param branch: The ids of the open branch, by depth. It's updated.
+        :returns: The number of added nodes.
+        """
+        # (depth of the parent, structure, depths of its nodes in preorder)
+        runs = []
+        # the dumped objects of the current branch in this batch, by depth
+        stack = []
+        for node_struct in batch:
+            depth = node_struct['depth']
+            # the keys of the json objects are unicode strings
+            newobj = {'data': dict([(str(key), val) for key, val
+                                    in node_struct['data'].items()])}
+            if keep_ids:
+                newobj['id'] = node_struct['id']
+            while stack and stack[-1][0] >= depth:
+                stack.pop()
+            if stack:
+                stack[-1][1].setdefault('children', []).append(newobj)
+            elif runs and runs[-1][0] == depth - 1:
+                runs[-1][1].append(newobj)
+            else:
+                runs.append((depth - 1, [newobj], []))
+            runs[-1][2].append(depth)
+            stack.append((depth, newobj))
+
+        for parent_depth, bulk_data, depths in runs:
+            if parent_depth:
+                run_parent = cls.objects.get(pk=branch[parent_depth - 1])
+            else:
+                run_parent = parent
+            added = cls._load_bulk_batch(bulk_data, run_parent, keep_ids)
+            for depth, pk in zip(depths, added):
+                del branch[depth - 1:]
+                branch.append(pk)
+        return len(batch)
+
+    @classmethod
+    def _load_bulk_batch(cls, bulk_data, parent, keep_ids):
+        """
+        Loads a batch of :meth:`load_bulk_stream`, a structure as in
+        :meth:`load_bulk`.
+
+        :returns: The ids of the added nodes, in preorder.
+        """
+        return cls.load_bulk(bulk_data, parent, keep_ids)
+
+    @classmethod
+    def dump_bulk(cls, parent=None, keep_ids=True):
         """
         Dumps a tree branch to a python data structure.
 
@@ -104,8 +197,100 @@ class Node(models.Model):
         :returns: A python data structure, describen with detail in
                   :meth:`load_bulk`
         """
+        ret = []
+        # the dumped objects of the current branch, by depth
+        stack = []
+        for depth, newobj in cls._dump_bulk_iter(parent, keep_ids):
+            del stack[depth - 1:]
+            if stack:
+                stack[-1].setdefault('children', []).append(newobj)
+            else:
+                ret.append(newobj)
+            stack.append(newobj)
+        return ret
+
+    @classmethod
+    def dump_bulk_stream(cls, fileobj, parent=None, keep_ids=True,
+                         format='json'):
+        """
+        Dumps a tree branch to a file object, writing one node at a time, so
+        big trees can be exported with bounded memory.
+
+        :param fileobj: The file object to write.
+        :param parent: As in :meth:`dump_bulk`
+        :param keep_ids: As in :meth:`dump_bulk`
+        :param format:
+
+            - ``json``: the structure of :meth:`dump_bulk`, as nested json
+            - ``jsonl``: json lines, one object per node in DFS order, with
+              its ``data``, ``id`` and ``depth`` (relative to the first
+              level), as read by :meth:`load_bulk_stream`
+
+        :returns: The number of dumped nodes.
+        """
+        if format not in ('json', 'jsonl'):
+            raise ValueError('Unknown dump format: %s' % (format, ))
+        encoder = DjangoJSONEncoder()
+        dumped = 0
+        lastdepth = 0
+        for depth, newobj in cls._dump_bulk_iter(parent, keep_ids):
+            dumped += 1
+            if format == 'jsonl':
+                newobj['depth'] = depth
+                fileobj.write(encoder.encode(newobj) + '\n')
+                continue
+            if not lastdepth:
+                fileobj.write('[')
+            elif depth > lastdepth:
+                fileobj.write(', "children": [')
+            else:
+                # closing the previous node and the finished branches
+                fileobj.write('}' + ']}' * (lastdepth - depth) + ', ')
+            # the object is left open in case the next node is a child
+            fileobj.write(encoder.encode(newobj)[:-1])
+            lastdepth = depth
+        if format == 'json':
+            if lastdepth:
+                fileobj.write('}' + ']}' * (lastdepth - 1) + ']')
+            else:
+                fileobj.write('[]')
+        return dumped
+
+    @classmethod
+    def _dump_bulk_iter(cls, parent=None, keep_ids=True):  # pragma: no cover
+        """
+        Walks a tree branch as DFS for :meth:`dump_bulk`, fetching the nodes
+        in batches.
+
+        :returns: An iterator of ``(depth, dumped object)`` tuples, where
+            depth is relative (the first level of the dump has depth 1) and
+            the dumped object is a ``{'data': ..., 'id': ...}`` dictionary.
+        """
         raise NotImplementedError
 
+    @classmethod
+    def _dump_bulk_serialize(cls, nodes, keep_ids, exclude):
+        """
+        Serializes a batch of nodes for :meth:`_dump_bulk_iter`.
+
+        :param exclude: names of the fields that are internal to the tree
+        :returns: A list of ``{'data': ..., 'id': ...}`` dictionaries.
+        """
+        ret = []
+        for pyobj in serializers.serialize('python', nodes):
+            # django's serializer stores the attributes in 'fields'
+            fields = pyobj['fields']
+            for name in exclude:
+                fields.pop(name, None)
+            if 'id' in fields:
+                # this happens immediately after a load_bulk
+                del fields['id']
+            newobj = {'data': fields}
+            if keep_ids:
+                newobj['id'] = pyobj['pk']
+            ret.append(newobj)
+        return ret
+
     @classmethod
     def get_root_nodes(cls):  # pragma: no cover
         ":returns: A queryset containing the root nodes in the tree."
@@ -374,6 +559,25 @@ class Node(models.Model):
         """
         raise NotImplementedError
 
+    @classmethod
+    def get_parents(cls, nodes):
+        """
+        :returns: A list with the parent node of every node in ``nodes``
+            (``None`` for root nodes and for nodes whose parent row is
+            missing), in the same order. The parents are cached in the nodes
+            like :meth:`get_parent` does.
+        """
+
+        # this is the last resort, subclasses of Node should implement this in
+        # a efficient way.
+        ret = []
+        for node in nodes:
+            try:
+                ret.append(node.get_parent(True))
+            except cls.DoesNotExist:
+                ret.append(None)
+        return ret
+
     def move(self, target, pos=None):  # pragma: no cover
         """
         Moves the current node and all it's descendants to a new position
@@ -539,6 +743,31 @@ class Node(models.Model):
                 cls = cls._meta.proxy_for_model
         return cls
 
+    @classmethod
+    def _has_delete_dependencies(cls):
+        """
+        :returns: ``False`` if the nodes can be removed with plain DELETE
+            statements: no other model refers to this model and nobody listens
+            to the pre_delete/post_delete signals of its instances. Otherwise
+            the default django delete is needed (one query per removed node
+            and related model).
+        """
+        model = cls._get_serializable_model()
+        opts = model._meta
+        if (opts.get_all_related_objects() or opts.many_to_many or
+                opts.get_all_related_many_to_many_objects()):
+            return True
+        # receivers connected for any sender or for one of our models,
+        # ``signal.receivers`` is a list of ((receiver id, sender id),
+        # receiver) tuples (django 1.0 to 1.2). Receivers that were garbage
+        # collected still count: the per-node delete is always safe.
+        senders = set([_make_id(None), _make_id(cls), _make_id(model)])
+        for signal in (signals.pre_delete, signals.post_delete):
+            for (receiver_id, sender_id), receiver in signal.receivers:
+                if sender_id in senders:
+                    return True
+        return False
+
     @classmethod
     def get_database_engine(cls):
         """
@@ -1,16 +1,115 @@
 "Materialized Path Trees"
 
-import operator
+import time
 from numconv import NumConv
 
-from django.core import serializers
 from django.db import models, transaction, connection
-from django.db.models import Q
 
 from treebeard.models import Node
 from treebeard.exceptions import InvalidMoveToDescendant, PathOverflow
 
 
+class MP_PathEncoding(object):
+    """
+    Path encoding used by Materialized Path trees: a path is a string made of
+    one fixed length step (of :attr:`steplen` chars from :attr:`alphabet`)
+    per level. Also used by :class:`treebeard.al_tree.AL_Node` models that
+    have a ``path`` field.
+    """
+
+    steplen = 4
+    alphabet = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+    numconv_obj_ = None
+
+    @classmethod
+    def _int2str(cls, num):
+        return cls.numconv_obj().int2str(num)
+
+    @classmethod
+    def _str2int(cls, num):
+        return cls.numconv_obj().str2int(num)
+
+    @classmethod
+    def numconv_obj(cls):
+        if cls.numconv_obj_ is None:
+            cls.numconv_obj_ = NumConv(len(cls.alphabet), cls.alphabet)
+        return cls.numconv_obj_
+
+    @classmethod
+    def _get_basepath(cls, path, depth):
+        ":returns: The base path of another path up to a given depth"
+        if path:
+            return path[0:(depth) * cls.steplen]
+        return ''
+
+    @classmethod
+    def _get_path(cls, path, depth, newstep):
+        """
+        Builds a path given some values
+
+        :param path: the base path
+        :param depth: the depth of the  node
+        :param newstep: the value (integer) of the new step
+        """
+        parentpath = cls._get_basepath(path, depth - 1)
+        key = cls._int2str(newstep)
+        return '%s%s%s' % (parentpath,
+                           '0' * (cls.steplen - len(key)),
+                           key)
+
+    @classmethod
+    def _inc_path(cls, path):
+        ":returns: The path of the next sibling of a given node path."
+        newpos = cls._str2int(path[-cls.steplen:]) + 1
+        key = cls._int2str(newpos)
+        if len(key) > cls.steplen:
+            raise PathOverflow("Path Overflow from: '%s'" % (path, ))
+        return '%s%s%s' % (path[:-cls.steplen],
+                           '0' * (cls.steplen - len(key)),
+                           key)
+
+    @classmethod
+    def _get_lastpos_in_path(cls, path):
+        ":returns: The integer value of the last step in a path."
+        return cls._str2int(path[-cls.steplen:])
+
+    @classmethod
+    def _get_parent_path_from_path(cls, path):
+        ":returns: The parent path for a given path"
+        if path:
+            return path[0:len(path) - cls.steplen]
+        return ''
+
+    @classmethod
+    def _get_children_path_interval(cls, path):
+        ":returns: An interval of all possible children paths for a node."
+        return (path + cls.alphabet[0] * cls.steplen,
+                path + cls.alphabet[-1] * cls.steplen)
+
+    @classmethod
+    def _get_sql_path_concat(cls):
+        """
+        :returns: An sql expression (with two params: the new path prefix and
+            the length of the old one plus one) that replaces the prefix of
+            the ``path`` column.
+        """
+        if cls.get_database_engine() == 'sqlite3':
+            # I know that the third argument in SUBSTR (LENGTH(path)) is
+            # awful, but sqlite fails without it:
+            # OperationalError: wrong number of arguments to function substr()
+            # even when the documentation says that 2 arguments are valid:
+            # http://www.sqlite.org/lang_corefunc.html
+            return "%s||SUBSTR(path, %s, LENGTH(path))"
+        elif cls.get_database_engine() == 'mysql':
+            # hooray for mysql ignoring standards in their default
+            # configuration!
+            # to make || work as it should, enable ansi mode
+            # http://dev.mysql.com/doc/refman/5.0/en/ansi-mode.html
+            return "CONCAT(%s, SUBSTR(path, %s))"
+        return "%s||SUBSTR(path, %s)"
+
+
 class MP_NodeQuerySet(models.query.QuerySet):
     """
     Custom queryset for the tree node manager.
@@ -31,47 +130,43 @@ class MP_NodeQuerySet(models.query.QuerySet):
             # foreign keys...
             super(MP_NodeQuerySet, self).delete()
         else:
-            # we'll have to manually run through all the nodes that are going
-            # to be deleted and remove nodes from the list if an ancestor is
-            # already getting removed, since that would be redundant
-            removed = {}
-            for node in self.order_by('depth', 'path'):
-                found = False
-                for depth in range(1, len(node.path) / node.steplen):
-                    path = node._get_basepath(node.path, depth)
-                    if path in removed:
-                        # we are already removing a parent of this node
-                        # skip
-                        found = True
-                        break
-                if not found:
-                    removed[node.path] = node
-
-            # ok, got the minimal list of nodes to remove...
-            # we must also remove their children
-            # and update every parent node's numchild attribute
-            # LOTS OF FUN HERE!
+            # the minimal list of nodes to remove, in one sweep: ordered by
+            # path, the descendants of a node come right after it
+            removed = []
+            for path in self.order_by('path').values_list('path', flat=True):
+                if removed and path.startswith(removed[-1]):
+                    continue
+                removed.append(path)
+
+            # every parent node loses one child per removed node
             parents = {}
-            toremove = []
-            for path, node in removed.items():
-                parentpath = node._get_basepath(node.path, node.depth - 1)
+            for path in removed:
+                parentpath = path[:-self.model.steplen]
                 if parentpath:
-                    if parentpath not in parents:
-                        parents[parentpath] = node.get_parent(True)
-                    parent = parents[parentpath]
-                    if parent and parent.numchild > 0:
-                        parent.numchild -= 1
-                        parent.save()
-                if not node.is_leaf():
-                    toremove.append(Q(path__startswith=node.path))
+                    parents[parentpath] = parents.get(parentpath, 0) + 1
+            cursor = connection.cursor()
+            parents = sorted(parents.items())
+            step = max(1, self.model.bulk_batch_size // 3)
+            for pos in range(0, len(parents), step):
+                sql, vals = self.model._get_sql_dec_numchild(
+                    parents[pos:pos + step])
+                cursor.execute(sql, vals)
+
+            # we must also remove their descendants, the nodes whose path
+            # starts with the path of a removed node
+            dependencies = self.model._has_delete_dependencies()
+            step = max(1, self.model.bulk_batch_size // 3)
+            for pos in range(0, len(removed), step):
+                where, vals = self.model._get_sql_in_branches(
+                    removed[pos:pos + step])
+                if dependencies:
+                    # django must handle the removal of the user's foreign keys
+                    self.model.objects.extra(where=[where], params=vals
+                        ).delete(known_children=True)
                 else:
-                    toremove.append(Q(path=node.path))
-            # uh, django will handle this as a SELECT and then a DELETE of
-            # ids..
-            # status: NOT SURE IF WANT, maybe add custom sql here
-            if toremove:
-                self.model.objects.filter(
-                    reduce(operator.or_, toremove)).delete(known_children=True)
+                    cursor.execute('DELETE FROM %s WHERE %s' % (
+                        connection.ops.quote_name(self.model._meta.db_table),
+                        where), vals)
         transaction.commit_unless_managed()
 
 
@@ -83,11 +178,9 @@ class MP_NodeManager(models.Manager):
         return MP_NodeQuerySet(self.model).order_by('path')
 
 
-class MP_Node(Node):
+class MP_Node(MP_PathEncoding, Node):
     "Abstract model to create your own Materialized Path Trees."
 
-    steplen = 4
-    alphabet = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
     node_order_by = []
     path = models.CharField(max_length=255, unique=True)
     depth = models.PositiveIntegerField()
@@ -95,22 +188,6 @@ class MP_Node(Node):
 
     objects = MP_NodeManager()
 
-    numconv_obj_ = None
-
-    @classmethod
-    def _int2str(cls, num):
-        return cls.numconv_obj().int2str(num)
-
-    @classmethod
-    def _str2int(cls, num):
-        return cls.numconv_obj().str2int(num)
-
-    @classmethod
-    def numconv_obj(cls):
-        if cls.numconv_obj_ is None:
-            cls.numconv_obj_ = NumConv(len(cls.alphabet), cls.alphabet)
-        return cls.numconv_obj_
-
     @classmethod
     def add_root(cls, **kwargs):
         """
@@ -143,44 +220,32 @@ class MP_Node(Node):
         return newobj
 
     @classmethod
-    def dump_bulk(cls, parent=None, keep_ids=True):
-        "Dumps a tree branch to a python data structure."
+    def _dump_bulk_iter(cls, parent=None, keep_ids=True):
+        "Walks a tree branch as DFS for :meth:`dump_bulk`."
 
         # Because of fix_tree, this method assumes that the depth
         # and numchild properties in the nodes can be incorrect,
         # so no helper methods are used
-        qset = cls._get_serializable_model().objects.all()
+        qset = cls._get_serializable_model().objects.order_by('path')
+        basedepth = 0
         if parent:
             qset = qset.filter(path__startswith=parent.path)
-        ret, lnk = [], {}
-        for pyobj in serializers.serialize('python', qset):
-            # django's serializer stores the attributes in 'fields'
-            fields = pyobj['fields']
-            path = fields['path']
-            depth = len(path) / cls.steplen
-            # this will be useless in load_bulk
-            del fields['depth']
-            del fields['path']
-            del fields['numchild']
-            if 'id' in fields:
-                # this happens immediately after a load_bulk
-                del fields['id']
-
-            newobj = {'data': fields}
-            if keep_ids:
-                newobj['id'] = pyobj['pk']
-
-            if (not parent and depth == 1) or \
-                    (parent and len(path) == len(parent.path)):
-                ret.append(newobj)
-            else:
-                parentpath = cls._get_basepath(path, depth - 1)
-                parentobj = lnk[parentpath]
-                if 'children' not in parentobj:
-                    parentobj['children'] = []
-                parentobj['children'].append(newobj)
-            lnk[path] = newobj
-        return ret
+            basedepth = len(parent.path) / cls.steplen - 1
+        lastpath = None
+        while True:
+            # keyset pagination: the batches don't get slower as the walk
+            # goes deeper in the table
+            batch = qset
+            if lastpath is not None:
+                batch = batch.filter(path__gt=lastpath)
+            batch = list(batch[:cls.bulk_batch_size])
+            if not batch:
+                break
+            dumped = cls._dump_bulk_serialize(batch, keep_ids,
+                                              ('depth', 'path', 'numchild'))
+            for node, newobj in zip(batch, dumped):
+                yield len(node.path) / cls.steplen - basedepth, newobj
+            lastpath = batch[-1].path
 
     @classmethod
     def find_problems(cls):
@@ -206,34 +271,42 @@ class MP_Node(Node):
         """
         evil_chars, bad_steplen, orphans = [], [], []
         wrong_depth, wrong_numchild = [], []
-        for node in cls.objects.all():
-            found_error = False
-            for char in node.path:
-                if char not in cls.alphabet:
-                    evil_chars.append(node.id)
-                    found_error = True
-                    break
-            if found_error:
+
+        # the nodes with a wrong numchild value, from a single grouped pass
+        cursor = connection.cursor()
+        sql, vals = cls._get_sql_wrong_numchild()
+        cursor.execute(sql, vals)
+        bad_numchild = set([row[0] for row in cursor.fetchall()])
+
+        # the nodes are never loaded, their values are streamed in path
+        # order: the existing ancestors of a node are the paths in the
+        # ancestors stack
+        alphabet = set(cls.alphabet)
+        ancestors = []
+        for pk, path, depth, numchild in cls.objects.order_by('path').values_list(
+                'id', 'path', 'depth', 'numchild').iterator():
+            if not alphabet.issuperset(path):
+                evil_chars.append(pk)
                 continue
-            if len(node.path) % cls.steplen:
-                bad_steplen.append(node.id)
+            if len(path) % cls.steplen:
+                bad_steplen.append(pk)
                 continue
-            try:
-                node.get_parent(True)
-            except cls.DoesNotExist:
-                orphans.append(node.id)
+            while ancestors and not path.startswith(ancestors[-1]):
+                ancestors.pop()
+            parentpath = path[:-cls.steplen]
+            orphan = parentpath and not (ancestors and
+                                         ancestors[-1] == parentpath)
+            ancestors.append(path)
+            if orphan:
+                orphans.append(pk)
                 continue
 
-            if node.depth != len(node.path) / cls.steplen:
-                wrong_depth.append(node.id)
+            if depth != len(path) / cls.steplen:
+                wrong_depth.append(pk)
                 continue
 
-            real_numchild = cls.objects.filter(
-                path__range=cls._get_children_path_interval(node.path)).extra(
-                    where=['LENGTH(path)/%d=%d' % (cls.steplen,
-                                                   node.depth + 1)]).count()
-            if real_numchild != node.numchild:
-                wrong_numchild.append(node.id)
+            if path in bad_numchild:
+                wrong_numchild.append(pk)
                 continue
 
         return evil_chars, bad_steplen, orphans, wrong_depth, wrong_numchild
@@ -263,25 +336,28 @@ class MP_Node(Node):
             ``numchild`` nodes, it won't fix the tree holes or broken path
             ordering.
 
-            .. warning::
-
-               Currently what the ``destructive`` method does is:
-
-               1. Backup the tree with :meth:`dump_data`
-               2. Remove all nodes in the tree.
-               3. Restore the tree with :meth:`load_data`
-
-               So, even when the primary keys of your nodes will be preserved,
-               this method isn't foreign-key friendly. That needs complex
-               in-place tree reordering, not available at the moment (hint:
-               patches are welcome).
+            The ``destructive`` method rewrites the paths in place, level by
+            level: the children of every node get consecutive steps, in the
+            ``node_order_by`` order (or in their current order). Every moved
+            branch is updated with a single statement and committed on its
+            own (unless the transactions are managed by the caller), so the
+            rows, their primary keys and the foreign keys pointing to them
+            are preserved, the tree can be used while it's fixed and an
+            interrupted fix can simply be run again.
+
+        :returns: A dictionary with the number of rows whose ``depth``
+            ('depth') and ``numchild`` ('numchild') values were fixed, the
+            number of moved branches ('moved', destructive method only) and
+            the time it took in seconds ('seconds')
         """
         if destructive:
-            dump = cls.dump_bulk(None, True)
-            cls.objects.all().delete()
-            cls.load_bulk(dump, None, True)
+            result = cls.fix_tree(destructive=False)
+            start = time.time()
+            result['moved'] = cls._fix_paths_in_place()
+            result['seconds'] += time.time() - start
+            return result
         else:
-
+            start = time.time()
             cursor = connection.cursor()
 
             # fix the depth field
@@ -292,39 +368,132 @@ class MP_Node(Node):
                       connection.ops.quote_name(cls._meta.db_table), )
             vals = [cls.steplen, cls.steplen]
             cursor.execute(sql, vals)
+            fixed_depth = cursor.rowcount
 
-            # fix the numchild field
-            vals = ['_' * cls.steplen]
-            # the cake and sql portability are a lie
-            if cls.get_database_engine() == 'mysql':
-                sql = "SELECT tbn1.path, tbn1.numchild, (" \
-                              "SELECT COUNT(1) " \
-                              "FROM %(table)s AS tbn2 " \
-                              "WHERE tbn2.path LIKE " \
-                                "CONCAT(tbn1.path, %%s)) AS real_numchild " \
-                      "FROM %(table)s AS tbn1 " \
-                      "HAVING tbn1.numchild != real_numchild" % {
-                        'table': connection.ops.quote_name(cls._meta.db_table)}
-            else:
-                subquery = "(SELECT COUNT(1) FROM %(table)s AS tbn2" \
-                           " WHERE tbn2.path LIKE tbn1.path||%%s)"
-                sql = "SELECT tbn1.path, tbn1.numchild, " + subquery + " " \
-                      "FROM %(table)s AS tbn1 " \
-                      "WHERE tbn1.numchild != " + subquery
-                sql = sql % {
-                        'table': connection.ops.quote_name(cls._meta.db_table)}
-                # we include the subquery twice
-                vals *= 2
+            # fix the numchild field: the real number of children of every
+            # node comes from a single grouped pass over the parent paths,
+            # joined to the nodes to find the wrong values
+            sql, vals = cls._get_sql_wrong_numchild()
             cursor.execute(sql, vals)
+            rows = [(real_numchild, path)
+                    for path, numchild, real_numchild in cursor.fetchall()]
             sql = "UPDATE %(table)s " \
                      "SET numchild=%%s " \
                    "WHERE path=%%s" % {
                      'table': connection.ops.quote_name(cls._meta.db_table)}
-            for node_data in cursor.fetchall():
-                vals = [node_data[2], node_data[0]]
-                cursor.execute(sql, vals)
+            for pos in range(0, len(rows), cls.bulk_batch_size):
+                cursor.executemany(sql, rows[pos:pos + cls.bulk_batch_size])
 
             transaction.commit_unless_managed()
+            return {'depth': fixed_depth, 'numchild': len(rows),
+                    'seconds': time.time() - start}
+
+    @classmethod
+    def _fix_paths_in_place(cls):
+        """
+        Gives the children of every node consecutive steps in the right order,
+        see :meth:`fix_tree`. The depth values must be correct.
+
+        :returns: The number of moved branches
+        """
+        cursor = connection.cursor()
+        moved = 0
+        depth = 1
+        while True:
+            # the nodes of a level, grouped by parent in the final order
+            siblings = {}
+            qset = cls.objects.filter(depth=depth).order_by(
+                *(list(cls.node_order_by) + ['path']))
+            for path in qset.values_list('path', flat=True).iterator():
+                siblings.setdefault(path[:-cls.steplen], []).append(path)
+            if not siblings:
+                break
+            for parentpath in sorted(siblings):
+                for oldpath, newpath in cls._get_sibling_moves(
+                        parentpath, depth, siblings[parentpath]):
+                    sql, vals = cls._get_sql_newpath_in_branches(oldpath,
+                                                                 newpath)
+                    cursor.execute(sql, vals)
+                    transaction.commit_unless_managed()
+                    moved += 1
+            depth += 1
+        return moved
+
+    @classmethod
+    def _get_sibling_moves(cls, parentpath, depth, paths):
+        """
+        :returns: The list of (oldpath, newpath) branch moves that give the
+            siblings in paths (in their final order) the steps 1, 2, 3...
+            without ever using a path that is taken.
+        """
+        moves = []
+        for pos, oldpath in enumerate(paths):
+            newpath = cls._get_path(parentpath, depth, pos + 1)
+            if oldpath != newpath:
+                moves.append((oldpath, newpath))
+
+        pending = dict(moves)
+        wanted_by = dict([(newpath, oldpath) for oldpath, newpath in moves])
+        result = []
+
+        def follow(vacant):
+            # the branch that wants a freed path moves there, freeing its own
+            oldpath = wanted_by.get(vacant)
+            while oldpath in pending:
+                del pending[oldpath]
+                result.append((oldpath, vacant))
+                vacant = oldpath
+                oldpath = wanted_by.get(vacant)
+
+        # moves to free paths (all of them when there are only holes)
+        for oldpath, newpath in moves:
+            if oldpath in pending and newpath not in pending:
+                del pending[oldpath]
+                result.append((oldpath, newpath))
+                follow(oldpath)
+
+        # the rest are cycles of swapped siblings: one branch is parked on
+        # step 0 (never used by treebeard) until its new path is free
+        for oldpath, newpath in moves:
+            if oldpath in pending:
+                parking = cls._get_path(parentpath, depth, 0)
+                if parking in paths:
+                    raise PathOverflow('No free path to reorder the children'
+                                       ' of: %r' % (parentpath, ))
+                del pending[oldpath]
+                result.append((oldpath, parking))
+                follow(oldpath)
+                result.append((parking, newpath))
+        return result
+
+    @classmethod
+    def _get_sql_wrong_numchild(cls):
+        """
+        :returns: The sql that finds the nodes with a wrong ``numchild``
+            value, as (path, numchild, real_numchild) rows
+        """
+        # the nodes with children are found through the path index, the
+        # leaves must not appear as a parent path
+        parentpath = "SUBSTR(path, 1, LENGTH(path)-%%s)"
+        sql = "SELECT tbn1.path, tbn1.numchild, tbn2.real_numchild " \
+              "FROM (" \
+                  "SELECT " + parentpath + " AS parentpath, " \
+                         "COUNT(1) AS real_numchild " \
+                  "FROM %(table)s " \
+                  "WHERE LENGTH(path)>%%s " \
+                  "GROUP BY " + parentpath + \
+              ") AS tbn2 " \
+              "INNER JOIN %(table)s AS tbn1 ON tbn1.path=tbn2.parentpath " \
+              "WHERE tbn1.numchild!=tbn2.real_numchild " \
+              "UNION ALL " \
+              "SELECT path, numchild, 0 " \
+              "FROM %(table)s " \
+              "WHERE numchild!=0 AND path NOT IN (" \
+                  "SELECT " + parentpath + " " \
+                  "FROM %(table)s " \
+                  "WHERE LENGTH(path)>%%s)"
+        sql = sql % {'table': connection.ops.quote_name(cls._meta.db_table)}
+        return sql, [cls.steplen] * 5
 
     @classmethod
     def get_tree(cls, parent=None):
@@ -617,6 +786,35 @@ class MP_Node(Node):
         self._cached_parent_obj = self.__class__.objects.get(path=parentpath)
         return self._cached_parent_obj
 
+    @classmethod
+    def get_parents(cls, nodes):
+        """
+        :returns: A list with the parent node of every node in ``nodes``
+            (``None`` for root nodes and for nodes whose parent row is
+            missing), in the same order, with a single query
+            per batch of nodes. The parents are cached in the nodes like
+            :meth:`get_parent` does.
+        """
+        nodes = list(nodes)
+        paths = sorted(set([cls._get_parent_path_from_path(node.path)
+                            for node in nodes
+                            if len(node.path) > cls.steplen]))
+        parents = {}
+        for pos in range(0, len(paths), cls.bulk_batch_size):
+            for parent in cls.objects.filter(
+                    path__in=paths[pos:pos + cls.bulk_batch_size]):
+                parents[parent.path] = parent
+        ret = []
+        for node in nodes:
+            parent = None
+            if len(node.path) > cls.steplen:
+                parent = parents.get(
+                    cls._get_parent_path_from_path(node.path))
+                if parent is not None:
+                    node._cached_parent_obj = parent
+            ret.append(parent)
+        return ret
+
     def move(self, target, pos=None):
         """
         Moves the current node and all it's descendants to a new position
@@ -670,57 +868,6 @@ class MP_Node(Node):
             cursor.execute(sql, vals)
         transaction.commit_unless_managed()
 
-    @classmethod
-    def _get_basepath(cls, path, depth):
-        ":returns: The base path of another path up to a given depth"
-        if path:
-            return path[0:(depth) * cls.steplen]
-        return ''
-
-    @classmethod
-    def _get_path(cls, path, depth, newstep):
-        """
-        Builds a path given some values
-
-        :param path: the base path
-        :param depth: the depth of the  node
-        :param newstep: the value (integer) of the new step
-        """
-        parentpath = cls._get_basepath(path, depth - 1)
-        key = cls._int2str(newstep)
-        return '%s%s%s' % (parentpath,
-                           '0' * (cls.steplen - len(key)),
-                           key)
-
-    @classmethod
-    def _inc_path(cls, path):
-        ":returns: The path of the next sibling of a given node path."
-        newpos = cls._str2int(path[-cls.steplen:]) + 1
-        key = cls._int2str(newpos)
-        if len(key) > cls.steplen:
-            raise PathOverflow("Path Overflow from: '%s'" % (path, ))
-        return '%s%s%s' % (path[:-cls.steplen],
-                           '0' * (cls.steplen - len(key)),
-                           key)
-
-    @classmethod
-    def _get_lastpos_in_path(cls, path):
-        ":returns: The integer value of the last step in a path."
-        return cls._str2int(path[-cls.steplen:])
-
-    @classmethod
-    def _get_parent_path_from_path(cls, path):
-        ":returns: The parent path for a given path"
-        if path:
-            return path[0:len(path) - cls.steplen]
-        return ''
-
-    @classmethod
-    def _get_children_path_interval(cls, path):
-        ":returns: An interval of all possible children paths for a node."
-        return (path + cls.alphabet[0] * cls.steplen,
-                path + cls.alphabet[-1] * cls.steplen)
-
     @classmethod
     def _move_add_sibling_aux(cls, pos, newpos, newdepth, target, siblings,
                               stmts, oldpath=None, movebranch=False):
@@ -846,21 +993,7 @@ class MP_Node(Node):
             connection.ops.quote_name(cls._meta.db_table), )
 
         # <3 "standard" sql
-        if cls.get_database_engine() == 'sqlite3':
-            # I know that the third argument in SUBSTR (LENGTH(path)) is
-            # awful, but sqlite fails without it:
-            # OperationalError: wrong number of arguments to function substr()
-            # even when the documentation says that 2 arguments are valid:
-            # http://www.sqlite.org/lang_corefunc.html
-            sqlpath = "%s||SUBSTR(path, %s, LENGTH(path))"
-        elif cls.get_database_engine() == 'mysql':
-            # hooray for mysql ignoring standards in their default
-            # configuration!
-            # to make || work as it should, enable ansi mode
-            # http://dev.mysql.com/doc/refman/5.0/en/ansi-mode.html
-            sqlpath = "CONCAT(%s, SUBSTR(path, %s))"
-        else:
-            sqlpath = "%s||SUBSTR(path, %s)"
+        sqlpath = cls._get_sql_path_concat()
 
         sql2 = ["path=%s" % (sqlpath, )]
         vals = [newpath, len(oldpath) + 1]
@@ -901,6 +1034,44 @@ class MP_Node(Node):
         vals = [path]
         return sql, vals
 
+    @classmethod
+    def _get_sql_dec_numchild(cls, counts):
+        """
+        :returns: The sql needed to decrease the numchild values of several
+            nodes at once, counts is a list of (path, decrement) pairs. A
+            stale numchild smaller than its decrement ends at 0.
+        """
+        sql = "UPDATE %s SET numchild=CASE path %s ELSE numchild END" \
+              " WHERE path IN (%s) AND numchild>0" % (
+                connection.ops.quote_name(cls._meta.db_table),
+                ' '.join(['WHEN %s THEN CASE WHEN numchild > %s'
+                          ' THEN numchild-%s ELSE 0 END'] * len(counts)),
+                ', '.join(['%s'] * len(counts)))
+        vals = []
+        for path, count in counts:
+            vals.extend([path, count, count])
+        vals.extend([path for path, count in counts])
+        return sql, vals
+
+    @classmethod
+    def _get_sql_in_branches(cls, paths):
+        """
+        :returns: The sql condition (and its values) that matches the nodes
+            whose path starts with one of the paths, whatever the collation
+            of the path column.
+
+        .. note::
+
+           ``LIKE`` ignores the case in sqlite (and may in other databases),
+           so the prefix is compared too, for alphabets with both cases.
+        """
+        sql = ' OR '.join(['(path LIKE %s AND SUBSTR(path, 1, %s) = %s)'] *
+                          len(paths))
+        vals = []
+        for path in paths:
+            vals.extend([path + '%', len(path), path])
+        return '(%s)' % (sql, ), vals
+
     class Meta:
         "Abstract model."
         abstract = True
@@ -1,9 +1,9 @@
 "Nested Sets"
 
+import bisect
 import operator
 
-from django.db.models import Q
-from django.core import serializers
+from django.db.models import Q, Min
 from django.db import models, transaction, connection
 
 from treebeard.models import Node
@@ -29,47 +29,50 @@ class NS_NodeQuerySet(models.query.QuerySet):
             # delete method and let it handle the removal of the user's
             # foreign keys...
             super(NS_NodeQuerySet, self).delete()
-            cursor = connection.cursor()
-
-            # Now closing the gap (Celko's trees book, page 62)
-            # We do this for every gap that was left in the tree when the nodes
-            # were removed.  If many nodes were removed, we're going to update
-            # the same nodes over and over again. This would be probably
-            # cheaper precalculating the gapsize per intervals, or just do a
-            # complete reordering of the tree (uses COUNT)...
-            for tree_id, drop_lft, drop_rgt in sorted(removed_ranges,
-                                                      reverse=True):
-                sql, params = self.model._get_close_gap_sql(drop_lft, drop_rgt,
-                                                            tree_id)
-                cursor.execute(sql, params)
+            self._close_gaps(removed_ranges)
         else:
-            # we'll have to manually run through all the nodes that are going
-            # to be deleted and remove nodes from the list if an ancestor is
-            # already getting removed, since that would be redundant
-            removed = {}
-            for node in self.order_by('tree_id', 'lft'):
-                found = False
-                for rid, rnode in removed.items():
-                    if node.is_descendant_of(rnode):
-                        found = True
-                        break
-                if not found:
-                    removed[node.id] = node
-
-            # ok, got the minimal list of nodes to remove...
-            # we must also remove their descendants
-            toremove = []
+            # the minimal list of nodes to remove, in one sweep: ordered by
+            # tree_id and lft, a node is a descendant of an already removed
+            # node if it starts inside its range
             ranges = []
-            for id, node in removed.items():
-                toremove.append(Q(lft__range=(node.lft, node.rgt)) &
-                                Q(tree_id=node.tree_id))
-                ranges.append((node.tree_id, node.lft, node.rgt))
-            if toremove:
-                self.model.objects.filter(
-                    reduce(operator.or_, toremove)).delete(
-                    removed_ranges=ranges)
+            for tree_id, lft, rgt in self.order_by('tree_id', 'lft').values_list(
+                    'tree_id', 'lft', 'rgt'):
+                if ranges and ranges[-1][0] == tree_id and lft < ranges[-1][2]:
+                    continue
+                ranges.append((tree_id, lft, rgt))
+
+            # we must also remove their descendants, in batches of ranges
+            # (3 query parameters per range); the gaps are closed afterwards,
+            # the lft/rgt values of the next batches must not change before
+            step = max(1, self.model.bulk_batch_size // 3)
+            for pos in range(0, len(ranges), step):
+                toremove = [Q(lft__range=(lft, rgt)) & Q(tree_id=tree_id)
+                            for tree_id, lft, rgt in ranges[pos:pos + step]]
+                qset = self.model.objects.filter(reduce(operator.or_, toremove))
+                super(NS_NodeQuerySet, qset).delete()
+            self._close_gaps(ranges)
         transaction.commit_unless_managed()
 
+    def _close_gaps(self, removed_ranges):
+        """
+        Closes the gaps left in the trees by the removed
+        (tree_id, drop_lft, drop_rgt) ranges, with one UPDATE per tree
+        (Celko's trees book, page 62, for all the gaps at once)
+
+        With spread numbering the gaps are kept, they are free room for the
+        next inserts.
+        """
+        if self.model.node_spread:
+            return
+        ranges_per_tree = {}
+        for tree_id, drop_lft, drop_rgt in removed_ranges:
+            ranges_per_tree.setdefault(tree_id, []).append((drop_lft, drop_rgt))
+        cursor = connection.cursor()
+        for tree_id, ranges in sorted(ranges_per_tree.items()):
+            sql, params = self.model._get_close_gaps_sql(sorted(ranges),
+                                                         tree_id)
+            cursor.execute(sql, params)
+
 
 class NS_NodeManager(models.Manager):
     """ Custom manager for nodes.
@@ -81,8 +84,27 @@ class NS_NodeManager(models.Manager):
 
 
 class NS_Node(Node):
-    "Abstract model to create your own Nested Sets Trees."
+    """
+    Abstract model to create your own Nested Sets Trees.
+
+    With ``node_spread`` set, the lft/rgt values are allocated leaving up to
+    ``node_spread`` free values before, after and inside every new node, and
+    inserting or moving a node only fills one of these gaps. When a gap is
+    exhausted, the values after it are shifted up to the nearest ancestor
+    followed by enough free values (with room for as many nodes as the parent
+    already holds), instead of up to the end of the tree. The lft/rgt values
+    are not consecutive then: ``rgt - lft`` doesn't give the number of
+    descendants and existing trees keep their numbering until they grow.
+
+    With ``tree_id_spread`` set, the roots get tree_ids with up to
+    ``tree_id_spread`` free tree_ids between them, and a root inserted before
+    another one (e.g. with ``node_order_by``) takes a free tree_id instead of
+    moving all the following trees. When there is none, only the following
+    trees up to the next big enough gap are moved.
+    """
     node_order_by = []
+    node_spread = 0
+    tree_id_spread = 0
 
     lft = models.PositiveIntegerField(db_index=True)
     rgt = models.PositiveIntegerField(db_index=True)
@@ -105,24 +127,24 @@ class NS_Node(Node):
 
         if last_root:
             # adding the new root node as the last one
-            newtree_id = last_root.tree_id + 1
+            newtree_id = last_root.tree_id + 1 + cls.tree_id_spread
         else:
             # adding the first root node
-            newtree_id = 1
+            newtree_id = 1 + cls.tree_id_spread
 
         # creating the new object
         newobj = cls(**kwargs)
         newobj.depth = 1
         newobj.tree_id = newtree_id
         newobj.lft = 1
-        newobj.rgt = 2
+        newobj.rgt = 2 + cls.node_spread
         # saving the instance before returning it
         newobj.save()
         transaction.commit_unless_managed()
         return newobj
 
     @classmethod
-    def _move_right(cls, tree_id, rgt, lftmove=False, incdec=2):
+    def _move_right(cls, tree_id, rgt, lftmove=False, incdec=2, limit=None):
         if lftmove:
             lftop = '>='
         else:
@@ -141,8 +163,93 @@ class NS_Node(Node):
                   'tree_id': tree_id,
                   'lftop': lftop,
                   'incdec': incdec}
+        if limit is not None:
+            # only the nodes inside the node whose rgt is limit
+            sql += ' AND rgt <= %d' % limit
         return sql, []
 
+    @classmethod
+    def _get_spread_limit(cls, parent, amount):
+        """
+        :returns: the rgt of the nearest node, starting with parent and going
+            up to the root, followed by at least ``amount`` free values
+        """
+        chain = list(cls.objects.filter(
+            tree_id=parent.tree_id,
+            lft__lte=parent.lft,
+            rgt__gte=parent.rgt).order_by('-depth').values_list('depth',
+                                                                'rgt'))
+        # the first lft after the ancestor on every level (if it isn't a
+        # sibling of the ancestor, it's after the rgt of the ancestor's parent)
+        nextlfts = {}
+        for row in cls.objects.filter(
+                tree_id=parent.tree_id,
+                depth__lte=parent.depth,
+                lft__gt=parent.rgt).order_by().values('depth').annotate(
+                    nextlft=Min('lft')):
+            nextlfts[row['depth']] = row['nextlft']
+        for pos, (depth, rgt) in enumerate(chain[:-1]):
+            nextval = chain[pos + 1][1]
+            if depth in nextlfts:
+                nextval = min(nextval, nextlfts[depth])
+            if nextval - rgt > amount:
+                return rgt
+        # the root, nothing after it
+        return chain[-1][1]
+
+    @classmethod
+    def _get_spread_slot(cls, parent, left, right, width=2, grow=True):
+        """
+        Finds room for ``width`` values after the ``left`` and before the
+        ``right`` values inside parent, leaving up to ``node_spread`` free
+        values around them (and inside them if ``grow``, for a new node).
+        When there isn't enough room, the values from ``right`` on are moved
+        right first, the cached ``parent.rgt`` is updated.
+
+        :returns: the first value of the room and the free values left inside
+        """
+        spread = cls.node_spread
+        gaps = 3 if grow else 2
+        free = right - left - 1
+        if free < width:
+            amount = max(width + gaps * spread, parent.rgt - parent.lft + 1)
+            limit = cls._get_spread_limit(parent, amount)
+            sql, params = cls._move_right(parent.tree_id, right, True,
+                                          amount, limit)
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            parent.rgt += amount
+            free += amount
+        gap = min(spread, (free - width) // gaps)
+        if grow:
+            return left + 1 + gap, gap
+        return left + 1 + gap, 0
+
+    def _refresh_spread_bounds(self):
+        """
+        Reloads the lft and rgt values of the node: with ``node_spread``,
+        they change when any gap inside an ancestor is exhausted, so cached
+        node objects (like the parent of a node) get stale.
+        """
+        self.lft, self.rgt = self.__class__.objects.filter(
+            pk=self.pk).values_list('lft', 'rgt')[0]
+
+    def _get_spread_bounds(self, pos, siblings=None):
+        """
+        :returns: the (left, right) values around the room for a new sibling
+            of the node at pos ('last-sibling', 'first-sibling' or 'left'),
+            ``siblings`` is needed for 'left'. The boundaries of the parent
+            are reloaded first.
+        """
+        parent = self.get_parent()
+        parent._refresh_spread_bounds()
+        if pos == 'last-sibling':
+            return self.get_last_sibling().rgt, parent.rgt
+        if pos == 'first-sibling':
+            return parent.lft, siblings[0].lft
+        pos = siblings.index(self)
+        return siblings[pos - 1].rgt, siblings[pos].lft
+
     @classmethod
     def _move_tree_right(cls, tree_id):
         sql = 'UPDATE %(table)s ' \
@@ -152,36 +259,142 @@ class NS_Node(Node):
                   'tree_id': tree_id}
         return sql, []
 
+    @classmethod
+    def _get_renumber_trees_sql(cls, moves):
+        """
+        Changes the tree_ids of the (old, new) moves in a single statement,
+        the moves must be sorted, and be all the trees between the first
+        and the last old tree_id.
+        """
+        sql = 'UPDATE %(table)s ' \
+              ' SET tree_id = CASE tree_id %(whens)s ELSE tree_id END ' \
+              ' WHERE tree_id BETWEEN %(first)d AND %(last)d' % {
+                  'table': connection.ops.quote_name(cls._meta.db_table),
+                  'whens': ' '.join(['WHEN %d THEN %d' % move
+                                     for move in moves]),
+                  'first': moves[0][0],
+                  'last': moves[-1][0]}
+        return sql, []
+
+    @classmethod
+    def _get_new_tree_id(cls, prev_tree_id=None, next_tree_id=None):
+        """
+        With ``tree_id_spread``, finds a free tree_id for a new root between
+        the roots with prev_tree_id and next_tree_id (the missing one is
+        looked up, without both the new root is the last one). When
+        there is none, the roots from next_tree_id on are spread evenly
+        first, up to the first root that leaves at least
+        ``(tree_id_spread + 1) // 2`` free tree_ids per moved root.
+
+        :returns: the tree_id
+        """
+        # every tree has a root, the lookups only need the tree_id index
+        tree_ids = cls.objects.values_list('tree_id', flat=True)
+        if prev_tree_id is None:
+            prev_tree_id = 0
+            before = tree_ids
+            if next_tree_id is not None:
+                before = tree_ids.filter(tree_id__lt=next_tree_id)
+            for prev_tree_id in before.order_by('-tree_id')[:1]:
+                pass
+        elif next_tree_id is None:
+            for next_tree_id in tree_ids.filter(
+                    tree_id__gt=prev_tree_id).order_by('tree_id')[:1]:
+                pass
+        if next_tree_id is None:
+            return prev_tree_id + 1 + cls.tree_id_spread
+        if next_tree_id - prev_tree_id < 2:
+            # the following roots are read until the gap, in chunks
+            density = (cls.tree_id_spread + 1) // 2 + 1
+            run = []
+            end = None
+            for tree_id in tree_ids.filter(
+                    tree_id__gte=next_tree_id).order_by(
+                        'tree_id').distinct().iterator():
+                if tree_id - prev_tree_id > (len(run) + 1) * density:
+                    end = tree_id
+                    break
+                run.append(tree_id)
+            if end is None:
+                # the last roots
+                moves = [(tree_id,
+                          prev_tree_id + (pos + 1) * (cls.tree_id_spread + 1))
+                         for pos, tree_id in enumerate(run)]
+            else:
+                # leaving room for the new root first
+                moves = [(tree_id, prev_tree_id + (pos + 2) *
+                          (end - prev_tree_id) // (len(run) + 2))
+                         for pos, tree_id in enumerate(run)]
+            # every new tree_id is greater than (or equal to) the old one and
+            # the old ones are sorted: renumbering the batches starting by
+            # the last one never merges two trees
+            cursor = connection.cursor()
+            for pos in reversed(range(0, len(moves), cls.bulk_batch_size)):
+                sql, params = cls._get_renumber_trees_sql(
+                    moves[pos:pos + cls.bulk_batch_size])
+                cursor.execute(sql, params)
+            next_tree_id = moves[0][1]
+        return (prev_tree_id + next_tree_id) // 2
+
     def add_child(self, **kwargs):
         "Adds a child to the node."
-        if not self.is_leaf():
+        if self.node_spread:
+            # is_leaf() needs a query anyway
+            self._refresh_spread_bounds()
+            # the descendant with the greatest rgt is the last child
+            last_child = None
+            for last_child in self.__class__.objects.filter(
+                    tree_id=self.tree_id,
+                    rgt__range=(self.lft + 1, self.rgt - 1)).order_by(
+                        '-rgt')[:1]:
+                pass
+            if last_child is not None and not self.node_order_by:
+                newobj = self.__class__(**kwargs)
+                newobj.tree_id = self.tree_id
+                newobj.depth = self.depth + 1
+                newobj.lft, gap = self.__class__._get_spread_slot(
+                    self, last_child.rgt, self.rgt)
+                newobj.rgt = newobj.lft + 1 + gap
+                newobj._cached_parent_obj = self
+                newobj.save()
+                transaction.commit_unless_managed()
+                return newobj
+        elif self.is_leaf():
+            last_child = None
+        else:
+            last_child = self.get_last_child()
+        if last_child is not None:
             # there are child nodes, delegate insertion to add_sibling
             if self.node_order_by:
                 pos = 'sorted-sibling'
             else:
                 pos = 'last-sibling'
-            last_child = self.get_last_child()
             last_child._cached_parent_obj = self
             return last_child.add_sibling(pos, **kwargs)
 
-        # we're adding the first child of this node
-        sql, params = self.__class__._move_right(self.tree_id,
-                                                 self.rgt, False, 2)
-
         # creating a new object
         newobj = self.__class__(**kwargs)
         newobj.tree_id = self.tree_id
         newobj.depth = self.depth + 1
-        newobj.lft = self.lft + 1
-        newobj.rgt = self.lft + 2
 
-        # this is just to update the cache
-        self.rgt = self.rgt + 2
+        # we're adding the first child of this node
+        if self.node_spread:
+            newobj.lft, gap = self.__class__._get_spread_slot(self, self.lft,
+                                                              self.rgt)
+            newobj.rgt = newobj.lft + 1 + gap
+        else:
+            sql, params = self.__class__._move_right(self.tree_id,
+                                                     self.rgt, False, 2)
+            newobj.lft = self.lft + 1
+            newobj.rgt = self.lft + 2
 
-        newobj._cached_parent_obj = self
+            # this is just to update the cache
+            self.rgt = self.rgt + 2
 
-        cursor = connection.cursor()
-        cursor.execute(sql, params)
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+
+        newobj._cached_parent_obj = self
 
         # saving the instance before returning it
         newobj.save()
@@ -200,30 +413,45 @@ class NS_Node(Node):
 
         sql = None
         target = self
+        siblings = None
 
         if target.is_root():
             newobj.lft = 1
-            newobj.rgt = 2
+            newobj.rgt = 2 + self.node_spread
             if pos == 'sorted-sibling':
+                # only the first root that must be moved to the right
                 siblings = list(target.get_sorted_pos_queryset(
-                    target.get_siblings(), newobj))
+                    target.get_siblings(), newobj)[:1])
                 if siblings:
                     pos = 'left'
                     target = siblings[0]
                 else:
                     pos = 'last-sibling'
 
-            last_root = target.__class__.get_last_root_node()
-            if pos == 'last-sibling' \
-                  or (pos == 'right' and target == last_root):
-                newobj.tree_id = last_root.tree_id + 1
+            if self.tree_id_spread:
+                get_new_tree_id = self.__class__._get_new_tree_id
+                if pos == 'last-sibling':
+                    newobj.tree_id = get_new_tree_id()
+                elif pos == 'first-sibling':
+                    newobj.tree_id = get_new_tree_id(prev_tree_id=0)
+                elif pos == 'left':
+                    newobj.tree_id = get_new_tree_id(
+                        next_tree_id=target.tree_id)
+                else:
+                    newobj.tree_id = get_new_tree_id(
+                        prev_tree_id=target.tree_id)
             else:
-                newpos = {'first-sibling': 1,
-                          'left': target.tree_id,
-                          'right': target.tree_id + 1}[pos]
-                sql, params = target.__class__._move_tree_right(newpos)
+                last_root = target.__class__.get_last_root_node()
+                if pos == 'last-sibling' \
+                      or (pos == 'right' and target == last_root):
+                    newobj.tree_id = last_root.tree_id + 1
+                else:
+                    newpos = {'first-sibling': 1,
+                              'left': target.tree_id,
+                              'right': target.tree_id + 1}[pos]
+                    sql, params = target.__class__._move_tree_right(newpos)
 
-                newobj.tree_id = newpos
+                    newobj.tree_id = newpos
         else:
             newobj.tree_id = target.tree_id
 
@@ -259,18 +487,25 @@ class NS_Node(Node):
 
             move_right = self.__class__._move_right
 
-            if pos == 'last-sibling':
-                newpos = target.get_parent().rgt
-                sql, params = move_right(target.tree_id, newpos, False, 2)
-            elif pos == 'first-sibling':
-                newpos = target.lft
-                sql, params = move_right(target.tree_id, newpos - 1, False, 2)
-            elif pos == 'left':
-                newpos = target.lft
-                sql, params = move_right(target.tree_id, newpos, True, 2)
-
-            newobj.lft = newpos
-            newobj.rgt = newpos + 1
+            if self.node_spread:
+                left, right = target._get_spread_bounds(pos, siblings)
+                newobj.lft, gap = self.__class__._get_spread_slot(
+                    target.get_parent(), left, right)
+                newobj.rgt = newobj.lft + 1 + gap
+            else:
+                if pos == 'last-sibling':
+                    newpos = target.get_parent().rgt
+                    sql, params = move_right(target.tree_id, newpos, False, 2)
+                elif pos == 'first-sibling':
+                    newpos = target.lft
+                    sql, params = move_right(target.tree_id, newpos - 1,
+                                             False, 2)
+                elif pos == 'left':
+                    newpos = target.lft
+                    sql, params = move_right(target.tree_id, newpos, True, 2)
+
+                newobj.lft = newpos
+                newobj.rgt = newpos + 1
 
         # saving the instance before returning it
         if sql:
@@ -292,6 +527,7 @@ class NS_Node(Node):
         cls = self.__class__
 
         parent = None
+        siblings = None
 
         if pos in ('first-child', 'last-child', 'sorted-child'):
             # moving to a child
@@ -353,18 +589,32 @@ class NS_Node(Node):
         target_tree = target.tree_id
 
         # first make a hole
-        if pos == 'last-child':
+        if pos == 'last-child' and cls.node_spread:
+            parent._refresh_spread_bounds()
+            newpos = cls._get_spread_slot(parent, parent.lft, parent.rgt,
+                                          gap, False)[0]
+        elif pos == 'last-child':
             newpos = parent.rgt
             sql, params = move_right(target.tree_id, newpos, False, gap)
         elif target.is_root():
             newpos = 1
-            if pos == 'last-sibling':
+            if pos == 'last-sibling' and cls.tree_id_spread:
+                target_tree = cls._get_new_tree_id()
+            elif pos == 'last-sibling':
                 target_tree = target.get_siblings().reverse()[0].tree_id + 1
+            elif cls.tree_id_spread:
+                # first-sibling and left: target is the next root
+                target_tree = cls._get_new_tree_id(next_tree_id=target.tree_id)
             elif pos == 'first-sibling':
                 target_tree = 1
                 sql, params = cls._move_tree_right(1)
             elif pos == 'left':
                 sql, params = cls._move_tree_right(target.tree_id)
+        elif cls.node_spread:
+            # fill a gap, the values after it are moved only if it's too small
+            left, right = target._get_spread_bounds(pos, siblings)
+            newpos = cls._get_spread_slot(target.get_parent(), left, right,
+                                          gap, False)[0]
         else:
             if pos == 'last-sibling':
                 newpos = target.get_parent().rgt
@@ -405,10 +655,11 @@ class NS_Node(Node):
                   'fromrgt': fromobj.rgt}
         cursor.execute(sql, [])
 
-        # close the gap
-        sql, params = cls._get_close_gap_sql(fromobj.lft,
-            fromobj.rgt, fromobj.tree_id)
-        cursor.execute(sql, params)
+        if not cls.node_spread:
+            # close the gap
+            sql, params = cls._get_close_gap_sql(fromobj.lft,
+                fromobj.rgt, fromobj.tree_id)
+            cursor.execute(sql, params)
 
         transaction.commit_unless_managed()
 
@@ -432,6 +683,36 @@ class NS_Node(Node):
                   'tree_id': tree_id}
         return sql, []
 
+    @classmethod
+    def _get_close_gaps_sql(cls, ranges, tree_id):
+        """
+        Every lft/rgt value is decreased by the total size of the removed
+        (drop_lft, drop_rgt) ranges on its left. The ranges must be sorted and
+        must not overlap.
+        """
+        whens = []
+        gapsize = 0
+        for drop_lft, drop_rgt in ranges:
+            gapsize += drop_rgt - drop_lft + 1
+            whens.insert(0, (drop_lft, gapsize))
+
+        def case(col):
+            return 'CASE %s ELSE %s END' % (' '.join([
+                'WHEN %s > %d THEN %s - %d' % (col, drop_lft, col, gapsize)
+                for drop_lft, gapsize in whens]), col)
+
+        sql = 'UPDATE %(table)s ' \
+              ' SET lft = %(lft_case)s, ' \
+              '     rgt = %(rgt_case)s ' \
+              ' WHERE rgt > %(drop_lft)d AND ' \
+              '     tree_id=%(tree_id)d' % {
+                  'table': connection.ops.quote_name(cls._meta.db_table),
+                  'lft_case': case('lft'),
+                  'rgt_case': case('rgt'),
+                  'drop_lft': ranges[0][0],
+                  'tree_id': tree_id}
+        return sql, []
+
     @classmethod
     def load_bulk(cls, bulk_data, parent=None, keep_ids=False):
         "Loads a list/dictionary structure to the tree."
@@ -474,8 +755,16 @@ class NS_Node(Node):
 
     def is_leaf(self):
         ":returns: True if the node is a leaf node (else, returns False)"
+        if self.node_spread:
+            return not self.__class__.objects.filter(
+                tree_id=self.tree_id,
+                lft__range=(self.lft + 1, self.rgt - 1)).exists()
         return self.rgt - self.lft == 1
 
+    def is_root(self):
+        ":returns: True if the node is a root node (else, returns False)"
+        return self.lft == 1
+
     def get_root(self):
         ":returns: the root node for the current node object."
         if self.lft == 1:
@@ -493,39 +782,31 @@ class NS_Node(Node):
         return self.get_parent(True).get_children()
 
     @classmethod
-    def dump_bulk(cls, parent=None, keep_ids=True):
-        "Dumps a tree branch to a python data structure."
-        qset = cls._get_serializable_model().get_tree(parent)
-        ret, lnk = [], {}
-        for pyobj in qset:
-            serobj = serializers.serialize('python', [pyobj])[0]
-            # django's serializer stores the attributes in 'fields'
-            fields = serobj['fields']
-            depth = fields['depth']
-            # this will be useless in load_bulk
-            del fields['lft']
-            del fields['rgt']
-            del fields['depth']
-            del fields['tree_id']
-            if 'id' in fields:
-                # this happens immediately after a load_bulk
-                del fields['id']
-
-            newobj = {'data': fields}
-            if keep_ids:
-                newobj['id'] = serobj['pk']
-
-            if (not parent and depth == 1) or \
-                    (parent and depth == parent.depth):
-                ret.append(newobj)
-            else:
-                parentobj = pyobj.get_parent()
-                parentser = lnk[parentobj.id]
-                if 'children' not in parentser:
-                    parentser['children'] = []
-                parentser['children'].append(newobj)
-            lnk[pyobj.id] = newobj
-        return ret
+    def _dump_bulk_iter(cls, parent=None, keep_ids=True):
+        "Walks a tree branch as DFS for :meth:`dump_bulk`."
+        qset = cls._get_serializable_model().objects.order_by('tree_id',
+                                                              'lft')
+        basedepth = 0
+        if parent:
+            qset = qset.filter(tree_id=parent.tree_id,
+                               lft__range=(parent.lft, parent.rgt))
+            basedepth = parent.depth - 1
+        last = None
+        while True:
+            # keyset pagination over (tree_id, lft)
+            batch = qset
+            if last is not None:
+                batch = batch.filter(Q(tree_id__gt=last.tree_id) |
+                                     Q(tree_id=last.tree_id, lft__gt=last.lft))
+            batch = list(batch[:cls.bulk_batch_size])
+            if not batch:
+                break
+            dumped = cls._dump_bulk_serialize(batch, keep_ids,
+                                              ('lft', 'rgt', 'depth',
+                                               'tree_id'))
+            for node, newobj in zip(batch, dumped):
+                yield node.depth - basedepth, newobj
+            last = batch[-1]
 
     @classmethod
     def get_tree(cls, parent=None):
@@ -536,7 +817,7 @@ class NS_Node(Node):
         if parent is None:
             # return the entire tree
             return cls.objects.all()
-        if parent.is_leaf():
+        if not cls.node_spread and parent.is_leaf():
             return cls.objects.filter(pk=parent.id)
         return cls.objects.filter(
             tree_id=parent.tree_id,
@@ -547,12 +828,14 @@ class NS_Node(Node):
         :returns: A queryset of all the node's descendants as DFS, doesn't
             include the node itself
         """
-        if self.is_leaf():
+        if not self.node_spread and self.is_leaf():
             return self.__class__.objects.none()
         return self.__class__.get_tree(self).exclude(pk=self.id)
 
     def get_descendant_count(self):
         ":returns: the number of descendants of a node."
+        if self.node_spread:
+            return self.get_descendants().count()
         return (self.rgt - self.lft - 1) / 2
 
     def get_ancestors(self):
@@ -590,10 +873,51 @@ class NS_Node(Node):
                 return self._cached_parent_obj
         except AttributeError:
             pass
-        # parent = our most direct ancestor
-        self._cached_parent_obj = self.get_ancestors().reverse()[0]
+        # parent = our only ancestor a level above
+        self._cached_parent_obj = self.__class__.objects.get(
+            tree_id=self.tree_id,
+            depth=self.depth - 1,
+            lft__lt=self.lft,
+            rgt__gt=self.rgt)
         return self._cached_parent_obj
 
+    @classmethod
+    def get_parents(cls, nodes):
+        """
+        :returns: A list with the parent node of every node in ``nodes``
+            (``None`` for root nodes and for nodes whose parent row is
+            missing), in the same order, with a single query
+            per batch of nodes. The parents are cached in the nodes like
+            :meth:`get_parent` does.
+        """
+        nodes = list(nodes)
+        children = [node for node in nodes if node.depth > 1]
+        # the parents found on every (tree_id, depth), as (lft, parent)
+        levels = {}
+        step = max(1, cls.bulk_batch_size // 4)
+        for pos in range(0, len(children), step):
+            parents = [Q(tree_id=node.tree_id, depth=node.depth - 1,
+                         lft__lt=node.lft, rgt__gt=node.rgt)
+                       for node in children[pos:pos + step]]
+            for parent in cls.objects.filter(reduce(operator.or_, parents)):
+                levels.setdefault((parent.tree_id, parent.depth), []).append(
+                    (parent.lft, parent))
+        for level in levels.values():
+            level.sort()
+        ret = []
+        for node in nodes:
+            parent = None
+            if node.depth > 1:
+                # the nodes of a level don't overlap: the parent is the last
+                # one starting before the node, if it contains the node
+                level = levels.get((node.tree_id, node.depth - 1), [])
+                pos = bisect.bisect_left(level, (node.lft, ))
+                if pos and level[pos - 1][1].rgt > node.rgt:
+                    parent = level[pos - 1][1]
+                    node._cached_parent_obj = parent
+            ret.append(parent)
+        return ret
+
     @classmethod
     def get_root_nodes(cls):
         ":returns: A queryset containing the root nodes in the tree."
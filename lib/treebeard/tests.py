@@ -2,14 +2,16 @@
 
 import functools
 import os
+from StringIO import StringIO
 from django.contrib.admin.options import ModelAdmin
 from django.contrib.admin.sites import AdminSite
 from django.test import TestCase
-from django.db import models, transaction
+from django.db import models, transaction, connection
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db.models import Q, signals
 from django.conf import settings
 from django import VERSION as DJANGO_VERSION
+from django.utils import simplejson
 
 from treebeard import numconv
 from treebeard.exceptions import InvalidPosition, InvalidMoveToDescendant, \
@@ -18,6 +20,7 @@ from treebeard.mp_tree import MP_Node
 from treebeard.al_tree import AL_Node
 from treebeard.ns_tree import NS_Node
 from treebeard.forms import MoveNodeForm
+from treebeard.testutils import QueryCountMixin
 
 # ghetto app detection, there is probably some introspection method,
 # but meh, this works
@@ -70,6 +73,15 @@ class NS_TestNodeSomeDep(models.Model):
         return 'Node %d' % self.id
 
 
+class NS_TestNodeSpread(NS_Node):
+    node_spread = 2
+    tree_id_spread = 2
+    desc = models.CharField(max_length=255)
+
+    def __unicode__(self):  # pragma: no cover
+        return 'Node %d' % self.id
+
+
 class AL_TestNode(AL_Node):
     parent = models.ForeignKey('self',
                                related_name='children_set',
@@ -89,6 +101,59 @@ class AL_TestNodeSomeDep(models.Model):
         return 'Node %d' % self.id
 
 
+class AL_TestNodeDepth(AL_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    sib_order = models.PositiveIntegerField()
+    depth = models.PositiveIntegerField(db_index=True, null=True)
+    desc = models.CharField(max_length=255)
+
+    def __unicode__(self):  # pragma: no cover
+        return 'Node %d' % self.id
+
+
+class AL_TestNodeDepthSomeDep(models.Model):
+    node = models.ForeignKey(AL_TestNodeDepth)
+
+    def __unicode__(self):  # pragma: no cover
+        return 'Node %d' % self.id
+
+
+class AL_TestNodeSpread(AL_Node):
+    sib_order_spread = 2
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    sib_order = models.PositiveIntegerField()
+    desc = models.CharField(max_length=255)
+
+    def __unicode__(self):  # pragma: no cover
+        return 'Node %d' % self.id
+
+
+class AL_TestNodePath(AL_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    sib_order = models.PositiveIntegerField()
+    path = models.CharField(max_length=255, unique=True, null=True)
+    desc = models.CharField(max_length=255)
+
+    def __unicode__(self):  # pragma: no cover
+        return 'Node %d' % self.id
+
+
+class AL_TestNodePathSomeDep(models.Model):
+    node = models.ForeignKey(AL_TestNodePath)
+
+    def __unicode__(self):  # pragma: no cover
+        return 'Node %d' % self.id
+
+
 class MP_TestNodeSorted(MP_Node):
     steplen = 1
     node_order_by = ['val1', 'val2', 'desc']
@@ -124,6 +189,36 @@ class AL_TestNodeSorted(AL_Node):
         return 'Node %d' % self.id
 
 
+class AL_TestNodePathSorted(AL_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    node_order_by = ['val1', 'val2', 'desc']
+    path = models.CharField(max_length=255, unique=True, null=True)
+    val1 = models.IntegerField()
+    val2 = models.IntegerField()
+    desc = models.CharField(max_length=255)
+
+    def __unicode__(self):  # pragma: no cover
+        return 'Node %d' % self.id
+
+
+class AL_TestNodeDepthSorted(AL_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    node_order_by = ['val1', 'val2', 'desc']
+    depth = models.PositiveIntegerField(db_index=True, null=True)
+    val1 = models.IntegerField()
+    val2 = models.IntegerField()
+    desc = models.CharField(max_length=255)
+
+    def __unicode__(self):  # pragma: no cover
+        return 'Node %d' % self.id
+
+
 class MP_TestNodeAlphabet(MP_Node):
     steplen = 2
 
@@ -182,6 +277,16 @@ if DJANGO_VERSION >= (1, 1):  # pragma: no cover
             proxy = True
 
 
+    class AL_TestNodePath_Proxy(AL_TestNodePath):
+        class Meta:
+            proxy = True
+
+
+    class AL_TestNodeDepth_Proxy(AL_TestNodeDepth):
+        class Meta:
+            proxy = True
+
+
 class MP_TestSortedNodeShortPath(MP_Node):
     steplen = 1
     alphabet = '01234'
@@ -210,6 +315,8 @@ def testtype(treetype, proxy):
         def _testtype(self):
             {'MP': self.set_MP,
              'AL': self.set_AL,
+             'ALP': self.set_ALP,
+             'ALD': self.set_ALD,
              'NS': self.set_NS}[treetype](proxy)
             try:
                 f(self)
@@ -230,7 +337,7 @@ def _load_test_methods(cls, proxy=True):
     for m in dir(cls):
         if not m.startswith('_multi_'):
             continue
-        for t in ('MP', 'AL', 'NS'):
+        for t in ('MP', 'AL', 'ALP', 'ALD', 'NS'):
             for p in proxyopts:
                 deco = testtype(t, p)
                 name = 'test_%s%s_%s' % (t.lower(),
@@ -239,7 +346,7 @@ def _load_test_methods(cls, proxy=True):
                 setattr(cls, name, deco(getattr(cls, m)))
 
 
-class TestTreeBase(TestCase):
+class TestTreeBase(QueryCountMixin, TestCase):
 
     def setUp(self):
         self.set_MP()
@@ -278,6 +385,22 @@ class TestTreeBase(TestCase):
         self.sorted_model = AL_TestNodeSorted
         self.dep_model = AL_TestNodeSomeDep
 
+    def set_ALP(self, proxy=False):
+        if proxy and DJANGO_VERSION >= (1, 1):
+            self.model = AL_TestNodePath_Proxy
+        else:
+            self.model = AL_TestNodePath
+        self.sorted_model = AL_TestNodePathSorted
+        self.dep_model = AL_TestNodePathSomeDep
+
+    def set_ALD(self, proxy=False):
+        if proxy and DJANGO_VERSION >= (1, 1):
+            self.model = AL_TestNodeDepth_Proxy
+        else:
+            self.model = AL_TestNodeDepth
+        self.sorted_model = AL_TestNodeDepthSorted
+        self.dep_model = AL_TestNodeDepthSomeDep
+
     def got(self):
         nsmodels = [NS_TestNode]
         if DJANGO_VERSION >= (1, 1):
@@ -295,6 +418,26 @@ class TestTreeBase(TestCase):
                 good_edges = range(1, len(got_edges) + 1)
                 self.assertEqual(sorted(got_edges), good_edges)
 
+        if issubclass(self.model, AL_TestNodePath):
+            # the materialized paths must agree with the parent pointers
+            paths = dict(self.model.objects.values_list('id', 'path'))
+            steplen = self.model.steplen
+            for pk, parent_id in self.model.objects.values_list('id',
+                                                                'parent'):
+                parentpath = paths.get(parent_id, '')
+                self.assertEqual(paths[pk][:-steplen], parentpath)
+
+        if issubclass(self.model, AL_TestNodeDepth):
+            # the stored depths must agree with the parent pointers
+            depths = {None: 0}
+            rows = list(self.model.objects.values_list('id', 'parent',
+                                                       'depth'))
+            while len(depths) <= len(rows):
+                for pk, parent_id, depth in rows:
+                    if parent_id in depths and pk not in depths:
+                        self.assertEqual(depth, depths[parent_id] + 1)
+                        depths[pk] = depth
+
         return [(o.desc, o.get_depth(), o.get_children_count())
                 for o in self.model.get_tree()]
 
@@ -351,6 +494,8 @@ class TestNonEmptyTree(TestTreeBase):
         super(TestNonEmptyTree, self).setUp()
         MP_TestNode.load_bulk(BASE_DATA)
         AL_TestNode.load_bulk(BASE_DATA)
+        AL_TestNodePath.load_bulk(BASE_DATA)
+        AL_TestNodeDepth.load_bulk(BASE_DATA)
         NS_TestNode.load_bulk(BASE_DATA)
 
 
@@ -473,6 +618,68 @@ class TestClassMethods(TestNonEmptyTree):
                 for o in self.model.get_tree()]
         self.assertEqual(got, self.unchanged)
 
+    def _multi_dump_bulk_stream_json(self):
+        node = self.model.objects.get(desc=u'231')
+        self.model.load_bulk(BASE_DATA, node)
+        node = self.model.objects.get(pk=node.id)
+        for parent in (None, node):
+            out = StringIO()
+            dumped = self.model.dump_bulk_stream(out, parent)
+            got = simplejson.loads(out.getvalue())
+            self.assertEqual(got, self.model.dump_bulk(parent))
+            self.assertEqual(dumped, len(self.model.get_tree(parent)))
+
+    def _multi_dump_bulk_stream_small_batches(self):
+        # the walk must cross the batch boundaries without losing nodes
+        self.model.bulk_batch_size = 3
+        try:
+            exp = self.model.dump_bulk()
+            out = StringIO()
+            self.model.dump_bulk_stream(out)
+            self.assertEqual(simplejson.loads(out.getvalue()), exp)
+        finally:
+            del self.model.bulk_batch_size
+
+    def _multi_load_and_dump_bulk_stream_jsonl(self):
+        exp = self.model.dump_bulk(keep_ids=True)
+        out = StringIO()
+        self.model.dump_bulk_stream(out, format='jsonl')
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), len(self.unchanged))
+        self.assertEqual([simplejson.loads(line)['depth'] for line in lines],
+                         [depth for desc, depth, numchild in self.unchanged])
+        self.model.objects.all().delete()
+        self.assertEqual(self.model.load_bulk_stream(
+            StringIO(out.getvalue()), None, True), len(lines))
+        self.assertEqual(self.model.dump_bulk(keep_ids=True), exp)
+        got = [(o.desc, o.get_depth(), o.get_children_count())
+                for o in self.model.get_tree()]
+        self.assertEqual(got, self.unchanged)
+
+    def _multi_load_bulk_stream_small_batches(self):
+        # the nodes of a batch hang from nodes loaded by the previous ones
+        node = self.model.objects.get(desc=u'231')
+        exp = self.model.dump_bulk(keep_ids=False)
+        out = StringIO()
+        self.model.dump_bulk_stream(out, keep_ids=False, format='jsonl')
+        self.model.bulk_batch_size = 3
+        try:
+            self.assertEqual(self.model.load_bulk_stream(
+                StringIO(out.getvalue()), node), len(self.unchanged))
+        finally:
+            del self.model.bulk_batch_size
+        node = self.model.objects.get(pk=node.pk)
+        self.assertEqual(self.model.dump_bulk(node, False),
+                         [{'data': {'desc': u'231'}, 'children': exp}])
+
+    def _multi_dump_bulk_stream_empty_and_format(self):
+        self.model.objects.all().delete()
+        out = StringIO()
+        self.assertEqual(self.model.dump_bulk_stream(out), 0)
+        self.assertEqual(out.getvalue(), '[]')
+        self.assertRaises(ValueError, self.model.dump_bulk_stream, out,
+                          format='xml')
+
     def _multi_get_root_nodes(self):
         got = self.model.get_root_nodes()
         expected = ['1', '2', '3', '4']
@@ -565,6 +772,32 @@ class TestSimpleNodeMethods(TestNonEmptyTree):
             else:
                 self.assertEqual(parent, None)
 
+    def _multi_get_parents(self):
+        descs = ['231', '1', '41', '21', '24', '23', '4']
+        nodes = [self.model.objects.get(desc=desc) for desc in descs]
+        parents, queries = self._count_queries(self.model.get_parents, nodes)
+        self.assertEqual(queries, 1)
+        # cached in the nodes
+        got, queries = self._count_queries(
+            lambda: [node.get_parent() for node in nodes])
+        self.assertEqual((got, queries), (parents, 0))
+        self.assertEqual([parent and parent.desc for parent in parents],
+                         [u'23', None, u'4', u'2', u'2', u'2', None])
+        self.assertEqual(self.model.get_parents([]), [])
+
+    def _multi_get_parents_missing(self):
+        self.model.objects.get(desc=u'21').add_child(desc=u'211')
+        nodes = [self.model.objects.get(desc=desc)
+                 for desc in ('231', '211', '41')]
+        # a corrupted tree: the row of 23 is gone, its child is left
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE id = %%s' % (
+            connection.ops.quote_name(self.model._meta.db_table), ),
+            [self.model.objects.get(desc=u'23').pk])
+        parents = self.model.get_parents(nodes)
+        self.assertEqual([parent and parent.desc for parent in parents],
+                         [None, u'21', u'4'])
+
     def _multi_get_children(self):
         data = [
             ('2', ['21', '22', '23', '24']),
@@ -1047,6 +1280,17 @@ class TestDelete(TestNonEmptyTree):
                     (u'41', 2, 0)]
         self.assertEqual(self.got(), expected)
 
+    def _multi_delete_filter_scattered(self):
+        # several gaps in the same tree, closed together
+        self.model.objects.filter(
+            desc__in=('21', '23', '231', '24', '41')).delete()
+        expected = [(u'1', 1, 0),
+                    (u'2', 1, 1),
+                    (u'22', 2, 0),
+                    (u'3', 1, 0),
+                    (u'4', 1, 0)]
+        self.assertEqual(self.got(), expected)
+
     def _multi_delete_nonexistant_nodes(self):
         self.model.objects.filter(desc__in=('ZZZ', 'XXX')).delete()
         self.assertEqual(self.got(), self.unchanged)
@@ -1677,7 +1921,8 @@ class TestMP_TreeAlphabet(TestCase):
 class TestHelpers(TestTreeBase):
 
     def setUp(self):
-        for model in (MP_TestNode, AL_TestNode, NS_TestNode):
+        for model in (MP_TestNode, AL_TestNode, AL_TestNodePath,
+                      AL_TestNodeDepth, NS_TestNode):
             model.load_bulk(BASE_DATA)
             for node in model.get_root_nodes():
                 model.load_bulk(BASE_DATA, node)
@@ -1699,6 +1944,268 @@ class TestHelpers(TestTreeBase):
         self.assertEqual(got, expected)
 
 
+class TestAL_TreeBulk(TestNonEmptyTree):
+
+    def setUp(self):
+        super(TestAL_TreeBulk, self).setUp()
+        self.set_AL()
+
+    def test_get_tree_single_query(self):
+        got, queries = self._count_queries(self.model.get_tree)
+        self.assertEqual(queries, 1)
+        self.assertEqual([(o.desc, o.get_depth(), o.get_children_count())
+                          for o in got], self.unchanged)
+
+    def test_get_tree_caches_relations(self):
+        tree = self.model.get_tree()
+        node = [o for o in tree if o.desc == u'231'][0]
+        got, queries = self._count_queries(
+            lambda: [o.desc for o in node.get_ancestors()])
+        self.assertEqual(got, [u'2', u'23'])
+        self.assertEqual(queries, 0)
+
+    def test_get_tree_bfs_fallback(self):
+        node = self.model.objects.get(desc=u'2')
+        expected = [o.desc for o in self.model.get_tree(node)]
+        nodes = self.model._get_subtree_bfs(node)
+        got = self.model._stitch_subtree(node, nodes, 2)
+        self.assertEqual([o.desc for o in got], expected)
+        self.assertEqual([o.get_depth() for o in got], [1, 2, 2, 2, 3, 2])
+        nodes = self.model._get_subtree_bfs(None)
+        got = self.model._stitch_subtree(None, nodes, 1)
+        self.assertEqual([(o.desc, o.get_depth(), o.get_children_count())
+                          for o in got], self.unchanged)
+
+    def test_get_tree_levels(self):
+        node = self.model.objects.get(desc=u'2')
+        self.assertEqual([o.desc for o in self.model.get_tree(node, 0)],
+                         [u'2'])
+        self.assertEqual([o.desc for o in self.model.get_tree(node, 1)],
+                         [u'2', u'21', u'22', u'23', u'24'])
+        self.assertEqual([o.desc for o in self.model.get_tree(None, 0)],
+                         [u'1', u'2', u'3', u'4'])
+        self.assertEqual(
+            [o.desc for o in self.model._get_subtree_bfs(node, 1)],
+            [u'21', u'22', u'23', u'24'])
+
+    def test_get_descendant_count_single_query(self):
+        node = self.model.objects.get(desc=u'2')
+        got, queries = self._count_queries(node.get_descendant_count)
+        self.assertEqual((got, queries), (5, 1))
+
+    def test_bulk_load(self):
+        for model in (AL_TestNode, AL_TestNodePath, AL_TestNodeDepth):
+            self.model = model
+            model.objects.all().delete()
+            ids, queries = self._count_queries(model.bulk_load, BASE_DATA)
+            self.assertEqual(len(ids), 10)
+            self.assertEqual(sorted(model.objects.values_list('id',
+                                                              flat=True)),
+                             sorted(ids))
+            self.assertEqual(self.got(), self.unchanged)
+            self.assertTrue(ids.nodes_per_second >= 0)
+            # max id, max sib_order (and max path), then one INSERT
+            self.assertTrue(queries <= 4)
+
+    def test_bulk_load_existing(self):
+        for model in (AL_TestNode, AL_TestNodePath, AL_TestNodeDepth):
+            self.model = model
+            node = model.objects.get(desc=u'231')
+            model.load_bulk(BASE_DATA, node)
+            expected = self.got()
+            model.objects.all().delete()
+            model.load_bulk(BASE_DATA)
+            node = model.objects.get(desc=u'231')
+            model.bulk_load(BASE_DATA, node)
+            self.assertEqual(self.got(), expected)
+            node = model.get_root_nodes().get(desc=u'4')
+            model.bulk_load([{'data': {'desc': u'42'}}], node)
+            self.assertEqual([(o.desc, o.sib_order)
+                              for o in node.get_children()],
+                             [(u'41', 1), (u'42', 2)])
+
+    def test_bulk_load_keeping_ids(self):
+        for model in (AL_TestNode, AL_TestNodePath, AL_TestNodeDepth):
+            self.model = model
+            exp = model.dump_bulk(keep_ids=True)
+            model.objects.all().delete()
+            model.bulk_load(exp, None, True)
+            self.assertEqual(model.dump_bulk(keep_ids=True), exp)
+            self.assertEqual(self.got(), self.unchanged)
+            # new nodes still get fresh ids
+            node = model.add_root(desc=u'5')
+            self.assertTrue(node.id > max([o['id'] for o in exp]))
+
+    def test_bulk_load_sorted(self):
+        data = [{'data': {'val1': 3, 'val2': 1, 'desc': u'b'}},
+                {'data': {'val1': 1, 'val2': 4, 'desc': u'a'},
+                 'children': [{'data': {'val1': 2, 'val2': 2,
+                                        'desc': u'c'}}]}]
+        for model in (AL_TestNodeSorted, AL_TestNodePathSorted,
+                      AL_TestNodeDepthSorted):
+            model.bulk_load(data)
+            self.assertEqual([(o.desc, o.get_depth())
+                              for o in model.get_tree()],
+                             [(u'a', 1), (u'c', 2), (u'b', 1)])
+
+    def test_dump_and_load_bulk_stream_queries(self):
+        # a query per level, the serializer doesn't fetch the parents
+        out = StringIO()
+        dumped, queries = self._count_queries(self.model.dump_bulk_stream,
+                                              out, format='jsonl')
+        self.assertEqual((dumped, queries), (10, 4))
+        # the whole file fits in a single bulk_load
+        self.model.objects.all().delete()
+        added, queries = self._count_queries(self.model.load_bulk_stream,
+                                             StringIO(out.getvalue()), None,
+                                             True)
+        self.assertEqual(added, 10)
+        self.assertTrue(queries <= 4)
+        self.assertEqual(self.got(), self.unchanged)
+
+    def test_bulk_load_model(self):
+        data = [{'data': {'desc': u'1'}, 'model': AL_TestNode_Proxy},
+                {'data': {'desc': u'2'}, 'model': 'treebeard.AL_TestNode'}]
+        AL_TestNode.bulk_load(data)
+        self.assertRaises(ValueError, AL_TestNode.bulk_load,
+                          [{'data': {'desc': u'3'}, 'model': MP_TestNode}])
+
+
+class TestAL_TreePath(TestNonEmptyTree):
+
+    def setUp(self):
+        super(TestAL_TreePath, self).setUp()
+        self.set_ALP()
+
+    def test_paths(self):
+        got = [(o.desc, o.path) for o in self.model.get_tree()]
+        self.assertEqual(got, [(u'1', u'0001'),
+                               (u'2', u'0002'),
+                               (u'21', u'00020001'),
+                               (u'22', u'00020002'),
+                               (u'23', u'00020003'),
+                               (u'231', u'000200030001'),
+                               (u'24', u'00020004'),
+                               (u'3', u'0003'),
+                               (u'4', u'0004'),
+                               (u'41', u'00040001')])
+
+    def test_queries(self):
+        node = self.model.objects.get(desc=u'231')
+        root = self.model.objects.get(desc=u'2')
+        got, queries = self._count_queries(node.get_depth)
+        self.assertEqual((got, queries), (3, 0))
+        got, queries = self._count_queries(node.is_descendant_of, root)
+        self.assertEqual((got, queries), (True, 0))
+        got, queries = self._count_queries(root.is_descendant_of, node)
+        self.assertEqual((got, queries), (False, 0))
+        got, queries = self._count_queries(node.get_ancestors)
+        self.assertEqual(([o.desc for o in got], queries), ([u'2', u'23'], 1))
+        got, queries = self._count_queries(node.get_root)
+        self.assertEqual((got.desc, queries), (u'2', 1))
+        got, queries = self._count_queries(root.get_descendant_count)
+        self.assertEqual((got, queries), (5, 1))
+        got, queries = self._count_queries(self.model.get_tree, root, 1)
+        self.assertEqual(([o.desc for o in got], queries),
+                         ([u'2', u'21', u'22', u'23', u'24'], 1))
+
+    def test_move_branch(self):
+        node = self.model.objects.get(desc=u'23')
+        node.move(self.model.objects.get(desc=u'41'), 'first-child')
+        self.assertEqual(node.path, u'000400010001')
+        self.assertEqual(self.model.objects.get(desc=u'231').path,
+                         u'0004000100010001')
+        self.assertEqual(self.got(), [(u'1', 1, 0),
+                                      (u'2', 1, 3),
+                                      (u'21', 2, 0),
+                                      (u'22', 2, 0),
+                                      (u'24', 2, 0),
+                                      (u'3', 1, 0),
+                                      (u'4', 1, 1),
+                                      (u'41', 2, 1),
+                                      (u'23', 3, 1),
+                                      (u'231', 4, 0)])
+
+    def test_create_and_rebuild(self):
+        parent = self.model.objects.get(desc=u'4')
+        node = self.model.objects.create(desc=u'42', parent=parent,
+                                         sib_order=2)
+        self.assertEqual(node.path, u'00040002')
+        expected = sorted(self.model.objects.values_list('desc', 'path'))
+        self.model.objects.update(path=None)
+        self.model.rebuild_paths()
+        self.assertEqual(sorted(self.model.objects.values_list('desc',
+                                                               'path')),
+                         expected)
+
+
+class TestAL_TreeDepth(TestNonEmptyTree):
+
+    def setUp(self):
+        super(TestAL_TreeDepth, self).setUp()
+        self.set_ALD()
+
+    def test_queries(self):
+        nodes = list(self.model.objects.all())
+        got, queries = self._count_queries(
+            lambda: [(o.desc, o.get_depth()) for o in nodes])
+        self.assertEqual((sorted(got), queries),
+                         (sorted([(desc, depth)
+                                  for desc, depth, children in self.unchanged]),
+                          0))
+        got, queries = self._count_queries(self.model.get_annotated_list)
+        self.assertEqual(([(o.desc, info['level']) for o, info in got],
+                          queries),
+                         ([(desc, depth - 1)
+                           for desc, depth, children in self.unchanged], 1))
+        got, queries = self._count_queries(self.model.get_tree, None, 1)
+        self.assertEqual(([o.desc for o in got], queries),
+                         ([u'1', u'2', u'21', u'22', u'23', u'24', u'3', u'4',
+                           u'41'], 1))
+
+    def test_get_nodes_at_depth(self):
+        for depth, expected in ((1, [u'1', u'2', u'3', u'4']),
+                                (2, [u'21', u'22', u'23', u'24', u'41']),
+                                (3, [u'231']),
+                                (4, [])):
+            for model in (AL_TestNode, AL_TestNodePath, AL_TestNodeDepth):
+                got, queries = self._count_queries(
+                    lambda: sorted([o.desc for o in
+                                    model.get_nodes_at_depth(depth)]))
+                self.assertEqual(got, expected)
+                if model is not AL_TestNode:
+                    self.assertEqual(queries, 1)
+
+    def test_move_branch(self):
+        node = self.model.objects.get(desc=u'2')
+        node.move(self.model.objects.get(desc=u'41'), 'first-child')
+        self.assertEqual(node.depth, 3)
+        self.assertEqual(
+            sorted(self.model.objects.values_list('desc', 'depth')),
+            [(u'1', 1), (u'2', 3), (u'21', 4), (u'22', 4), (u'23', 4),
+             (u'231', 5), (u'24', 4), (u'3', 1), (u'4', 1), (u'41', 2)])
+        # back to the root level, without recursive queries
+        AL_TestNodeDepth._supports_recursive_cte = classmethod(
+            lambda cls: False)
+        try:
+            node.move(self.model.objects.get(desc=u'1'), 'right')
+        finally:
+            del AL_TestNodeDepth._supports_recursive_cte
+        self.assertEqual(self.got(), self.unchanged)
+
+    def test_create_and_rebuild(self):
+        parent = self.model.objects.get(desc=u'41')
+        node = self.model.objects.create(desc=u'411', parent=parent,
+                                         sib_order=1)
+        self.assertEqual(node.depth, 3)
+        expected = sorted(self.model.objects.values_list('desc', 'depth'))
+        self.model.objects.update(depth=None)
+        self.model.rebuild_depths()
+        self.assertEqual(sorted(self.model.objects.values_list('desc',
+                                                               'depth')),
+                         expected)
+
+
 class TestMP_TreeSortedAutoNow(TestCase):
     """
     The sorting mechanism used by treebeard when adding a node can fail if the
@@ -1763,6 +2270,303 @@ class TestMP_TreeStepOverflow(TestCase):
                 self.assertRaises(PathOverflow, newroot.move, target, pos)
 
 
+class TestMP_TreeDelete(TestNonEmptyTree):
+
+    def setUp(self):
+        super(TestMP_TreeDelete, self).setUp()
+        self.set_MP()
+
+    def test_delete_statements(self):
+        # no other model refers to sorted_model: plain DELETE statements
+        self.model = self.sorted_model
+        for val in (1, 3):
+            node = self.model.add_root(val1=val, val2=val, desc=u'%d' % val)
+            for i in range(20):
+                node.add_child(val1=val, val2=i, desc=u'%d-%d' % (val, i))
+        ret, few = self._count_queries(
+            self.model.objects.filter(desc__in=(u'1-0', u'3-0')).delete)
+        ret, many = self._count_queries(
+            self.model.objects.filter(desc__regex=r'^[13]-1?[13579]$').delete)
+        # the number of statements doesn't depend on the number of nodes
+        self.assertEqual(few, many)
+        self.assertEqual(many, 3)
+        self.assertEqual(
+            [(o.desc, o.numchild) for o in self.model.get_root_nodes()],
+            [(u'1', 9), (u'3', 9)])
+        self.assertEqual(self.model.objects.count(), 20)
+
+    def test_delete_alphabet_with_both_cases(self):
+        # the branches are matched by prefix, '0a' isn't a prefix of '0A'
+        model = MP_TestNodeAlphabet
+        model.alphabet = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ' \
+                         'abcdefghijklmnopqrstuvwxyz'
+        try:
+            for numval, path in enumerate(('0A', '0A01', '0a', '0a01', '0b')):
+                model.objects.create(path=path, depth=len(path) / 2,
+                                     numchild=int(len(path) == 2 and
+                                                  path != '0b'),
+                                     numval=numval)
+            self.assertEqual(model._has_delete_dependencies(), False)
+            model.objects.filter(path__in=('0a', '0b')).delete()
+            self.assertEqual([o.path for o in model.objects.all()],
+                             ['0A', '0A01'])
+        finally:
+            del model.alphabet
+
+    def test_delete_stale_numchild(self):
+        self.model = self.sorted_model
+        node = self.model.add_root(val1=1, val2=1, desc=u'1')
+        for i in range(3):
+            node.add_child(val1=1, val2=i, desc=u'1-%d' % i)
+        self.model.objects.filter(pk=node.pk).update(numchild=1)
+        self.model.objects.filter(depth=2).delete()
+        # numchild never goes below 0
+        self.assertEqual(self.model.objects.get(pk=node.pk).numchild, 0)
+
+    def test_delete_dependencies(self):
+        self.assertEqual(self.model._has_delete_dependencies(), True)
+        self.assertEqual(self.sorted_model._has_delete_dependencies(), False)
+        for node in self.model.objects.all():
+            self.dep_model(node=node).save()
+        self.model.objects.filter(desc__in=(u'21', u'23')).delete()
+        self.assertEqual(self.dep_model.objects.count(), 7)
+        self.assertEqual(self.model.objects.get(desc=u'2').numchild, 2)
+
+    def test_delete_receivers(self):
+        deleted = []
+
+        def receiver(sender, instance, **kwargs):
+            deleted.append(instance.desc)
+
+        signals.post_delete.connect(receiver, sender=self.sorted_model)
+        try:
+            self.assertEqual(self.sorted_model._has_delete_dependencies(),
+                             True)
+            self.sorted_model.add_root(val1=1, val2=1, desc=u'1')
+            self.sorted_model.objects.all().delete()
+        finally:
+            signals.post_delete.disconnect(receiver, sender=self.sorted_model)
+        self.assertEqual(deleted, [u'1'])
+        self.assertEqual(self.sorted_model._has_delete_dependencies(), False)
+
+
+class TestNS_TreeSpread(TestNonEmptyTree):
+
+    def setUp(self):
+        super(TestNS_TreeSpread, self).setUp()
+        self.set_NS()
+        self.spread_model = NS_TestNodeSpread
+        self.spread_model.load_bulk(BASE_DATA)
+
+    def got(self, model):
+        # the edges are unique and nested, but not consecutive
+        rows = list(model.objects.values_list('tree_id', 'lft', 'rgt',
+                                              'depth'))
+        for tree_id, lft, rgt, depth in rows:
+            self.assertTrue(lft < rgt)
+            inside = [row for row in rows if row[0] == tree_id and
+                      (lft < row[1] < rgt or lft < row[2] < rgt)]
+            for row in inside:
+                self.assertTrue(lft < row[1] < row[2] < rgt)
+                self.assertTrue(row[3] > depth)
+            ancestors = [row for row in rows if row[0] == tree_id and
+                         row[1] < lft and row[2] > rgt]
+            self.assertEqual(len(ancestors), depth - 1)
+        return [(o.desc, o.get_depth(), o.get_children_count(),
+                 o.get_descendant_count(), o.is_leaf())
+                for o in model.get_tree()]
+
+    def test_load_bulk(self):
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+        self.assertEqual(self.spread_model.dump_bulk(keep_ids=False),
+                         self.model.dump_bulk(keep_ids=False))
+
+    def test_add_fills_gaps(self):
+        for desc, pos in ((u'21', 'right'), (u'24', 'left'),
+                          (u'24', 'last-sibling')):
+            node = self.spread_model.objects.get(desc=desc)
+            node, updates = self._count_updates(node.add_sibling, pos,
+                                                desc=u'new')
+            self.assertEqual(updates, 0)
+            self.model.objects.get(desc=desc).add_sibling(pos, desc=u'new')
+        node = self.spread_model.objects.get(desc=u'23')
+        node, updates = self._count_updates(node.add_child, desc=u'new')
+        self.assertEqual(updates, 0)
+        self.model.objects.get(desc=u'23').add_child(desc=u'new')
+        # no room left before 21: one bounded UPDATE
+        node = self.spread_model.objects.get(desc=u'21')
+        node, updates = self._count_updates(node.add_sibling, 'first-sibling',
+                                            desc=u'new')
+        self.assertEqual(updates, 1)
+        self.model.objects.get(desc=u'21').add_sibling('first-sibling',
+                                                       desc=u'new')
+        self.assertEqual(self.spread_model.objects.get(desc=u'1').rgt, 4)
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+
+    def test_add_renumbering(self):
+        total = 0
+        for i in range(50):
+            for desc in (u'231', u'2'):
+                node = self.spread_model.objects.get(desc=desc)
+                child, updates = self._count_updates(node.add_child,
+                                                     desc=u'%s-%d' % (desc, i))
+                total += updates
+                self.model.objects.get(desc=desc).add_child(
+                    desc=u'%s-%d' % (desc, i))
+        # the gaps grow with the number of children
+        self.assertTrue(total < 20)
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+
+    def test_add_with_stale_parent(self):
+        # the boundaries of a spread node change as other instances of it
+        # get children: they're reloaded before looking for room
+        node = self.spread_model.objects.get(desc=u'231')
+        for i in range(21):
+            for model in (self.model, self.spread_model):
+                model.objects.get(desc=u'231').add_child(desc=u'b%d' % i)
+        self.assertTrue(node.rgt <
+                        self.spread_model.objects.get(desc=u'231').rgt)
+        # the gap left after the last child is used, nothing is moved
+        newobj, updates = self._count_updates(node.add_child, desc=u'z')
+        self.assertEqual(updates, 0)
+        self.model.objects.get(desc=u'231').add_child(desc=u'z')
+        # and the parent cached by the new node is the reloaded one
+        for model in (self.model, self.spread_model):
+            model.objects.get(desc=u'22').move(
+                model.objects.get(desc=u'231'), 'last-child')
+        newobj.add_sibling('first-sibling', desc=u'y')
+        self.model.objects.get(desc=u'z').add_sibling('first-sibling',
+                                                      desc=u'y')
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+
+    def test_move_and_delete(self):
+        for model in (self.model, self.spread_model):
+            get = lambda desc: model.objects.get(desc=desc)
+            get(u'231').move(get(u'21'), 'left')
+            get(u'4').move(get(u'22'), 'last-child')
+            get(u'24').move(get(u'1'), 'last-child')
+            get(u'3').move(get(u'2'), 'first-child')
+            model.objects.filter(desc__in=(u'21', u'1')).delete()
+            get(u'41').add_sibling('first-sibling', desc=u'40')
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+
+    def test_add_root_fills_gaps(self):
+        self.assertEqual([o.tree_id
+                          for o in self.spread_model.get_root_nodes()],
+                         [3, 6, 9, 12])
+        for desc, pos, updates in ((u'2', 'left', 0), (u'4', 'right', 0),
+                                   (u'3', 'first-sibling', 0),
+                                   (u'3', 'first-sibling', 1)):
+            node = self.spread_model.objects.get(desc=desc)
+            node, got_updates = self._count_updates(node.add_sibling, pos,
+                                                    desc=u'new')
+            self.assertEqual(got_updates, updates)
+            self.model.objects.get(desc=desc).add_sibling(pos, desc=u'new')
+        for model in (self.model, self.spread_model):
+            model.objects.get(desc=u'3').move(model.objects.get(desc=u'1'),
+                                              'left')
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+        # the roots before the one with tree_id 15 were spread
+        self.assertEqual([o.tree_id
+                          for o in self.spread_model.get_root_nodes()],
+                         [1, 3, 4, 5, 7, 9, 13, 15])
+
+    def test_add_root_sorted(self):
+        self.sorted_model.tree_id_spread = 4
+        try:
+            total = 0
+            for i in range(40):
+                val = (i * 7) % 40
+                node, updates = self._count_updates(
+                    self.sorted_model.add_root, val1=val, val2=0, desc=u'x')
+                total += updates
+        finally:
+            self.sorted_model.tree_id_spread = 0
+        self.assertTrue(total <= 2)
+        self.assertEqual([o.val1 for o in self.sorted_model.get_root_nodes()],
+                         range(40))
+
+
+class TestAL_TreeSpread(TestNonEmptyTree):
+
+    def setUp(self):
+        super(TestAL_TreeSpread, self).setUp()
+        self.set_AL()
+        self.spread_model = AL_TestNodeSpread
+        self.spread_model.load_bulk(BASE_DATA)
+
+    def got(self, model):
+        # the siblings have unique, but not consecutive, sib_orders
+        siblings = {}
+        for parent_id, sib_order in model.objects.values_list('parent',
+                                                              'sib_order'):
+            siblings.setdefault(parent_id, []).append(sib_order)
+        for sib_orders in siblings.values():
+            self.assertEqual(len(set(sib_orders)), len(sib_orders))
+        return [(o.desc, o.get_depth(), o.get_children_count())
+                for o in model.get_tree()]
+
+    def test_load_bulk(self):
+        self.assertEqual([o.sib_order
+                          for o in self.spread_model.get_root_nodes()],
+                         [3, 6, 9, 12])
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+        self.spread_model.objects.all().delete()
+        self.spread_model.bulk_load(BASE_DATA)
+        self.assertEqual([o.sib_order
+                          for o in self.spread_model.get_root_nodes()],
+                         [3, 6, 9, 12])
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+
+    def test_add_fills_gaps(self):
+        for desc, pos, updates in ((u'22', 'left', 0), (u'22', 'right', 0),
+                                   (u'21', 'first-sibling', 0),
+                                   (u'21', 'first-sibling', 1),
+                                   (u'3', 'left', 0)):
+            node = self.spread_model.objects.get(desc=desc)
+            node, got_updates = self._count_updates(node.add_sibling, pos,
+                                                    desc=u'new')
+            self.assertEqual(got_updates, updates)
+            self.model.objects.get(desc=desc).add_sibling(pos, desc=u'new')
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+        # no gap left before 21: the children of 2 were spread, the
+        # root nodes were not
+        self.assertEqual([(o.desc, o.sib_order) for o in
+                          self.spread_model.objects.get(
+                              desc=u'2').get_children()],
+                         [(u'new', 1), (u'new', 3), (u'21', 6), (u'new', 9),
+                          (u'22', 12), (u'new', 15), (u'23', 18), (u'24', 21)])
+        self.assertEqual([(o.desc, o.sib_order)
+                          for o in self.spread_model.get_root_nodes()],
+                         [(u'1', 3), (u'2', 6), (u'new', 7), (u'3', 9),
+                          (u'4', 12)])
+
+    def test_add_renumbering(self):
+        total = 0
+        for i in range(50):
+            for model in (self.model, self.spread_model):
+                children = list(model.objects.get(desc=u'2').get_children())
+                node = children[(i * 7) % len(children)]
+                newobj, updates = self._count_updates(
+                    node.add_sibling, 'left', desc=u'new-%d' % i)
+            total += updates
+        # only the inserts without a free sib_order renumber siblings
+        self.assertTrue(total < 20)
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+
+    def test_move(self):
+        for model in (self.model, self.spread_model):
+            get = lambda desc: model.objects.get(desc=desc)
+            get(u'24').move(get(u'21'), 'left')
+            get(u'22').move(get(u'24'), 'right')
+            get(u'21').move(get(u'24'), 'first-sibling')
+            get(u'4').move(get(u'23'), 'first-child')
+            get(u'231').move(get(u'41'), 'right')
+            get(u'3').move(get(u'1'), 'left')
+            get(u'1').move(get(u'2'), 'last-child')
+        self.assertEqual(self.got(self.spread_model), self.got(self.model))
+
+
 class TestMP_TreeShortPath(TestCase):
     """
     Here we test a tree with a very small path field (max_length=4) and a
@@ -1806,6 +2610,13 @@ class TestMP_TreeFindProblems(TestTreeBase):
         self.assertEqual(['04', '0401'],
             [o.path for o in model.objects.filter(id__in=wrong_depth)])
 
+    def test_find_problems_queries(self):
+        MP_TestNode.load_bulk(BASE_DATA)
+        problems, queries = self._count_queries(MP_TestNode.find_problems)
+        # the grouped numchild pass and the node values
+        self.assertEqual(queries, 2)
+        self.assertEqual(problems, ([], [], [], [], []))
+
 
 class TestMP_TreeFix(TestTreeBase):
 
@@ -1898,17 +2709,39 @@ class TestMP_TreeFix(TestTreeBase):
 
         for model in (MP_TestNodeShortPath, MP_TestSortedNodeShortPath):
             self.add_broken_test_data(model)
-            model.fix_tree(destructive=False)
+            report = model.fix_tree(destructive=False)
             self.assertEqual(self.got(model), self.expected_with_holes[model])
             model.find_problems()
+            self.assertEqual((report['depth'], report['numchild']), (14, 14))
+            # nothing left to fix
+            report = model.fix_tree(destructive=False)
+            self.assertEqual((report['depth'], report['numchild']), (0, 0))
 
     def test_fix_tree_destructive(self):
 
         for model in (MP_TestNodeShortPath, MP_TestSortedNodeShortPath):
             self.add_broken_test_data(model)
-            model.fix_tree(destructive=True)
+            descs = dict(model.objects.values_list('id', 'desc'))
+            report = model.fix_tree(destructive=True)
             self.assertEqual(self.got(model), self.expected_no_holes[model])
             model.find_problems()
+            # fixed in place: same rows, same primary keys
+            self.assertEqual(dict(model.objects.values_list('id', 'desc')),
+                             descs)
+            self.assertTrue(report['moved'] > 0)
+            report = model.fix_tree(destructive=True)
+            self.assertEqual((report['depth'], report['numchild'],
+                              report['moved']), (0, 0, 0))
+
+    def test_fix_tree_destructive_resume(self):
+        model = MP_TestSortedNodeShortPath
+        self.add_broken_test_data(model)
+        # a fix interrupted while swapping two branches: one of them was left
+        # on the parking step
+        sql, vals = model._get_sql_newpath_in_branches('4', '0')
+        connection.cursor().execute(sql, vals)
+        model.fix_tree(destructive=True)
+        self.assertEqual(self.got(model), self.expected_no_holes[model])
 
 
 class TestIssues(TestCase):
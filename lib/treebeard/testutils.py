@@ -0,0 +1,31 @@
+"Helpers for the tests of treebeard and of the apps that build on it"
+
+from django.conf import settings
+from django.db import connection
+
+
+class QueryCountMixin(object):
+    "TestCase mixin to check the queries run by a piece of code"
+
+    def _get_queries(self, func, *args, **kwargs):
+        """
+        Runs func with DEBUG on, returns its result and the list of the
+        queries it ran.
+        """
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            ret = func(*args, **kwargs)
+        finally:
+            settings.DEBUG = old_debug
+        return ret, connection.queries
+
+    def _count_queries(self, func, *args, **kwargs):
+        ret, queries = self._get_queries(func, *args, **kwargs)
+        return ret, len(queries)
+
+    def _count_updates(self, func, *args, **kwargs):
+        ret, queries = self._get_queries(func, *args, **kwargs)
+        return ret, len([query for query in queries
+                         if query['sql'].startswith('UPDATE')])